@@ -0,0 +1,107 @@
+"""
+Бенчмарк одновременной отправки заявок на медленный SMTP-сервер.
+
+N вызовов send_email запускаются одновременно; локальный SMTP-сервер отвечает
+на каждое письмо с задержкой --delay секунд. Сравниваются два транспорта:
+
+    blocking   прежний способ: smtplib вызывается прямо в event loop,
+               заявки отправляются по очереди, а цикл событий стоит
+    transport  SmtpTransport: smtplib работает в пуле потоков
+
+Параллельно с отправкой в цикле событий тикает задача с периодом 10 мс;
+её наибольшая задержка показывает, отвечал ли бот другим чатам.
+
+    python benchmarks/concurrent_send.py --requests 10 --delay 1
+"""
+
+import os
+import asyncio
+import argparse
+import tempfile
+import time
+from datetime import date
+
+from support import SinkServer, import_main
+
+TICK = 0.01
+
+
+class BlockingTransport:
+    """Отправка, как до выноса SMTP в пул потоков: блокирующий вызов внутри корутины."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def send(self, from_addr, to_addrs, make_chunks):
+        self.pool.send_stream(from_addr, to_addrs, make_chunks)
+
+
+async def heartbeat(stop, lags):
+    """Тикает каждые TICK секунд и запоминает, насколько цикл событий опоздал с тиком."""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - started - TICK)
+
+
+async def submit(main, count):
+    positions = [
+        main.Position(name=f"Позиция {i + 1}", unit="шт", quantity=i + 1, module="1", delivery_date=date(2025, 7, 1))
+        for i in range(5)
+    ]
+    stop, lags = asyncio.Event(), []
+    ticker = asyncio.create_task(heartbeat(stop, lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        main.send_email(chat_id, "Мотели", "Каркаролинск", positions, "Иван Петров", "@ivan")
+        for chat_id in range(count)
+    ))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    return elapsed, max(lags, default=0)
+
+
+def run(main, transport, count):
+    main.mail_transport = transport
+    single, _ = asyncio.run(submit(main, 1)) # Первая отправка заодно открывает SMTP-сессию
+    single, _ = asyncio.run(submit(main, 1))
+    total, lag = asyncio.run(submit(main, count))
+    return single, total, lag
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=10, help="заявок, отправляемых одновременно")
+    parser.add_argument("--delay", type=float, default=1.0, help="задержка ответа SMTP-сервера на письмо, сек")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = import_main(workdir)
+        bot.excel_renderer.start()
+        server = SinkServer(data_delay=args.delay).start()
+        print(f"Заявок одновременно: {args.requests}, ответ SMTP-сервера: {args.delay:g} с")
+        print(f"{'транспорт':<10} {'одна, с':>8} {'все, с':>8} {'макс. задержка цикла, мс':>25}")
+        try:
+            for mode in ("blocking", "transport"):
+                pool = bot.SmtpConnectionPool("127.0.0.1", server.port, None, None, size=args.requests, starttls=False)
+                if mode == "blocking":
+                    transport = BlockingTransport(pool)
+                else:
+                    transport = bot.SmtpTransport(pool, max_workers=args.requests)
+                single, total, lag = run(bot, transport, args.requests)
+                print(f"{mode:<10} {single:>8.2f} {total:>8.2f} {lag * 1000:>25.1f}")
+                if mode == "transport":
+                    transport.shutdown()
+                else:
+                    pool.close_all()
+        finally:
+            server.stop()
+            bot.excel_renderer.shutdown()
+        expected = 2 * (args.requests + 2)
+        if len(server.received) != expected:
+            raise SystemExit(f"Сервер принял {len(server.received)} писем вместо {expected}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Бенчмарк памяти черновиков: сколько занимают --drafts заявок по --positions позиций.
+
+Сравниваются прежние вложенные словари (дата поставки строкой, каждое значение
+из справочника - отдельная строка, пришедшая в своём обновлении) и слотовые
+Draft/Position, в которых значения справочников интернируются, а дата хранится
+объектом date. Память считается tracemalloc как прирост при построении черновиков.
+
+    python benchmarks/draft_memory.py --drafts 100 --positions 50
+"""
+
+import gc
+import argparse
+import tempfile
+import tracemalloc
+from datetime import date
+
+from support import import_main
+
+
+def fresh(value):
+    """Новый объект строки с тем же текстом, как строка, разобранная из очередного обновления Telegram."""
+    return "".join(list(value))
+
+
+def position_values(i):
+    return {
+        "name": fresh(f"Кабель ВВГнг 3x{i % 10 + 1},5 мм²"),
+        "unit": fresh("м"),
+        "quantity": float(i + 1),
+        "module": fresh(str(i % 18 + 1)),
+        "delivery_date": date(2025, 7, 1 + i % 28),
+        "link": fresh(f"https://example.com/item?id={i}") if i % 5 == 0 else None,
+    }
+
+
+def build_dicts(main, drafts, positions):
+    """Прежнее представление: user_state[chat_id] - словарь, позиции - словари."""
+    state = {}
+    for chat_id in range(drafts):
+        items = []
+        for i in range(positions):
+            values = position_values(i)
+            item = {key: values[key] for key in ("name", "unit", "quantity", "module")}
+            item["delivery_date"] = values["delivery_date"].strftime("%Y-%m-%d")
+            if values["link"]:
+                item["link"] = values["link"]
+            items.append(item)
+        state[chat_id] = {
+            "user_full_name": fresh("Иван Петров"),
+            "telegram_id_or_username": fresh("@ivan"),
+            "project": fresh("Мотели"),
+            "object": fresh("Каркаролинск"),
+            "positions": items,
+        }
+    return state
+
+
+def build_drafts(main, drafts, positions):
+    """Текущее представление: Draft и Position со __slots__."""
+    return {
+        chat_id: main.Draft(
+            user_full_name=fresh("Иван Петров"),
+            telegram_id_or_username=fresh("@ivan"),
+            project=fresh("Мотели"),
+            object=fresh("Каркаролинск"),
+            positions=[main.Position(**position_values(i)) for i in range(positions)],
+        )
+        for chat_id in range(drafts)
+    }
+
+
+def measure(build, main, drafts, positions):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    state = build(main, drafts, positions)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del state
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drafts", type=int, default=100, help="черновиков")
+    parser.add_argument("--positions", type=int, default=50, help="позиций в каждом черновике")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = import_main(workdir)
+        print(f"Черновиков: {args.drafts} × {args.positions} позиций")
+        print(f"{'представление':<14} {'всего, КиБ':>11} {'на черновик, КиБ':>17} {'на позицию, байт':>17}")
+        for name, build in (("dict", build_dicts), ("slots", build_drafts)):
+            size = measure(build, bot, args.drafts, args.positions)
+            print(f"{name:<14} {size / 1024:>11.0f} {size / 1024 / args.drafts:>17.1f} "
+                  f"{size / args.drafts / args.positions:>17.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Бенчмарк генерации книги заявки: сколько заявок в секунду формирует fill_excel.
+
+Сравниваются три способа получить книгу из template.xlsx:
+
+    copy      прежний: шаблон копируется в каталог вывода, заново разбирается
+              openpyxl, заполняется и сохраняется на диск, затем файл читается
+    openpyxl  ExcelTemplateCache: шаблон разобран один раз, книга пишется в память
+    ooxml     OoxmlTemplate: правка XML листа без объектной модели openpyxl
+
+Каждый способ подставляется в main.excel_template, поэтому заполнение ячеек
+в fill_excel у всех общее. Заявки формируются последовательно в одном потоке.
+
+    python benchmarks/excel_render.py --positions 1 10 100 --seconds 3
+"""
+
+import os
+import shutil
+import argparse
+import tempfile
+import time
+import warnings
+from datetime import date
+
+from openpyxl import load_workbook
+
+from support import import_main
+
+
+class CopyAndLoad:
+    """Прежний fill_excel: копия шаблона на диске, полный разбор и сохранение на каждую заявку."""
+
+    def __init__(self, path, output_dir):
+        self.path = path
+        self.output_dir = output_dir
+
+    def load(self):
+        pass
+
+    def render(self, cells):
+        new_path = os.path.join(self.output_dir, "request.xlsx")
+        shutil.copy(self.path, new_path)
+        wb = load_workbook(new_path)
+        ws = wb.active
+        for (row, column), value in cells.items():
+            ws.cell(row=row, column=column).value = value
+        wb.save(new_path)
+        with open(new_path, "rb") as f:
+            return f.read()
+
+
+def make_positions(main, count):
+    return [
+        main.Position(name=f"Кабель ВВГнг 3x{i % 10 + 1},5", unit="м", quantity=i + 1, module=str(i % 18 + 1),
+                      delivery_date=date(2025, 7, 1 + i % 28), link=f"https://example.com/item?id={i}" if i % 2 else None)
+        for i in range(count)
+    ]
+
+
+def measure(main, positions, seconds):
+    """Формирует заявки подряд не меньше `seconds` секунд и возвращает число заявок в секунду."""
+    main.fill_excel("Мотели", "Каркаролинск", positions, "Иван Петров", "@ivan") # Прогрев: разбор шаблона
+    count = 0
+    started = time.perf_counter()
+    while True:
+        main.fill_excel("Мотели", "Каркаролинск", positions, "Иван Петров", "@ivan")
+        count += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--positions", type=int, nargs="+", default=[1, 10, 100], help="позиций в заявке")
+    parser.add_argument("--seconds", type=float, default=3, help="сколько секунд измерять каждый вариант")
+    args = parser.parse_args()
+    warnings.simplefilter("ignore") # openpyxl предупреждает о расширениях шаблона при каждом разборе
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = import_main(workdir)
+        template = bot.excel_template.path
+        engines = {
+            "copy": CopyAndLoad(template, workdir),
+            "openpyxl": bot.ExcelTemplateCache(template),
+            "ooxml": bot.OoxmlTemplate(template),
+        }
+        print(f"{'позиций':>7} " + " ".join(f"{name + ', заявок/с':>18}" for name in engines) + f" {'ooxml/copy':>11}")
+        for count in args.positions:
+            positions = make_positions(bot, count)
+            rates = {}
+            for name, engine in engines.items():
+                bot.excel_template = engine
+                rates[name] = measure(bot, positions, args.seconds)
+            print(f"{count:>7} " + " ".join(f"{rate:>18.1f}" for rate in rates.values())
+                  + f" {rates['ooxml'] / rates['copy']:>10.1f}×")
+
+
+if __name__ == "__main__":
+    main()
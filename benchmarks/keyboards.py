@@ -0,0 +1,79 @@
+"""
+Микробенчмарк клавиатур меню: время обработчика с общим реестром клавиатур
+и с клавиатурой, которая строится заново на каждый вызов, как было раньше.
+
+В варианте rebuild main.keyboards подменяется объектом, который при каждом
+обращении к атрибуту создаёт новую разметку с теми же кнопками; сами
+обработчики в обоих вариантах одни и те же. Обновления - заглушки.
+
+    python benchmarks/keyboards.py --calls 20000
+"""
+
+import asyncio
+import argparse
+import tempfile
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+
+from support import callback_update, handler_latencies, import_main, message_update, percentile
+
+CHAT_ID = 1
+
+
+class RebuildingKeyboards:
+    """Отдаёт копию клавиатуры реестра, построенную заново при каждом обращении."""
+
+    def __init__(self, registry):
+        self._registry = registry
+
+    def __getattr__(self, name):
+        markup = getattr(self._registry, name)
+        if isinstance(markup, ReplyKeyboardMarkup):
+            return ReplyKeyboardMarkup([[KeyboardButton(b.text) for b in row] for row in markup.keyboard],
+                                       one_time_keyboard=markup.one_time_keyboard, resize_keyboard=markup.resize_keyboard)
+        return InlineKeyboardMarkup([[InlineKeyboardButton(b.text, callback_data=b.callback_data) for b in row]
+                                     for row in markup.inline_keyboard])
+
+
+def cases(main):
+    """(название, обработчик, обновление, подготовка черновика перед вызовом)."""
+    def with_position(draft):
+        draft.positions = [main.Position(name="Болт", unit="шт", quantity=1, module="1")]
+        draft.editing_position_index = 0
+
+    return [
+        ("project_handler", main.project_handler, callback_update(CHAT_ID, "Мотели"), None),
+        ("name_handler", main.name_handler, message_update(CHAT_ID, "Болт М8"), None),
+        ("quantity_handler", main.quantity_handler, message_update(CHAT_ID, "12"), None),
+        ("edit_field(module)", main.edit_field_input_handler, callback_update(CHAT_ID, "edit_field_module"), with_position),
+    ]
+
+
+def measure(main, handler, update, prepare, calls):
+    main.user_state[CHAT_ID] = main.Draft(current=main.Position(name="Болт"))
+    if prepare:
+        prepare(main.user_state[CHAT_ID])
+    latencies = asyncio.run(handler_latencies(handler, [update] * calls))
+    return percentile(latencies, 0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000, help="вызовов каждого обработчика")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = import_main(workdir)
+        registry = bot.keyboards
+        print(f"Медиана времени обработчика, мкс ({args.calls} вызовов)")
+        print(f"{'обработчик':<20} {'rebuild':>8} {'реестр':>8}")
+        for name, handler, update, prepare in cases(bot):
+            bot.keyboards = RebuildingKeyboards(registry)
+            rebuilt = measure(bot, handler, update, prepare, args.calls)
+            bot.keyboards = registry
+            shared = measure(bot, handler, update, prepare, args.calls)
+            print(f"{name:<20} {rebuilt * 1e6:>8.1f} {shared * 1e6:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
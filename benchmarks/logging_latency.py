@@ -0,0 +1,130 @@
+"""
+Бенчмарк логирования: сколько стоит запись лога в горячем пути.
+
+Измеряются fill_excel на --positions позиций (движок OOXML) и quantity_handler,
+который пишет одну строку INFO. Варианты:
+
+    sync            прежний logging.StreamHandler: форматирование и запись в stderr
+                    в вызывающем потоке; уровень DEBUG, чтобы трасса по позициям
+                    писалась, как раньше на INFO
+    deferred+debug  DeferredQueueHandler и BatchLogWriter из setup_logging, та же трасса
+    deferred        DeferredQueueHandler, уровень INFO - настройка бота по умолчанию
+
+stderr процесса - канал, который читает медленный поток (--chunk байт раз в
+--read-delay секунд), как перегруженный сборщик логов. Для каждого варианта
+печатается лучшая из --runs серий по --calls вызовов.
+
+    python benchmarks/logging_latency.py --positions 50 --runs 6
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import warnings
+from datetime import date
+
+from support import handler_latencies, import_main, message_update
+
+CHAT_ID = 1
+
+
+class SlowPipe:
+    """Канал вместо stderr: поток-читатель забирает данные порциями с паузами и считает строки."""
+
+    def __init__(self, chunk, delay):
+        read_fd, write_fd = os.pipe()
+        self.stream = os.fdopen(write_fd, "w", encoding="utf-8")
+        self.lines = 0
+        self._read_fd = read_fd
+        self._chunk = chunk
+        self._delay = delay
+        threading.Thread(target=self._drain, daemon=True).start()
+
+    def _drain(self):
+        while True:
+            data = os.read(self._read_fd, self._chunk)
+            if not data:
+                return
+            self.lines += data.count(b"\n")
+            time.sleep(self._delay)
+
+
+def make_positions(main, count):
+    return [
+        main.Position(name=f"Кабель ВВГнг 3x{i % 10 + 1},5", unit="м", quantity=i + 1, module=str(i % 18 + 1),
+                      delivery_date=date(2025, 7, 1 + i % 28))
+        for i in range(count)
+    ]
+
+
+def fill_series(main, positions, calls):
+    """Среднее время fill_excel в серии, сек."""
+    started = time.perf_counter()
+    for _ in range(calls):
+        main.fill_excel("Мотели", "Каркаролинск", positions, "Иван Петров", "@ivan")
+    return (time.perf_counter() - started) / calls
+
+
+def quantity_series(main, calls):
+    """Среднее время quantity_handler в серии, сек."""
+    main.user_state[CHAT_ID] = main.Draft(current=main.Position(name="Болт"))
+    latencies = asyncio.run(handler_latencies(main.quantity_handler, [message_update(CHAT_ID, "12")] * calls))
+    return sum(latencies) / calls
+
+
+def wait_flushed(main, pipe):
+    """Ждёт, пока поток записи и читатель канала не разберут накопленное, чтобы серии не влияли друг на друга."""
+    while not main.log_writer.queue.empty():
+        time.sleep(0.01)
+    lines = None
+    while lines != pipe.lines:
+        lines = pipe.lines
+        time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--positions", type=int, default=50, help="позиций в заявке для fill_excel")
+    parser.add_argument("--runs", type=int, default=6, help="серий на вариант, печатается лучшая")
+    parser.add_argument("--calls", type=int, default=100, help="вызовов fill_excel в серии (quantity_handler - в 20 раз больше)")
+    parser.add_argument("--chunk", type=int, default=4096, help="байт, которые читатель stderr забирает за раз")
+    parser.add_argument("--read-delay", type=float, default=0.005, help="пауза читателя stderr между порциями, сек")
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    out = sys.stdout
+    pipe = SlowPipe(args.chunk, args.read_delay)
+    sys.stderr = pipe.stream # setup_logging при импорте main.py пишет в sys.stderr
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = import_main(workdir, EXCEL_ENGINE="ooxml")
+        bot.excel_template.load()
+        root = logging.getLogger()
+        deferred = root.handlers[0]
+        sync = logging.StreamHandler(pipe.stream)
+        sync.setFormatter(bot.log_writer.handler.formatter)
+        variants = (("sync", sync, logging.DEBUG), ("deferred+debug", deferred, logging.DEBUG), ("deferred", deferred, logging.INFO))
+
+        positions = make_positions(bot, args.positions)
+        print(f"fill_excel: {args.positions} позиций, лучшая из {args.runs} серий; stderr читается "
+              f"по {args.chunk} байт раз в {args.read_delay * 1000:g} мс", file=out)
+        print(f"{'вариант':<15} {'fill_excel, мс':>15} {'строк на вызов':>15} {'quantity_handler, мкс':>22}", file=out)
+        for name, handler, level in variants:
+            root.handlers[:] = [handler]
+            root.setLevel(level)
+            wait_flushed(bot, pipe)
+            lines = pipe.lines
+            fill_time = min(fill_series(bot, positions, args.calls) for _ in range(args.runs))
+            wait_flushed(bot, pipe)
+            per_call = (pipe.lines - lines) / (args.runs * args.calls)
+            quantity_time = min(quantity_series(bot, args.calls * 20) for _ in range(args.runs))
+            print(f"{name:<15} {fill_time * 1000:>15.2f} {per_call:>15.0f} {quantity_time * 1e6:>22.1f}", file=out)
+        root.handlers[:] = [deferred]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Бенчмарк пиковой памяти при отправке заявки с крупными вложениями.
+
+Сравнивает прежний способ (файлы читаются в память целиком, письмо собирается
+в EmailMessage и отправляется smtplib.send_message) с потоковой отправкой
+iter_mime_message через SmtpConnectionPool.send_stream. Каждый режим запускается
+в отдельном процессе, письма принимает локальный SMTP-сервер, который их отбрасывает.
+
+    python benchmarks/mime_memory.py --files 3 --size-mb 20 --requests 3
+
+Печатает прирост пикового RSS процесса отправки (ru_maxrss после импорта main.py)
+в целом и в пересчёте на одну заявку.
+"""
+
+import os
+import sys
+import argparse
+import resource
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from support import SinkServer, import_main
+
+
+def send_eager(main, port, attachments):
+    """Прежняя отправка: все вложения и письмо целиком в памяти."""
+    import smtplib
+    from email.message import EmailMessage
+
+    msg = EmailMessage()
+    msg["Subject"] = "Заявка на снабжение: Мотели - Каркаролинск"
+    msg["From"] = "bot@example.com"
+    msg["To"] = "supply@example.com"
+    msg.set_content("Во вложении заявка на снабжение.")
+    for filename, mime_type, path in attachments:
+        with open(path, "rb") as f:
+            content = bytearray(f.read())
+        maintype, subtype = mime_type.split("/", 1)
+        msg.add_attachment(bytes(content), maintype=maintype, subtype=subtype, filename=filename)
+    with smtplib.SMTP("127.0.0.1", port) as server:
+        server.send_message(msg)
+
+
+def send_stream(main, pool, attachments):
+    """Текущая отправка: письмо генерируется и передаётся на сервер блоками."""
+    pool.send_stream(
+        "bot@example.com", ["supply@example.com"],
+        lambda: main.iter_mime_message("bot@example.com", "supply@example.com",
+                                       "Заявка на снабжение: Мотели - Каркаролинск",
+                                       "Во вложении заявка на снабжение.", attachments),
+    )
+
+
+def run_child(args):
+    main = import_main(args.workdir)
+    attachments = [
+        (f"Позиция_{i + 1}_чертёж.pdf", "application/pdf", os.path.join(args.workdir, f"file{i}.bin"))
+        for i in range(args.files)
+    ]
+    pool = main.SmtpConnectionPool("127.0.0.1", args.port, None, None, size=args.requests, starttls=False)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with ThreadPoolExecutor(max_workers=args.requests) as executor:
+        if args.child == "eager":
+            futures = [executor.submit(send_eager, main, args.port, attachments) for _ in range(args.requests)]
+        else:
+            futures = [executor.submit(send_stream, main, pool, attachments) for _ in range(args.requests)]
+        for future in futures:
+            future.result()
+    pool.close_all()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print((peak - baseline) / 1024) # ru_maxrss в Linux измеряется в КиБ
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=3, help="вложений в одной заявке")
+    parser.add_argument("--size-mb", type=float, default=20, help="размер одного вложения, МБ")
+    parser.add_argument("--requests", type=int, default=3, help="заявок, отправляемых одновременно")
+    parser.add_argument("--child", choices=("eager", "stream"), help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return run_child(args)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for i in range(args.files):
+            with open(os.path.join(workdir, f"file{i}.bin"), "wb") as f:
+                f.write(os.urandom(int(args.size_mb * 1024 * 1024)))
+        server = SinkServer().start()
+        print(f"Заявок одновременно: {args.requests}, вложений в каждой: {args.files} × {args.size_mb:g} МБ")
+        print(f"{'режим':<8} {'пик RSS, МБ':>12} {'на заявку, МБ':>14}")
+        try:
+            for mode in ("eager", "stream"):
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child", mode,
+                     "--port", str(server.port), "--workdir", workdir,
+                     "--files", str(args.files), "--requests", str(args.requests)],
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                peak = float(output.strip().splitlines()[-1])
+                print(f"{mode:<8} {peak:>12.1f} {peak / args.requests:>14.1f}")
+        finally:
+            server.stop()
+        expected = args.requests * 2
+        if len(server.received) != expected:
+            sys.exit(f"Сервер принял {len(server.received)} писем вместо {expected}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Бенчмарк сохранения состояния диалогов: задержка обработчика и стоимость сброса.
+
+В памяти --drafts незавершённых заявок по --positions позиций. quantity_handler
+вызывается по кругу для разных чатов в трёх вариантах:
+
+    dict     user_state - обычный dict, как до появления хранилища
+    memory   SessionState с MemoryStateStore (STATE_BACKEND=memory)
+    sqlite   SessionState с SqliteStateStore; параллельно каждые --interval секунд
+             работает сброс write_behind, как state_flush_job в боте
+
+Для sqlite отдельно печатается полный сброс всех заявок: сериализация в цикле
+событий (take_changes) и запись в SQLite в фоновом потоке.
+
+    python benchmarks/state_store.py --drafts 1000 --positions 50 --calls 50000
+"""
+
+import os
+import asyncio
+import argparse
+import tempfile
+import time
+from datetime import date
+
+from support import handler_latencies, import_main, message_update, percentile
+
+
+def make_drafts(main, count, positions):
+    return {
+        chat_id: main.Draft(
+            project="Мотели", object="Каркаролинск", user_full_name="Иван Петров", telegram_id_or_username="@ivan",
+            request_id=f"{chat_id:032x}",
+            positions=[
+                main.Position(name=f"Кабель ВВГнг 3x{i % 10 + 1},5", unit="м", quantity=i + 1, module=str(i % 18 + 1),
+                              delivery_date=date(2025, 7, 1 + i % 28))
+                for i in range(positions)
+            ],
+            current=main.Position(name="Болт М8", unit="шт"),
+        )
+        for chat_id in range(count)
+    }
+
+
+async def flush_loop(persistence, interval, stop, stats):
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+        started = time.perf_counter()
+        await persistence.write_behind()
+        stats.append(time.perf_counter() - started)
+
+
+async def run_handlers(main, drafts, calls, persistence=None, interval=None):
+    updates = [message_update(i % len(drafts), str(i % 100 + 1)) for i in range(calls)]
+    stop, flushes = asyncio.Event(), []
+    flusher = asyncio.create_task(flush_loop(persistence, interval, stop, flushes)) if persistence else None
+    latencies = await handler_latencies(main.quantity_handler, updates)
+    stop.set()
+    if flusher:
+        await flusher
+    return latencies, flushes
+
+
+def full_flush(main, sessions, store):
+    """Сброс, когда изменены все заявки: (сериализация в цикле событий, запись в потоке), сек."""
+    for chat_id in list(sessions):
+        sessions[chat_id] # Обращение помечает заявку изменённой
+    started = time.perf_counter()
+    changes, deleted = sessions.take_changes()
+    serialized = time.perf_counter() - started
+    started = time.perf_counter()
+    store.write(changes, deleted, {})
+    return serialized, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drafts", type=int, default=1000, help="незавершённых заявок в памяти")
+    parser.add_argument("--positions", type=int, default=50, help="позиций в каждой заявке")
+    parser.add_argument("--calls", type=int, default=50000, help="вызовов обработчика в каждом варианте")
+    parser.add_argument("--interval", type=float, default=0.1, help="период сброса в варианте sqlite, сек")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bot = import_main(workdir)
+        print(f"Заявок: {args.drafts} × {args.positions} позиций, вызовов quantity_handler: {args.calls}")
+        print(f"{'вариант':<8} {'p50, мкс':>9} {'p99, мкс':>9} {'макс, мкс':>10} {'сбросов':>8} {'сброс в среднем, мс':>20}")
+        for mode in ("dict", "memory", "sqlite"):
+            drafts = make_drafts(bot, args.drafts, args.positions)
+            store, persistence = None, None
+            if mode == "dict":
+                sessions = dict(drafts)
+            else:
+                store = bot.SqliteStateStore(os.path.join(workdir, "state.db")) if mode == "sqlite" else bot.MemoryStateStore()
+                sessions = bot.SessionState()
+                sessions.update(drafts) # Без отметок об изменении: заявки уже сохранены
+                if mode == "sqlite":
+                    persistence = bot.DialogPersistence(store, sessions)
+            bot.user_state = sessions
+            latencies, flushes = asyncio.run(run_handlers(bot, drafts, args.calls, persistence, args.interval))
+            flush_mean = f"{sum(flushes) / len(flushes) * 1000:.2f}" if flushes else "-"
+            print(f"{mode:<8} {percentile(latencies, 0.5) * 1e6:>9.1f} {percentile(latencies, 0.99) * 1e6:>9.1f} "
+                  f"{max(latencies) * 1e6:>10.1f} {len(flushes):>8} {flush_mean:>20}")
+            if mode == "sqlite":
+                serialized, written = full_flush(bot, sessions, store)
+                print(f"Полный сброс {args.drafts} заявок: сериализация {serialized * 1000:.1f} мс в цикле событий, "
+                      f"запись {written * 1000:.1f} мс в фоновом потоке")
+            if store:
+                store.close()
+
+
+if __name__ == "__main__":
+    main()
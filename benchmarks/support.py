@@ -0,0 +1,188 @@
+"""
+Общие части бенчмарков: импорт main.py с файлами состояния во временном каталоге,
+заглушки обновлений Telegram для вызова обработчиков напрямую и локальный
+SMTP-сервер, который принимает письма и отбрасывает их содержимое.
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import threading
+import socketserver
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_main(workdir, **env):
+    """
+    Импортирует main.py так, чтобы его файлы состояния создавались во временном каталоге.
+    Дополнительные переменные окружения (например, EXCEL_ENGINE) задаются через env.
+    """
+    os.environ.update({
+        "STATE_BACKEND": "memory",
+        "OUTBOX_PATH": os.path.join(workdir, "outbox.db"),
+        "HISTORY_DB_PATH": os.path.join(workdir, "history.db"),
+        "ATTACHMENT_SPOOL_DIR": os.path.join(workdir, "spool"),
+        "ARCHIVE_DIR": os.path.join(workdir, "out"),
+        "EXCEL_ARCHIVE": "0",
+        "EXCEL_PROCESSES": "0",
+        "LOG_LEVEL": "WARNING",
+        **env,
+    })
+    os.environ.setdefault("SMTP_PORT", "25") # Без .env модуль не импортируется
+    sys.path.insert(0, ROOT)
+    import main
+    # Путь к шаблону в main.py относительный; бенчмарки запускаются из любого каталога
+    main.excel_template.path = os.path.join(ROOT, main.TEMPLATE_PATH)
+    return main
+
+
+async def _network_call(*args, **kwargs):
+    await asyncio.sleep(0) # Запрос к Bot API отдаёт управление циклу событий
+
+
+def message_update(chat_id, text):
+    """Заглушка Update с текстовым сообщением: reply_text ничего не отправляет."""
+    chat = SimpleNamespace(id=chat_id)
+    message = SimpleNamespace(text=text, chat=chat, reply_text=_network_call)
+    return SimpleNamespace(effective_chat=chat, message=message, callback_query=None)
+
+
+def callback_update(chat_id, data):
+    """Заглушка Update с нажатием inline-кнопки."""
+    chat = SimpleNamespace(id=chat_id)
+    message = SimpleNamespace(chat=chat, reply_text=_network_call)
+    query = SimpleNamespace(data=data, message=message, answer=_network_call, edit_message_text=_network_call)
+    return SimpleNamespace(effective_chat=chat, message=None, callback_query=query)
+
+
+async def handler_latencies(handler, updates, context=None):
+    """Вызывает обработчик по очереди для каждого обновления и возвращает длительности вызовов, сек."""
+    latencies = []
+    for update in updates:
+        started = time.perf_counter()
+        await handler(update, context)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    """Минимальный SMTP-сервер: принимает любые письма и отбрасывает их содержимое."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def setup(self):
+        super().setup()
+        self.server.opened(self)
+
+    def finish(self):
+        self.server.closed(self)
+        try:
+            super().finish()
+        except OSError:
+            pass # Соединение уже разорвано через drop_connections()
+
+    def handle(self):
+        self.reply("220 sink ready")
+        while True:
+            try:
+                line = self.rfile.readline()
+            except OSError:
+                return
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self.reply("250-sink")
+                self.reply("250 8BITMIME")
+            elif command == b"DATA":
+                self.reply("354 go ahead")
+                size = 0
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+                time.sleep(self.server.data_delay) # Медленный сервер: ответ на письмо задерживается
+                self.server.received.append(size)
+                self.reply("250 accepted")
+            elif command == b"NOOP":
+                self.server.noops += 1
+                self.reply("250 OK")
+            elif command == b"QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class SinkServer(socketserver.ThreadingTCPServer):
+    """
+    SMTP-сервер в фоновом потоке. Считает принятые письма, открытые соединения
+    и наибольшее число одновременных сессий; data_delay задерживает ответ на DATA.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, data_delay=0):
+        super().__init__(("127.0.0.1", 0), SinkHandler)
+        self.data_delay = data_delay
+        self.received = []
+        self.noops = 0
+        self.connections = 0
+        self.max_active = 0
+        self._active = set()
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def active(self):
+        with self._lock:
+            return len(self._active)
+
+    def opened(self, handler):
+        with self._lock:
+            self.connections += 1
+            self._active.add(handler)
+            self.max_active = max(self.max_active, len(self._active))
+
+    def closed(self, handler):
+        with self._lock:
+            self._active.discard(handler)
+
+    def drop_connections(self):
+        """Обрывает все открытые сессии, как сервер, закрывший соединение по таймауту."""
+        with self._lock:
+            handlers = list(self._active)
+        for handler in handlers:
+            try:
+                handler.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def wait_idle(self, timeout=5):
+        """Ждёт, пока сервер не закроет все сессии (например, после QUIT клиента)."""
+        deadline = time.monotonic() + timeout
+        while self.active and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.active
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,208 @@
+"""
+Нагрузочный тест получения обновлений: long polling против вебхука.
+
+Скрипт поднимает поддельный Bot API сервер и сам же присылает обновления:
+в режиме polling они отдаются боту в ответ на getUpdates, в режиме webhook
+отправляются POST-запросом на вебхук бота. Бот (main.py) запускается отдельным
+процессом с BOT_API_BASE_URL, указывающим на поддельный сервер. Одно обновление -
+команда /start из отдельного чата; задержка считается от момента, когда обновление
+предложено боту, до первого ответа sendMessage в этот чат.
+
+    python benchmarks/update_delivery.py --updates 300 --rate 200 --concurrent 16
+
+Поддельный сервер и отправитель работают в одном цикле событий, поэтому
+при насыщении вебхука результат во многом измеряет сам стенд.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import tornado.web
+import tornado.httpclient
+
+from support import ROOT, percentile
+
+SECRET = "benchmark-secret"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_update(update_id, chat_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": "/start",
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+class FakeBotApi:
+    """Состояние поддельного Bot API: очередь для getUpdates и время первого ответа в каждый чат."""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.pending = []
+        self.new_updates = asyncio.Event()
+        self.replies = {} # chat_id -> время первого sendMessage
+        self.all_replied = asyncio.Event()
+        self.ready = asyncio.Event() # Бот запросил getUpdates или установил вебхук
+
+    def offer(self, update):
+        self.pending.append(update)
+        self.new_updates.set()
+
+    async def get_updates(self, offset, timeout):
+        self.ready.set()
+        self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(self.pending)
+
+    def close(self):
+        """Отпускает ожидающие getUpdates, чтобы они завершились до остановки цикла событий."""
+        self.pending = []
+        self.new_updates.set()
+
+    def reply(self, chat_id):
+        self.replies.setdefault(chat_id, time.perf_counter())
+        if len(self.replies) >= self.expected:
+            self.all_replied.set()
+
+
+class BotApiHandler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    def arguments(self):
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(self.request.body or b"{}")
+        return {key: values[0].decode() for key, values in self.request.body_arguments.items()}
+
+    async def post(self, method):
+        args = self.arguments()
+        result = True
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            result = await self.api.get_updates(int(args.get("offset") or 0), float(args.get("timeout") or 0))
+        elif method == "setWebhook":
+            self.api.ready.set()
+        elif method == "sendMessage":
+            chat_id = int(args["chat_id"])
+            self.api.reply(chat_id)
+            result = {"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "ok"}
+        self.write({"ok": True, "result": result})
+
+
+async def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise TimeoutError(f"порт {port} не открылся за {timeout} с")
+
+
+def start_bot(mode, api_port, hook_port, workdir, concurrent):
+    env = dict(
+        os.environ,
+        BOT_TOKEN="123:bench", BOT_MODE=mode, BOT_API_BASE_URL=f"http://127.0.0.1:{api_port}/bot",
+        WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(hook_port), WEBHOOK_URL=f"http://127.0.0.1:{hook_port}",
+        WEBHOOK_SECRET_TOKEN=SECRET, CONCURRENT_UPDATES=str(concurrent),
+        # Файлы состояния - во временном каталоге, почта - на локальный адрес, чтобы стенд не трогал настоящий сервер
+        STATE_DB_PATH=os.path.join(workdir, "state.db"), OUTBOX_PATH=os.path.join(workdir, "outbox.db"),
+        HISTORY_DB_PATH=os.path.join(workdir, "history.db"), CLUSTER_DB_PATH=os.path.join(workdir, "cluster.db"),
+        ATTACHMENT_SPOOL_DIR=os.path.join(workdir, "spool"), ARCHIVE_DIR=os.path.join(workdir, "out"),
+        SMTP_SERVER="127.0.0.1", SMTP_PORT="25", EXCEL_PROCESSES="0", LOG_LEVEL="WARNING",
+    )
+    # Рабочий каталог - корень репозитория: там шаблон template.xlsx, который бот загружает при старте
+    with open(os.path.join(workdir, f"bot-{mode}.log"), "w") as log:
+        return subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], cwd=ROOT, env=env,
+                                stdout=subprocess.DEVNULL, stderr=log)
+
+
+async def run(mode, args, workdir):
+    api = FakeBotApi(args.updates)
+    api_port, hook_port = free_port(), free_port()
+    server = tornado.web.Application([(r"/bot[^/]+/(\w+)", BotApiHandler, {"api": api})]).listen(api_port, "127.0.0.1")
+    bot = start_bot(mode, api_port, hook_port, workdir, args.concurrent)
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=100)
+    hook_url = f"http://127.0.0.1:{hook_port}/telegram"
+    try:
+        await asyncio.wait_for(api.ready.wait(), 60)
+        if mode == "webhook":
+            await wait_for_port(hook_port)
+            response = await client.fetch(hook_url, method="POST", body=json.dumps(make_update(0, 1)), raise_error=False,
+                                          headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": "wrong"})
+            if response.code != 403:
+                raise SystemExit(f"Вебхук принял обновление с неверным секретом: HTTP {response.code}")
+
+        offered = {}
+        started = time.perf_counter()
+        requests = []
+        for i in range(args.updates):
+            chat_id = 1000 + i
+            update = make_update(i + 1, chat_id)
+            offered[chat_id] = time.perf_counter()
+            if mode == "webhook":
+                requests.append(asyncio.ensure_future(client.fetch(
+                    hook_url, method="POST", body=json.dumps(update),
+                    headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": SECRET},
+                )))
+            else:
+                api.offer(update)
+            await asyncio.sleep(1 / args.rate)
+        await asyncio.wait_for(api.all_replied.wait(), 120)
+        total = time.perf_counter() - started
+        if requests:
+            await asyncio.gather(*requests)
+    finally:
+        bot.terminate()
+        bot.wait()
+        api.close()
+        await asyncio.sleep(0.01)
+        server.stop()
+    latencies = [api.replies[chat_id] - offered[chat_id] for chat_id in offered]
+    return total, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=100, help="обновлений (по одному /start на чат)")
+    parser.add_argument("--rate", type=float, default=20, help="обновлений в секунду")
+    parser.add_argument("--concurrent", type=int, default=1, help="CONCURRENT_UPDATES бота")
+    parser.add_argument("--modes", nargs="+", choices=("polling", "webhook"), default=["polling", "webhook"])
+    args = parser.parse_args()
+
+    print(f"Обновлений: {args.updates}, {args.rate:g}/с, CONCURRENT_UPDATES={args.concurrent}")
+    print(f"{'режим':<8} {'всего, с':>9} {'p50, мс':>8} {'p95, мс':>8} {'макс, мс':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in args.modes:
+            total, latencies = asyncio.run(run(mode, args, workdir))
+            print(f"{mode:<8} {total:>9.2f} {percentile(latencies, 0.5) * 1000:>8.1f} "
+                  f"{percentile(latencies, 0.95) * 1000:>8.1f} {max(latencies) * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
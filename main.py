@@ -1,23 +1,55 @@
+import io
 import os
+import sys
+import copy
+import json
+import argparse
+import re
+import uuid
+import base64
+import hashlib
+import zipfile
+import posixpath
+from xml.sax.saxutils import escape as xml_escape
+from xml.etree import ElementTree
+import time
+import signal
+import socket
+import sqlite3
+import subprocess
+import queue
+import asyncio
+import random
+import atexit
 import logging
+import logging.handlers
+import threading
+import contextlib
+import contextvars
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import multiprocessing
+from itertools import islice
+from dataclasses import dataclass, field
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-    MessageHandler, ContextTypes, filters, ConversationHandler
+    MessageHandler, ContextTypes, filters, ConversationHandler,
+    BasePersistence, PersistenceInput, BaseUpdateProcessor, BaseHandler
 )
 from dotenv import load_dotenv
 from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter, column_index_from_string
 import smtplib
-from email.message import EmailMessage
-import shutil
+from email.header import Header
+from email.utils import encode_rfc2231, formatdate, make_msgid
 from datetime import datetime, date, timedelta
 import calendar
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 
@@ -31,7 +63,578 @@ EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 SMTP_SERVER = os.getenv("SMTP_SERVER")
 SMTP_PORT = int(os.getenv("SMTP_PORT"))
 EMAIL_RECEIVER = os.getenv("EMAIL_RECEIVER")
+BOT_MODE = os.getenv("BOT_MODE", "polling") # Способ получения обновлений: "polling" или "webhook"
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL") # Адрес собственного Bot API сервера, например http://localhost:8081/bot
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0") # Интерфейс локального HTTP-сервера вебхука
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443")) # Порт локального HTTP-сервера вебхука
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # Публичный адрес, на который Telegram шлёт обновления (без пути)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram") # Путь вебхука на локальном сервере
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN") # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")) # Сколько соединений Telegram может держать одновременно
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "8")) # Сколько обновлений разных чатов обрабатывать одновременно
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1")) # Сколько процессов-воркеров запускать; больше 1 — кластерный режим
+WORKER_INDEX = int(os.environ["WORKER_INDEX"]) if os.getenv("WORKER_INDEX") else None # Номер воркера, задаётся супервизором
+CLUSTER_DB_PATH = os.getenv("CLUSTER_DB_PATH", "cluster.db") # SQLite-файл общей шины воркеров
+CLUSTER_LEASE_TTL = float(os.getenv("CLUSTER_LEASE_TTL", "30")) # Срок аренды лидера, сек
+CLUSTER_POLL_TIMEOUT = int(os.getenv("CLUSTER_POLL_TIMEOUT", "10")) # Таймаут long polling у лидера, сек (меньше срока аренды)
+CLUSTER_INBOX_POLL = float(os.getenv("CLUSTER_INBOX_POLL", "0.05")) # Период проверки входящих обновлений воркером, сек
 TEMPLATE_PATH = "template.xlsx" # Убедитесь, что template.xlsx существует в той же директории
+SMTP_WORKERS = int(os.getenv("SMTP_WORKERS", "4")) # Количество потоков для параллельной отправки писем
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", str(SMTP_WORKERS))) # Максимум одновременно открытых SMTP-сессий
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT", "240")) # Через сколько секунд простоя закрывать сессию
+SMTP_KEEPALIVE_INTERVAL = float(os.getenv("SMTP_KEEPALIVE_INTERVAL", "60")) # Период отправки NOOP простаивающим сессиям
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30")) # Таймаут сетевых операций SMTP
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") == "1" # Отключается для локального тестового SMTP-сервера
+ATTACHMENT_DOWNLOAD_CONCURRENCY = int(os.getenv("ATTACHMENT_DOWNLOAD_CONCURRENCY", "5")) # Одновременных загрузок файлов позиций
+ATTACHMENT_DOWNLOAD_TIMEOUT = float(os.getenv("ATTACHMENT_DOWNLOAD_TIMEOUT", "60")) # Таймаут загрузки одного файла, сек
+ATTACHMENT_SPOOL_DIR = os.getenv("ATTACHMENT_SPOOL_DIR", "spool") # Каталог для заранее скачанных файлов позиций
+SMTP_CHUNK_SIZE = 64 * 1024 # Размер блока при потоковой передаче письма на SMTP-сервер
+MIME_READ_BLOCK = 57 * 1024 # Кратно 57 байтам, чтобы строки base64 не разрывались между блоками
+MIME_PARAM_CHUNK = 60 # Длина одного сегмента RFC 2231 для имени вложения (строка письма не длиннее 998 символов)
+EXCEL_PROCESSES = int(os.getenv("EXCEL_PROCESSES", "2")) # Процессов для генерации Excel (0 - без пула процессов)
+EXCEL_ENGINE = os.getenv("EXCEL_ENGINE", "openpyxl") # "openpyxl" или "ooxml" (прямая правка XML листа)
+EXCEL_ARCHIVE = os.getenv("EXCEL_ARCHIVE", "1") == "1" # Сохранять ли копию каждой заявки в архив
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "out") # Корень архива заявок
+ARCHIVE_INDEX_PATH = os.getenv("ARCHIVE_INDEX_PATH", os.path.join(ARCHIVE_DIR, "index.db")) # SQLite-индекс архива
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "0")) # Срок хранения книг, дней; 0 — хранить всегда
+ARCHIVE_COMPACT_AFTER_DAYS = int(os.getenv("ARCHIVE_COMPACT_AFTER_DAYS", "0")) # Через сколько дней пережимать книги; 0 — не пережимать
+ARCHIVE_COMPACT_LEVEL = int(os.getenv("ARCHIVE_COMPACT_LEVEL", "9")) # Уровень deflate при пережатии (1-9)
+ARCHIVE_MAINTENANCE_INTERVAL = float(os.getenv("ARCHIVE_MAINTENANCE_INTERVAL", "86400")) # Период обслуживания архива, сек
+XLSX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite") # Хранилище незавершённых заявок: "sqlite" или "memory"
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.db") # SQLite-файл состояния диалогов
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "5")) # Период сброса изменений в хранилище, сек
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", str(6 * 3600))) # Через сколько секунд бездействия черновик удаляется
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "1000")) # Максимум черновиков в памяти, лишние вытесняются по LRU
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60")) # Период проверки черновиков, сек
+CALENDAR_LOCALE = os.getenv("CALENDAR_LOCALE", "en") # Язык названий месяцев в календаре: "en" (системный) или "ru"
+CALENDAR_CACHE_SIZE = int(os.getenv("CALENDAR_CACHE_SIZE", "64")) # Сколько клавиатур-календарей держать в кэше
+CALENDAR_PREWARM_MONTHS = int(os.getenv("CALENDAR_PREWARM_MONTHS", "3")) # Сколько месяцев вперёд строить при старте
+CALENDAR_BLOCK_PAST = os.getenv("CALENDAR_BLOCK_PAST", "0") == "1" # Запрещать ли выбор прошедших дат
+CALENDAR_MARK_WEEKENDS = os.getenv("CALENDAR_MARK_WEEKENDS", "0") == "1" # Выделять ли выходные дни
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO") # Уровень логирования
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text") # Формат записей: "text" или "json"
+LOG_TRACE_SAMPLE_RATE = float(os.getenv("LOG_TRACE_SAMPLE_RATE", "1")) # Доля заявок с DEBUG-трассой по позициям и телом письма
+LOG_BATCH_INTERVAL = float(os.getenv("LOG_BATCH_INTERVAL", "0.05")) # Сколько секунд копить записи перед записью пачкой
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # Порт HTTP-эндпоинта /metrics; 0 — метрики выключены
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1") # Интерфейс HTTP-эндпоинта метрик
+TRACE_FILE = os.getenv("TRACE_FILE") # JSONL-файл для span'ов заявок; не задан — не пишется
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT") # OTLP/HTTP JSON коллектор, например http://127.0.0.1:4318/v1/traces
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "supply-request-bot") # service.name в экспортируемых span'ах
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "1")) # Сколько секунд копить span'ы перед выгрузкой
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "outbox.db") # SQLite-файл очереди исходящих заявок
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "10")) # Период проверки очереди, сек
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8")) # После стольких неудач заявка уходит в dead-letter
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "30")) # Начальная задержка повтора, сек
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "3600")) # Максимальная задержка повтора, сек
+OUTBOX_CLAIM_TIMEOUT = float(os.getenv("OUTBOX_CLAIM_TIMEOUT", "600")) # Через сколько секунд зависшая отправка возвращается в очередь
+SUMMARY_PAGE_SIZE = int(os.getenv("SUMMARY_PAGE_SIZE", "10")) # Позиций на одной странице сводки и выбора позиции
+SUMMARY_LINE_MAX = int(os.getenv("SUMMARY_LINE_MAX", "300")) # Длиннее этого строка позиции в сводке обрезается (в письме - нет)
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "history.db") # SQLite-файл истории отправленных заявок
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "5")) # Заявок на одной странице /history
+HISTORY_POSITIONS_SHOWN = int(os.getenv("HISTORY_POSITIONS_SHOWN", "10")) # Сколько позиций заявки показывать в /history
+REPORT_DEFAULT_DAYS = int(os.getenv("REPORT_DEFAULT_DAYS", "30")) # Период /report без параметров, дней
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "200")) # Сколько разобранных книг сохранять одной транзакцией при импорте
+HISTORY_ADMINS = {u.strip().lstrip("@") for u in os.getenv("HISTORY_ADMINS", "").split(",") if u.strip()} # ID или username тех, кому /history показывает заявки всех чатов
+
+# --- ЛОГИРОВАНИЕ ---
+
+class JsonLogFormatter(logging.Formatter):
+    """Форматирует запись лога одной JSON-строкой."""
+
+    def format(self, record):
+        data = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладёт запись в очередь, подставив аргументы в текст сразу в момент вызова:
+    объекты вроде Position или Draft к моменту записи могут уже измениться.
+    Остальное форматирование (время, JSON, шаблон строки) выполняется в потоке записи.
+    """
+
+    _exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # Как в QueueHandler.prepare: копия записи без args и exc_info, только с готовым текстом
+        message = record.getMessage()
+        record = copy.copy(record)
+        record.msg, record.args = message, None
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class BatchLogWriter:
+    """
+    Поток, который забирает записи из очереди пачками (раз в LOG_BATCH_INTERVAL),
+    форматирует их и пишет в поток вывода одной операцией записи.
+    """
+
+    _STOP = object()
+
+    def __init__(self, log_queue, handler, interval=LOG_BATCH_INTERVAL):
+        self.queue = log_queue
+        self.handler = handler
+        self.interval = interval
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Дописывает накопленные записи и останавливает поток."""
+        if self._thread is not None:
+            self.queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.handler.format(record))
+            except Exception:
+                self.handler.handleError(record)
+        if lines:
+            with self.handler.lock:
+                self.handler.stream.write("\n".join(lines) + "\n")
+                self.handler.flush()
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            time.sleep(self.interval)
+            try:
+                while True:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = self._STOP in records
+            self._write([r for r in records if r is not self._STOP])
+            if stop:
+                return
+
+def setup_logging():
+    """
+    Настраивает асинхронное логирование: обработчики только кладут запись в очередь,
+    а форматирование и вывод выполняет поток BatchLogWriter, не блокируя цикл событий.
+    На время fork поток останавливается, а в дочернем процессе записи пишутся напрямую,
+    так как потока записи там нет.
+    """
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_queue = queue.SimpleQueue()
+    writer = BatchLogWriter(log_queue, handler)
+
+    root = logging.getLogger()
+    root.handlers[:] = [DeferredQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    writer.start()
+
+    def after_fork_in_child():
+        writer._thread = None
+        root.handlers[:] = [handler]
+
+    os.register_at_fork(before=writer.stop, after_in_parent=writer.start, after_in_child=after_fork_in_child)
+    atexit.register(writer.stop)
+    return writer
+
+def trace_enabled():
+    """Писать ли для текущей заявки подробную DEBUG-трассу (с учётом уровня и доли выборки)."""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_TRACE_SAMPLE_RATE
+
+log_writer = setup_logging()
+
+# --- МЕТРИКИ ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 5e6, 1e7, 2e7, 5e7)
+
+class Metrics:
+    """
+    Счётчики и гистограммы в формате Prometheus, отдаваемые по HTTP на /metrics.
+    Когда метрики выключены (METRICS_PORT=0), все методы сразу возвращаются,
+    а timer() отдаёт один и тот же пустой контекстный менеджер.
+    """
+
+    def __init__(self, enabled=METRICS_PORT > 0):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {} # (имя, метки) -> значение
+        self._histograms = {} # (имя, метки) -> [границы, счётчики по корзинам, сумма, количество]
+        self._gauges = {} # имя -> функция без аргументов
+        self._server = None
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[1][i] += 1
+                    break
+            histogram[2] += value
+            histogram[3] += 1
+
+    def gauge(self, name, func):
+        """Регистрирует показатель, значение которого вычисляется при каждом запросе /metrics."""
+        self._gauges[name] = func
+
+    def timer(self, name, **labels):
+        """Контекстный менеджер, записывающий длительность блока в гистограмму name."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, name, labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{Metrics._escape(v)}"' for k, v in pairs) + "}"
+
+    @staticmethod
+    def _escape(value):
+        """Экранирует в значении метки обратную косую черту, кавычку и перевод строки, как требует формат Prometheus."""
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def render(self):
+        """Возвращает все метрики в текстовом формате Prometheus."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (h[0], list(h[1]), h[2], h[3])) for key, h in self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, func in sorted(self._gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host=METRICS_LISTEN, port=METRICS_PORT):
+        """Запускает HTTP-эндпоинт /metrics в фоновом потоке."""
+        if not self.enabled or self._server is not None:
+            return
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("Metrics endpoint listening on http://%s:%s/metrics", host, port)
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+class _StageTimer:
+    __slots__ = ("metrics", "name", "labels", "started")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+_NULL_TIMER = contextlib.nullcontext()
+metrics = Metrics()
+
+# --- ТРАССИРОВКА ---
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    """Участок обработки заявки: имя, атрибуты, время начала и окончания, ошибка."""
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "attributes", "start_ns", "end_ns", "error", "_token")
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.tracer.export(self)
+
+    @staticmethod
+    def _value(value):
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def to_otlp(self):
+        """Представление span'а в формате OTLP/JSON."""
+        data = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": self._value(v)} for k, v in self.attributes.items() if v is not None],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            data["parentSpanId"] = self.parent_id
+        return data
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class Tracer:
+    """
+    Трассировка заявок: идентификатор трассы равен request_id черновика, span'ы
+    вкладываются друг в друга через contextvars. Завершённые span'ы выгружает
+    фоновый поток пачками — в JSONL-файл и/или POST-запросом в OTLP/HTTP коллектор.
+    Когда ни TRACE_FILE, ни TRACE_OTLP_ENDPOINT не заданы, span() отдаёт пустой span.
+    """
+
+    _STOP = object()
+
+    def __init__(self, path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT, interval=TRACE_EXPORT_INTERVAL):
+        self.path = path
+        self.endpoint = endpoint
+        self.interval = interval
+        self.enabled = bool(path or endpoint)
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def span(self, name, trace_id=None, **attributes):
+        """
+        Создаёт span, вложенный в текущий. trace_id задаёт трассу явно (например, request_id
+        заявки из очереди); если он не совпадает с трассой текущего span'а, начинается новый корень.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        parent = _current_span.get()
+        if trace_id is None:
+            trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        parent_id = parent.span_id if parent is not None and parent.trace_id == trace_id else None
+        return Span(self, name, trace_id, parent_id, attributes)
+
+    def adopt(self, trace_id):
+        """Переносит текущий (корневой) span в трассу trace_id — для только что созданной заявки."""
+        span = _current_span.get()
+        if span is not None:
+            span.trace_id = trace_id
+
+    def export(self, span):
+        self._queue.put(span)
+
+    def start(self):
+        if self.enabled and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Выгружает накопленные span'ы и останавливает поток."""
+        if self._thread is not None:
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _write(self, spans):
+        if self.path:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(s.to_otlp(), ensure_ascii=False) + "\n" for s in spans)
+            except OSError as e:
+                logger.warning("Не удалось записать span'ы в %s: %s", self.path, e)
+        if self.endpoint:
+            resource = {"attributes": [
+                {"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}},
+                {"key": "service.instance.id", "value": {"stringValue": f"{socket.gethostname()}:{os.getpid()}"}},
+            ]}
+            body = json.dumps({"resourceSpans": [{
+                "resource": resource,
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": [s.to_otlp() for s in spans]}],
+            }]}, ensure_ascii=False).encode("utf-8")
+            request = urllib.request.Request(self.endpoint, data=body, headers={"Content-Type": "application/json"})
+            try:
+                urllib.request.urlopen(request, timeout=5).close()
+            except OSError as e:
+                logger.warning("Не удалось выгрузить %s span'ов в %s: %s", len(spans), self.endpoint, e)
+
+    def _run(self):
+        while True:
+            spans = [self._queue.get()]
+            time.sleep(self.interval)
+            try:
+                while True:
+                    spans.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = self._STOP in spans
+            spans = [s for s in spans if s is not self._STOP]
+            if spans:
+                self._write(spans)
+            if stop:
+                return
+
+tracer = Tracer()
+atexit.register(tracer.stop)
+
+class _Stage:
+    __slots__ = ("timer", "span")
+
+    def __init__(self, name, attributes):
+        self.timer = metrics.timer("bot_stage_seconds", stage=name)
+        self.span = tracer.span(name, **attributes)
+
+    def __enter__(self):
+        self.timer.__enter__()
+        return self.span.__enter__()
+
+    def __exit__(self, *exc_info):
+        self.span.__exit__(*exc_info)
+        self.timer.__exit__(*exc_info)
+
+def stage(name, **attributes):
+    """Этап обработки: длительность в bot_stage_seconds{stage=name} и span с тем же именем."""
+    if not metrics.enabled and not tracer.enabled:
+        return _NULL_SPAN
+    return _Stage(name, attributes)
+
+class TracingHTTPXRequest(HTTPXRequest):
+    """Запросы к Bot API, выполняемые внутри трассы, записываются span'ами telegram.<метод>."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        if _current_span.get() is None:
+            return await super().do_request(url, method, *args, **kwargs)
+        # Токен бота входит в URL, поэтому в span попадает только имя метода
+        api_method = "download_file" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        with tracer.span(f"telegram.{api_method}", http_method=method) as span:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            span.set(status_code=code, response_bytes=len(payload))
+            return code, payload
+
+def instrument_handler(callback):
+    """
+    Оборачивает обработчик: время выполнения, переходы ConversationHandler по состояниям
+    и корневой span в трассе заявки чата.
+    """
+    if not metrics.enabled and not tracer.enabled:
+        return callback
+    name = callback.__name__
+
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        outcome = "error"
+        chat = update.effective_chat if isinstance(update, Update) else None
+        draft = dict.get(user_state, chat.id) if chat else None
+        with tracer.span(name, trace_id=draft.request_id if draft else None, chat_id=chat.id if chat else None) as span:
+            try:
+                result = await callback(update, context)
+                outcome = "END" if result == ConversationHandler.END else STATE_NAMES.get(result, str(result))
+                return result
+            finally:
+                span.set(state=outcome)
+                metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+                metrics.inc("bot_state_transitions_total", handler=name, state=outcome)
+
+    wrapper.__name__ = name
+    return wrapper
+
+def instrument_handlers(handlers):
+    """
+    Оборачивает обратные вызовы обработчиков через instrument_handler. Один и тот же
+    экземпляр может стоять в нескольких состояниях диалога (как MissingDraftHandler) -
+    он оборачивается один раз, иначе каждое обновление учитывалось бы многократно.
+    """
+    for handler in {id(handler): handler for handler in handlers}.values():
+        handler.callback = instrument_handler(handler.callback)
 
 # Состояния для ConversationHandler
 # Обновлено количество состояний до 19
@@ -41,72 +644,1335 @@ CONFIRM_ADD_MORE, \
 EDIT_MENU, SELECT_POSITION, EDIT_FIELD_SELECTION, EDIT_FIELD_INPUT, \
 FINAL_CONFIRMATION, GLOBAL_DELIVERY_DATE_SELECTION, \
 EDITING_UNIT, EDITING_MODULE = range(19)
+STATE_NAMES = dict(enumerate([
+    "PROJECT", "OBJECT", "NAME", "UNIT", "QUANTITY", "MODULE", "POSITION_DELIVERY_DATE",
+    "ATTACHMENT_CHOICE", "FILE_INPUT", "LINK_INPUT",
+    "CONFIRM_ADD_MORE",
+    "EDIT_MENU", "SELECT_POSITION", "EDIT_FIELD_SELECTION", "EDIT_FIELD_INPUT",
+    "FINAL_CONFIRMATION", "GLOBAL_DELIVERY_DATE_SELECTION",
+    "EDITING_UNIT", "EDITING_MODULE",
+]))
+
+# --- МОДЕЛЬ ДАННЫХ ЗАЯВКИ ---
+
+class _InternedFields:
+    """
+    Примесь для классов со __slots__: строковые значения полей из справочников
+    (проекты, объекты, единицы измерения, модули) интернируются при присваивании,
+    поэтому все черновики ссылаются на один и тот же объект строки.
+    """
+
+    __slots__ = ()
+    _interned = frozenset()
+
+    def __setattr__(self, name, value):
+        if name in self._interned and isinstance(value, str):
+            value = sys.intern(value)
+        object.__setattr__(self, name, value)
+
+@dataclass(slots=True)
+class FileData:
+    """Файл Telegram, прикреплённый к позиции."""
+    file_id: str
+    file_name: str
+    mime_type: str
+    file_unique_id: str = None
+
+    def to_dict(self):
+        return {
+            "file_id": self.file_id,
+            "file_name": self.file_name,
+            "mime_type": self.mime_type,
+            "file_unique_id": self.file_unique_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["file_id"], data.get("file_name"), data.get("mime_type"), data.get("file_unique_id"))
+
+@dataclass(slots=True)
+class Position(_InternedFields):
+    """Позиция заявки. Дата поставки хранится как `date`, а не строка."""
+    _interned = frozenset({"unit", "module"})
+
+    name: str = None
+    unit: str = None
+    quantity: float = None
+    module: str = None
+    delivery_date: date = None
+    link: str = None
+    file_data: FileData = None
+    _summary: str = field(default=None, init=False, repr=False, compare=False) # Кэш строки для сводок
+
+    def __setattr__(self, name, value):
+        _InternedFields.__setattr__(self, name, value)
+        if name != "_summary":
+            # Любое изменение позиции делает сохранённую строку сводки устаревшей
+            object.__setattr__(self, "_summary", None)
+
+    def summary(self):
+        """Текст позиции без номера; строится один раз и живёт до следующего изменения полей."""
+        if self._summary is None:
+            line = (
+                f"Модуль: {self.module or 'N/A'} | Наименование: {self.name or 'N/A'} | "
+                f"Ед.изм.: {self.unit or 'N/A'} | Количество: {self.quantity if self.quantity is not None else 'N/A'} | "
+                f"Дата поставки: {self.delivery_date or 'N/A'}"
+            )
+            if self.link:
+                line += f" | Ссылка: {self.link}"
+            if self.file_data:
+                line += f" | Файл: {self.file_data.file_name or 'N/A'}"
+            self._summary = line
+        return self._summary
+
+    def to_dict(self):
+        data = {"name": self.name, "unit": self.unit, "quantity": self.quantity, "module": self.module}
+        if self.delivery_date:
+            data["delivery_date"] = self.delivery_date.isoformat()
+        if self.link:
+            data["link"] = self.link
+        if self.file_data:
+            data["file_data"] = self.file_data.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            name=data.get("name"),
+            unit=data.get("unit"),
+            quantity=data.get("quantity"),
+            module=data.get("module"),
+            delivery_date=date.fromisoformat(data["delivery_date"]) if data.get("delivery_date") else None,
+            link=data.get("link"),
+            file_data=FileData.from_dict(data["file_data"]) if data.get("file_data") else None,
+        )
+
+@dataclass(slots=True)
+class Draft(_InternedFields):
+    """Незавершённая заявка одного чата вместе со служебным состоянием редактирования."""
+    _interned = frozenset({"project", "object"})
+
+    user_full_name: str = "Неизвестно"
+    telegram_id_or_username: str = "Неизвестно"
+    project: str = None
+    object: str = None
+    positions: list = field(default_factory=list)
+    current: Position = None # Позиция, которая заполняется прямо сейчас
+    action_type: str = None
+    editing_position_index: int = None
+    editing_field: str = None
+    request_id: str = None # Идентификатор заявки, он же идентификатор трассы
+
+    def to_dict(self):
+        return {
+            "user_full_name": self.user_full_name,
+            "telegram_id_or_username": self.telegram_id_or_username,
+            "project": self.project,
+            "object": self.object,
+            "positions": [p.to_dict() for p in self.positions],
+            "current": self.current.to_dict() if self.current else None,
+            "action_type": self.action_type,
+            "editing_position_index": self.editing_position_index,
+            "editing_field": self.editing_field,
+            "request_id": self.request_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            user_full_name=data.get("user_full_name", "Неизвестно"),
+            telegram_id_or_username=data.get("telegram_id_or_username", "Неизвестно"),
+            project=data.get("project"),
+            object=data.get("object"),
+            positions=[Position.from_dict(p) for p in data.get("positions", [])],
+            current=Position.from_dict(data["current"]) if data.get("current") else None,
+            action_type=data.get("action_type"),
+            editing_position_index=data.get("editing_position_index"),
+            editing_field=data.get("editing_field"),
+            request_id=data.get("request_id"),
+        )
+
+def format_position_line(index, p):
+    """Формирует строку позиции для сводок и текста письма."""
+    return f"{index+1}. {p.summary()}"
+
+# --- ХРАНИЛИЩЕ СОСТОЯНИЯ ДИАЛОГОВ ---
+
+class MemoryStateStore:
+    """
+    Хранилище состояния диалогов без записи на диск: после перезапуска
+    все незавершённые заявки теряются. Задаёт интерфейс для других хранилищ.
+    """
+
+    def load_sessions(self):
+        """Возвращает сохранённые заявки {chat_id: (данные, время последнего сохранения)}."""
+        return {}
+
+    def load_conversations(self, name):
+        """Возвращает сохранённые состояния ConversationHandler {ключ: состояние}."""
+        return {}
+
+    def write(self, sessions, deleted, conversations):
+        """
+        Записывает пакет изменений: `sessions` - {chat_id: JSON данных заявки},
+        `deleted` - удалённые chat_id, `conversations` - {(имя, ключ): состояние или None}.
+        """
+
+    def close(self):
+        pass
+
+class SqliteStateStore(MemoryStateStore):
+    """
+    Хранилище состояния диалогов в SQLite. Изменения приходят пакетами
+    (write-behind), поэтому на каждое нажатие кнопки не приходится отдельный fsync.
+    """
+
+    def __init__(self, path=STATE_DB_PATH):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, state INTEGER NOT NULL, "
+                "PRIMARY KEY (name, key))"
+            )
+        self._lock = threading.Lock()
+
+    def load_sessions(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT chat_id, data, updated_at FROM sessions").fetchall()
+        return {chat_id: (json.loads(data), updated_at) for chat_id, data, updated_at in rows}
+
+    def load_conversations(self, name):
+        with self._lock:
+            rows = self._conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    def write(self, sessions, deleted, conversations):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sessions (chat_id, data, updated_at) VALUES (?, ?, ?)",
+                [(chat_id, data, now) for chat_id, data in sessions.items()],
+            )
+            self._conn.executemany("DELETE FROM sessions WHERE chat_id = ?", [(chat_id,) for chat_id in deleted])
+            for (name, key), state in conversations.items():
+                if state is None:
+                    self._conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+                else:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                        (name, json.dumps(key), state),
+                    )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class SessionState(dict):
+    """
+    Словарь незавершённых заявок (chat_id -> Draft), отслеживающий изменения.
+    Обработчики меняют вложенные данные напрямую, поэтому любое обращение
+    к заявке помечает её для сохранения при следующем сбросе в хранилище
+    и обновляет время последней активности (порядок LRU для вытеснения).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._dirty = set()
+        self._deleted = set()
+        self._activity = OrderedDict() # chat_id -> время последнего обращения, от старых к новым
+        self.evicted_sessions = 0
+        self.evicted_bytes = 0
+
+    def _touch(self, chat_id, at=None):
+        self._activity[chat_id] = time.time() if at is None else at
+        self._activity.move_to_end(chat_id)
+
+    def __getitem__(self, chat_id):
+        value = super().__getitem__(chat_id)
+        self._dirty.add(chat_id)
+        self._touch(chat_id)
+        return value
+
+    def get(self, chat_id, default=None):
+        return self[chat_id] if chat_id in self else default
+
+    def __setitem__(self, chat_id, value):
+        super().__setitem__(chat_id, value)
+        self._dirty.add(chat_id)
+        self._deleted.discard(chat_id)
+        self._touch(chat_id)
+
+    def __delitem__(self, chat_id):
+        super().__delitem__(chat_id)
+        self._dirty.discard(chat_id)
+        self._deleted.add(chat_id)
+        self._activity.pop(chat_id, None)
+
+    def restore(self, sessions):
+        """
+        Загружает сохранённые заявки {chat_id: (данные, время сохранения)}, не помечая их изменёнными.
+        Временем активности считается время сохранения, чтобы перезапуск не продлевал срок простоя.
+        """
+        now = time.time()
+        for chat_id, (data, updated_at) in sorted(sessions.items(), key=lambda item: item[1][1]):
+            super().__setitem__(chat_id, Draft.from_dict(data))
+            self._touch(chat_id, min(updated_at, now))
+
+    def take_changes(self):
+        """Возвращает снимок изменённых заявок (в JSON) и удалённые chat_id, сбрасывая отметки."""
+        sessions = {
+            chat_id: json.dumps(super(SessionState, self).__getitem__(chat_id).to_dict(), ensure_ascii=False)
+            for chat_id in self._dirty
+        }
+        deleted = self._deleted
+        self._dirty, self._deleted = set(), set()
+        return sessions, deleted
+
+    def idle_sessions(self, ttl):
+        """Возвращает chat_id заявок, к которым не обращались дольше `ttl` секунд."""
+        now = time.time()
+        idle = []
+        for chat_id, last_activity in self._activity.items():
+            if now - last_activity < ttl:
+                break
+            idle.append(chat_id)
+        return idle
+
+    def last_activity(self, chat_id):
+        """Время последнего обращения к заявке или None, если заявки нет."""
+        return self._activity.get(chat_id)
+
+    def lru_overflow(self, max_count):
+        """Возвращает самые давние chat_id сверх допустимого количества заявок."""
+        return list(islice(self._activity, max(len(self) - max_count, 0)))
+
+    def evict(self, chat_id):
+        """Удаляет заявку из памяти и хранилища, учитывая её размер в метриках. Возвращает удалённый черновик."""
+        draft = super().__getitem__(chat_id)
+        del self[chat_id]
+        size = len(json.dumps(draft.to_dict(), ensure_ascii=False).encode("utf-8"))
+        self.evicted_sessions += 1
+        self.evicted_bytes += size
+        metrics.inc("bot_evicted_sessions_total")
+        metrics.inc("bot_evicted_bytes_total", size)
+        return draft
+
+class DialogPersistence(BasePersistence):
+    """
+    Персистентность PTB для ConversationHandler, совмещённая с сохранением user_state.
+    Состояния диалогов и данные заявок записываются в хранилище одним пакетом
+    раз в STATE_FLUSH_INTERVAL секунд и при остановке бота.
+    """
+
+    def __init__(self, store, sessions):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=STATE_FLUSH_INTERVAL,
+        )
+        self.store = store
+        self.sessions = sessions
+        self._conversations = {}
+
+    async def get_conversations(self, name):
+        conversations = await asyncio.to_thread(self.store.load_conversations, name)
+        return {key: state for key, state in conversations.items() if owns_chat(key[0])}
+
+    async def update_conversation(self, name, key, new_state):
+        self._conversations[(name, key)] = new_state
+
+    async def write_behind(self):
+        """Сбрасывает накопленные изменения в хранилище."""
+        sessions, deleted = self.sessions.take_changes()
+        conversations, self._conversations = self._conversations, {}
+        if sessions or deleted or conversations:
+            await asyncio.to_thread(self.store.write, sessions, deleted, conversations)
+
+    async def flush(self):
+        await self.write_behind()
+
+    # Данные пользователей, чатов, бота и callback_data не сохраняются
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+state_store = SqliteStateStore() if STATE_BACKEND == "sqlite" else MemoryStateStore()
 
 # Глобальные переменные для хранения данных пользователя и предварительно определенных списков
-user_state = {}
+user_state = SessionState()
+dialog_persistence = DialogPersistence(state_store, user_state)
 projects = ["Stadler", "Мотели"]
 objects = ["Мерке", "Аральск", "Атырау", "Каркаролинск", "Семипалатинск"]
 modules = [f"{i+1}" for i in range(18)]
 units = ["м2", "м3", "шт", "компл", "л", "кг", "тн"]
 
+# --- КЛАВИАТУРЫ ---
+
+def _rows(buttons, per_row):
+    """Разбивает список кнопок на ряды по per_row штук."""
+    return [buttons[i:i + per_row] for i in range(0, len(buttons), per_row)]
+
+class KeyboardRegistry:
+    """
+    Реестр неизменяемых клавиатур статических меню.
+    Разметка, включая клавиатуры справочников (проекты, объекты, единицы, модули),
+    строится один раз при запуске и разделяется всеми обработчиками. Справочники
+    задаются в коде и во время работы не меняются, поэтому перестраивать их не нужно.
+    """
+
+    def __init__(self):
+        cancel_button = InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")
+        self.create_request = ReplyKeyboardMarkup([[KeyboardButton("Создать заявку")]], one_time_keyboard=False, resize_keyboard=True)
+        self.cancel = InlineKeyboardMarkup([[cancel_button]])
+        self.add_more = InlineKeyboardMarkup([[InlineKeyboardButton("Да", callback_data="yes"), InlineKeyboardButton("Нет", callback_data="no")]])
+        self.attachment_choice = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Прикрепить файл", callback_data="attach_file")],
+            [InlineKeyboardButton("Прикрепить ссылку", callback_data="attach_link")],
+            [InlineKeyboardButton("Продолжить без вложений", callback_data="no_attachment")],
+            [cancel_button],
+        ])
+        # Варианты после прикрепления файла или ссылки: предлагаем недостающее вложение
+        self.after_attachment = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Продолжить без вложений", callback_data="no_attachment")],
+            [cancel_button],
+        ])
+        self.after_file = InlineKeyboardMarkup([[InlineKeyboardButton("Прикрепить ссылку", callback_data="attach_link")]] + list(self.after_attachment.inline_keyboard))
+        self.after_link = InlineKeyboardMarkup([[InlineKeyboardButton("Прикрепить файл", callback_data="attach_file")]] + list(self.after_attachment.inline_keyboard))
+        self.continue_or_cancel = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Продолжить", callback_data="continue_final_confirm")],
+            [cancel_button],
+        ])
+        self.back_or_cancel = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Назад в меню", callback_data="back_to_edit_menu")],
+            [cancel_button],
+        ])
+        self.edit_menu = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Редактировать позицию", callback_data="edit_pos")],
+            [InlineKeyboardButton("Удалить позицию", callback_data="delete_pos")],
+        ] + list(self.continue_or_cancel.inline_keyboard))
+        self.edit_fields = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Наименование", callback_data="edit_field_name")],
+            [InlineKeyboardButton("Ед. изм.", callback_data="edit_field_unit")],
+            [InlineKeyboardButton("Количество", callback_data="edit_field_quantity")],
+            [InlineKeyboardButton("Модуль", callback_data="edit_field_module")],
+            [InlineKeyboardButton("Дата поставки", callback_data="edit_field_delivery_date")],
+            # Кнопки для прикрепления/изменения ссылки и файла к позиции
+            [InlineKeyboardButton("Прикрепить/Изменить файл", callback_data="edit_field_attach_file")],
+            [InlineKeyboardButton("Прикрепить/Изменить ссылку", callback_data="edit_field_attach_link")],
+        ] + list(self.back_or_cancel.inline_keyboard))
+        self.final_confirm = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Да", callback_data="final_yes"), InlineKeyboardButton("Нет", callback_data="final_no")],
+            [cancel_button],
+        ])
+        self._build_catalogs()
+
+    def _build_catalogs(self):
+        """Строит клавиатуры выбора проекта, объекта, единицы измерения и модуля."""
+        cancel_row = (InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog"),)
+        self.projects = InlineKeyboardMarkup([[InlineKeyboardButton(p, callback_data=p)] for p in projects] + [cancel_row])
+        self.objects = InlineKeyboardMarkup([[InlineKeyboardButton(o, callback_data=o)] for o in objects] + [cancel_row])
+        self.units = InlineKeyboardMarkup([[InlineKeyboardButton(u, callback_data=u)] for u in units] + [cancel_row])
+        self.edit_units = InlineKeyboardMarkup([[InlineKeyboardButton(u, callback_data=f"edit_unit_{u}")] for u in units] + [cancel_row])
+        self.modules = InlineKeyboardMarkup(_rows([InlineKeyboardButton(m, callback_data=m) for m in modules], 5) + [cancel_row])
+        self.edit_modules = InlineKeyboardMarkup(_rows([InlineKeyboardButton(m, callback_data=f"edit_module_{m}") for m in modules], 5) + [cancel_row])
+        logger.info("Keyboards built: %s projects, %s objects, %s units, %s modules.", len(projects), len(objects), len(units), len(modules))
+
+keyboards = KeyboardRegistry()
+
+class ExcelTemplateCache:
+    """
+    Кэш разобранного шаблона заявки.
+    Шаблон загружается через openpyxl один раз, после чего каждая заявка
+    записывается в ту же книгу, сохраняется в буфер в памяти, и изменённые
+    ячейки возвращаются к исходному состоянию шаблона.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, path=TEMPLATE_PATH):
+        self.path = path
+        self._wb = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Разбирает шаблон, если это ещё не сделано."""
+        with self._lock:
+            if self._wb is None:
+                self._wb = load_workbook(os.path.abspath(self.path))
+                logger.info("Excel template '%s' loaded into cache.", self.path)
+
+    def render(self, cells):
+        """
+        Возвращает байты XLSX-файла, в котором ячейки шаблона заполнены значениями
+        из `cells` ({(строка, столбец): значение}).
+        """
+        self.load()
+        with self._lock:
+            ws = self._wb.active
+            original = {}
+            current_row = ws._current_row
+            try:
+                for (row, column), value in cells.items():
+                    key = (row, column)
+                    original[key] = ws._cells[key].value if key in ws._cells else self._MISSING
+                    ws.cell(row=row, column=column).value = value
+                buffer = io.BytesIO()
+                self._wb.save(buffer)
+                return buffer.getvalue()
+            finally:
+                # Возвращаем шаблон в исходное состояние для следующей заявки
+                for key, value in original.items():
+                    if value is self._MISSING:
+                        del ws._cells[key]
+                    else:
+                        ws._cells[key].value = value
+                ws._current_row = current_row
+
+class OoxmlTemplate:
+    """
+    Быстрый генератор заявки без объектной модели openpyxl.
+    Шаблон распаковывается один раз; для каждой заявки заново собирается только
+    XML активного листа: затронутые строки пересобираются с сохранением стилей
+    ячеек шаблона, остальные копируются как есть. Строковые значения записываются
+    как inline-строки, поэтому sharedStrings.xml не меняется.
+    Интерфейс совпадает с ExcelTemplateCache.
+    """
+
+    _ROW_RE = re.compile(r'<row\b([^>]*?)(?:/>|>(.*?)</row>)', re.S)
+    _CELL_RE = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+    _ATTR_RE = re.compile(r'([\w:]+)="([^"]*)"')
+    _REF_RE = re.compile(r'([A-Z]+)(\d+)')
+    _ILLEGAL_XML_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+    def __init__(self, path=TEMPLATE_PATH):
+        self.path = path
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Распаковывает шаблон и разбирает строки активного листа, если это ещё не сделано."""
+        with self._lock:
+            if self._entries is not None:
+                return
+            with zipfile.ZipFile(os.path.abspath(self.path)) as zf:
+                entries = [(info, zf.read(info)) for info in zf.infolist()]
+            contents = {info.filename: data for info, data in entries}
+            self._sheet_name = self._active_sheet_name(contents)
+            sheet_xml = contents[self._sheet_name].decode("utf-8")
+
+            start = sheet_xml.index("<sheetData>") + len("<sheetData>")
+            end = sheet_xml.index("</sheetData>")
+            self._prefix = sheet_xml[:start]
+            self._suffix = sheet_xml[end:]
+            self._rows = {}
+            self._max_column = 1
+            for match in self._ROW_RE.finditer(sheet_xml, start, end):
+                attrs = dict(self._ATTR_RE.findall(match.group(1)))
+                cells = {}
+                for cell in self._CELL_RE.finditer(match.group(2) or ""):
+                    ref = dict(self._ATTR_RE.findall(cell.group(1)))["r"]
+                    column = column_index_from_string(self._REF_RE.match(ref).group(1))
+                    cells[column] = cell.group(0)
+                    self._max_column = max(self._max_column, column)
+                self._rows[int(attrs["r"])] = (match.group(1), cells, match.group(0))
+            self._entries = entries
+            logger.info("Excel template '%s' loaded into OOXML cache.", self.path)
+
+    @staticmethod
+    def _active_sheet_name(contents):
+        """Находит путь к XML активного листа через workbook.xml и его связи."""
+        workbook = contents["xl/workbook.xml"].decode("utf-8")
+        rels = contents["xl/_rels/workbook.xml.rels"].decode("utf-8")
+        active = re.search(r'<workbookView\b[^>]*\bactiveTab="(\d+)"', workbook)
+        sheet_ids = re.findall(r'<sheet\b[^>]*\br:id="([^"]+)"', workbook)
+        rel_id = sheet_ids[int(active.group(1)) if active else 0]
+        target = re.search(r'<Relationship\b[^>]*\bId="%s"[^>]*\bTarget="([^"]+)"' % re.escape(rel_id), rels)
+        if not target:
+            target = re.search(r'<Relationship\b[^>]*\bTarget="([^"]+)"[^>]*\bId="%s"' % re.escape(rel_id), rels)
+        # Target бывает относительным (worksheets/sheet1.xml) или от корня архива (/xl/worksheets/sheet1.xml)
+        target = target.group(1)
+        return posixpath.normpath(target[1:] if target.startswith("/") else posixpath.join("xl", target))
+
+    def _cell_xml(self, row, column, value, template_cell):
+        ref = f"{get_column_letter(column)}{row}"
+        style = ""
+        if template_cell:
+            s_attr = re.search(r'\bs="(\d+)"', template_cell.split(">", 1)[0])
+            if s_attr:
+                style = f' s="{s_attr.group(1)}"'
+        if value is None or value == "":
+            return f'<c r="{ref}"{style}/>'
+        if isinstance(value, bool):
+            return f'<c r="{ref}"{style} t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, (int, float)):
+            return f'<c r="{ref}"{style}><v>{value!r}</v></c>'
+        text = xml_escape(self._ILLEGAL_XML_RE.sub("", str(value)))
+        return f'<c r="{ref}"{style} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+    def _sheet_chunks(self, cells):
+        by_row = {}
+        for (row, column), value in cells.items():
+            by_row.setdefault(row, {})[column] = value
+        max_row = max([*self._rows, *by_row]) if (self._rows or by_row) else 1
+        max_column = max([self._max_column, *(c for row in by_row.values() for c in row)])
+        yield re.sub(r'<dimension ref="[^"]*"/>', f'<dimension ref="A1:{get_column_letter(max_column)}{max_row}"/>',
+                     self._prefix, count=1)
+        for row in sorted(set(self._rows) | set(by_row)):
+            template_row = self._rows.get(row)
+            if row not in by_row:
+                yield template_row[2]
+                continue
+            attrs, template_cells = (template_row[0], template_row[1]) if template_row else (f' r="{row}"', {})
+            row_cells = dict(template_cells)
+            for column, value in by_row[row].items():
+                row_cells[column] = self._cell_xml(row, column, value, template_cells.get(column))
+            yield f"<row{attrs}>"
+            yield "".join(row_cells[column] for column in sorted(row_cells))
+            yield "</row>"
+        yield self._suffix
+
+    def render(self, cells):
+        """
+        Возвращает байты XLSX-файла, в котором ячейки шаблона заполнены значениями
+        из `cells` ({(строка, столбец): значение}).
+        """
+        self.load()
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+            for info, data in self._entries:
+                if info.filename != self._sheet_name:
+                    zf.writestr(info, data, compress_type=zipfile.ZIP_DEFLATED)
+                    continue
+                with zf.open(info.filename, "w") as sheet:
+                    for chunk in self._sheet_chunks(cells):
+                        sheet.write(chunk.encode("utf-8"))
+        return buffer.getvalue()
+
+excel_template = OoxmlTemplate() if EXCEL_ENGINE == "ooxml" else ExcelTemplateCache()
+
 def fill_excel(project, object_name, positions, user_full_name, telegram_id_or_username):
     """
     Заполняет Excel-файл данными, включая дату поставки для каждой позиции, проект, объект,
     а также информацию о пользователе, от которого пришла заявка.
+    Книга формируется в памяти из кэшированного шаблона. Возвращает имя файла
+    и его содержимое; копию в архив сохраняет send_email (см. RequestArchive).
     """
     today = datetime.today().strftime("%d.%m.%Y")
     # Изменено: Добавлено user_full_name в имя файла, заменены пробелы на подчеркивания
     sanitized_user_name = user_full_name.replace(" ", "_")
     filename = f"Заявка_{project}_{object_name}_{sanitized_user_name}_{datetime.today().strftime('%Y-%m-%d')}.xlsx"
-    output_dir = "out"
 
-    template_full_path = os.path.abspath(TEMPLATE_PATH)
+    cells = {
+        (2, 6): today,
+        (3, 6): project,
+        (4, 6): object_name,
+        (5, 6): user_full_name,
+        (6, 6): telegram_id_or_username,
+    }
+    logger.info("Writing to Excel: F2=%s, F3=%s, F4=%s, F5=%s, F6=%s", today, project, object_name, user_full_name, telegram_id_or_username)
 
-    os.makedirs(output_dir, exist_ok=True)
-    new_path = os.path.join(output_dir, filename)
+    row_start_data = 9
+    trace = trace_enabled()
+    for i, pos in enumerate(positions):
+        row = row_start_data + i
 
-    shutil.copy(template_full_path, new_path)
-    wb = load_workbook(new_path)
-    ws = wb.active
+        cells[(row, 1)] = i + 1
+        cells[(row, 2)] = pos.name
+        cells[(row, 3)] = pos.unit
+        cells[(row, 4)] = pos.quantity
+        cells[(row, 5)] = pos.delivery_date.isoformat() if pos.delivery_date else "Не указано" # Дата из позиции
+        cells[(row, 6)] = pos.module
+        cells[(row, 7)] = pos.link or "" # Добавлено поле для ссылки в Excel
+        if trace:
+            logger.debug("Writing position %s to Excel: %s", i+1, pos)
 
-    ws['F2'] = today
-    ws['F3'] = project
-    ws['F4'] = object_name
-    ws['F5'] = user_full_name
-    ws['F6'] = telegram_id_or_username
+    content = excel_template.render(cells)
+    return filename, content
 
-    logger.info(f"Writing to Excel: F2={today}, F3={project}, F4={object_name}, F5={user_full_name}, F6={telegram_id_or_username}")
+def _load_excel_template():
+    """Инициализатор воркеров пула Excel: разбирает шаблон, если он ещё не загружен."""
+    excel_template.load()
 
+class ExcelRenderer:
+    """
+    Пул процессов для генерации Excel.
+    Шаблон разбирается в основном процессе до запуска воркеров, поэтому каждый
+    воркер получает уже загруженный шаблон при fork. Несколько заявок
+    формируются параллельно на разных ядрах, а event loop продолжает отвечать
+    на обновления. При EXCEL_PROCESSES=0 генерация выполняется в потоке.
+    """
 
-    row_start_data = 9
-    for i, pos in enumerate(positions):
-        row = row_start_data + i
+    def __init__(self, processes=EXCEL_PROCESSES):
+        self.processes = processes
+        self._executor = None
+        self._restart_lock = threading.Lock()
+
+    def start(self, start_method="fork"):
+        """Загружает шаблон и заранее запускает процессы-воркеры."""
+        excel_template.load()
+        if self.processes > 0:
+            executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context(start_method),
+                initializer=_load_excel_template,
+            )
+            executor.submit(os.getpid).result() # Прогрев: при fork запускаются сразу все воркеры
+            self._executor = executor
+            logger.info("Excel process pool started with %s workers (%s).", self.processes, start_method)
+
+    def _restart(self, broken):
+        """
+        Заменяет сломавшийся пул новым. Выполняется в отдельном потоке, а не в event loop.
+        К этому моменту в процессе уже работают потоки логирования, SMTP и трассировки,
+        и fork такого процесса небезопасен, поэтому новые воркеры запускаются через spawn.
+        """
+        with self._restart_lock:
+            if self._executor is not broken:
+                return # Пул уже перезапущен другой заявкой, упавшей одновременно с этой
+            self._executor = None
+            broken.shutdown(wait=True, cancel_futures=True)
+            self.start("spawn")
+
+    async def render(self, project, object_name, positions, user_full_name, telegram_id_or_username):
+        """
+        Формирует книгу заявки вне event loop и возвращает (имя файла, байты).
+        Ошибки генерации пробрасываются вызывающему, чтобы очередь отправки повторила заявку.
+        """
+        args = (project, object_name, positions, user_full_name, telegram_id_or_username)
+        executor = self._executor
+        try:
+            with stage("excel"):
+                if executor is None:
+                    return await asyncio.to_thread(fill_excel, *args)
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(executor, fill_excel, *args)
+        except BrokenProcessPool:
+            logger.error("Excel process pool is broken, restarting it.")
+            await asyncio.to_thread(self._restart, executor)
+            raise
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+excel_renderer = ExcelRenderer()
+
+# --- АРХИВ ЗАЯВОК ---
+
+class RequestArchive:
+    """
+    Архив сформированных книг. Каждая заявка хранится под своим request_id
+    в каталоге ARCHIVE_DIR/ГГГГ/ММ/<проект>/, поэтому повторные заявки с тем же
+    проектом, объектом и автором в один день не перезаписывают друг друга.
+    Метаданные и SHA-256 содержимого лежат в SQLite-индексе, поиск по request_id
+    идёт по первичному ключу без обхода каталогов. Старые книги пережимаются
+    с максимальным уровнем deflate и удаляются по истечении срока хранения.
+    """
 
-        ws.cell(row=row, column=1).value = i + 1
-        ws.cell(row=row, column=2).value = pos["name"]
-        ws.cell(row=row, column=3).value = pos["unit"]
-        ws.cell(row=row, column=4).value = pos["quantity"]
-        ws.cell(row=row, column=5).value = pos.get("delivery_date", "Не указано") # Дата из позиции
-        ws.cell(row=row, column=6).value = pos["module"]
-        ws.cell(row=row, column=7).value = pos.get("link", "") # Добавлено поле для ссылки в Excel
-        logger.info(f"Writing position {i+1} to Excel: {pos}")
+    def __init__(self, root=ARCHIVE_DIR, index_path=ARCHIVE_INDEX_PATH):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(index_path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS archive (
+                request_id TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                project TEXT,
+                object TEXT,
+                user_full_name TEXT,
+                telegram_id_or_username TEXT,
+                positions INTEGER,
+                created_at REAL NOT NULL,
+                compacted INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS archive_created ON archive (created_at)")
+
+    @staticmethod
+    def _slug(value):
+        """Имя каталога из названия проекта: без разделителей путей и служебных символов."""
+        return re.sub(r'[\\/:*?"<>|\s]+', "_", value or "").strip("._") or "_"
+
+    @staticmethod
+    def _write_atomic(path, content):
+        partial_path = f"{path}.{os.getpid()}.part"
+        with open(partial_path, "wb") as f:
+            f.write(content)
+        os.replace(partial_path, path)
+
+    def store(self, request_id, filename, content, project=None, object_name=None,
+              user_full_name=None, telegram_id_or_username=None, positions=None, created_at=None):
+        """
+        Сохраняет книгу заявки и возвращает путь к ней. Повторное сохранение
+        того же request_id (например, при повторной отправке) заменяет запись.
+        """
+        created_at = created_at or time.time()
+        relative_path = os.path.join(time.strftime("%Y/%m", time.localtime(created_at)), self._slug(project), f"{request_id}.xlsx")
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._write_atomic(path, content)
+        with self._lock:
+            previous = self._conn.execute("SELECT path FROM archive WHERE request_id = ?", (request_id,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO archive (request_id, path, filename, sha256, size, project, object, "
+                "user_full_name, telegram_id_or_username, positions, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (request_id, relative_path, filename, hashlib.sha256(content).hexdigest(), len(content), project,
+                 object_name, user_full_name, telegram_id_or_username, positions, created_at),
+            )
+        # Повтор в другом месяце или с другим проектом кладёт книгу по новому пути - прежняя больше не нужна
+        if previous is not None and previous["path"] != relative_path:
+            previous_path = os.path.join(self.root, previous["path"])
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(previous_path)
+            with contextlib.suppress(OSError):
+                os.removedirs(os.path.dirname(previous_path))
+        return path
+
+    def get(self, request_id):
+        """Возвращает запись индекса заявки (с абсолютным путём в 'path') или None."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM archive WHERE request_id = ?", (request_id,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry["path"] = os.path.join(self.root, entry["path"])
+        return entry
+
+    def _recompress(self, path, level):
+        """Пережимает xlsx (zip-контейнер) с заданным уровнем deflate и возвращает новые байты."""
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(path) as src, zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=level) as dst:
+            for info in src.infolist():
+                dst.writestr(info.filename, src.read(info), compress_type=zipfile.ZIP_DEFLATED, compresslevel=level)
+        content = buffer.getvalue()
+        self._write_atomic(path, content)
+        return content
+
+    def compact(self, older_than, level=ARCHIVE_COMPACT_LEVEL):
+        """Пережимает ещё не сжатые книги, созданные раньше older_than. Возвращает число книг и сэкономленные байты."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT request_id, path, size FROM archive WHERE compacted = 0 AND created_at < ?", (older_than,),
+            ).fetchall()
+        compacted, saved = 0, 0
+        for row in rows:
+            try:
+                content = self._recompress(os.path.join(self.root, row["path"]), level)
+            except (OSError, zipfile.BadZipFile) as e:
+                logger.warning("Archive: не удалось пережать %s: %s", row["path"], e)
+                continue
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE archive SET sha256 = ?, size = ?, compacted = 1 WHERE request_id = ?",
+                    (hashlib.sha256(content).hexdigest(), len(content), row["request_id"]),
+                )
+            compacted += 1
+            saved += row["size"] - len(content)
+        return compacted, saved
+
+    def expire(self, older_than):
+        """Удаляет книги и записи индекса, созданные раньше older_than. Возвращает число удалённых."""
+        with self._lock:
+            rows = self._conn.execute("SELECT request_id, path FROM archive WHERE created_at < ?", (older_than,)).fetchall()
+        for row in rows:
+            path = os.path.join(self.root, row["path"])
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            with contextlib.suppress(OSError):
+                os.removedirs(os.path.dirname(path)) # Убираем опустевшие каталоги проекта и месяца
+            with self._lock:
+                self._conn.execute("DELETE FROM archive WHERE request_id = ?", (row["request_id"],))
+        return len(rows)
+
+    def maintain(self):
+        """Применяет политику хранения: удаляет просроченные книги и пережимает старые."""
+        now = time.time()
+        expired = self.expire(now - ARCHIVE_RETENTION_DAYS * 86400) if ARCHIVE_RETENTION_DAYS > 0 else 0
+        compacted, saved = self.compact(now - ARCHIVE_COMPACT_AFTER_DAYS * 86400) if ARCHIVE_COMPACT_AFTER_DAYS > 0 else (0, 0)
+        if expired or compacted:
+            logger.info("Archive: удалено %s, пережато %s книг (-%s байт).", expired, compacted, saved)
+
+    def close(self):
+        self._conn.close()
+
+request_archive = RequestArchive() if EXCEL_ARCHIVE else None
+
+class SmtpConnectionPool:
+    """
+    Пул долгоживущих SMTP-сессий, общий для всех чатов.
+    Соединение (подключение, STARTTLS, логин) устанавливается один раз и переиспользуется,
+    поэтому на каждую заявку остаётся только передача письма (MAIL/RCPT/DATA).
+    Простаивающие соединения проверяются командой NOOP и закрываются по таймауту,
+    при обрыве связи выполняется прозрачное переподключение с повторным логином.
+    Все методы блокирующие и вызываются только из пула потоков транспорта.
+    """
 
+    def __init__(self, host, port, login, password, size=SMTP_POOL_SIZE,
+                 idle_timeout=SMTP_IDLE_TIMEOUT, keepalive_interval=SMTP_KEEPALIVE_INTERVAL,
+                 starttls=SMTP_STARTTLS):
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.starttls = starttls
+        self._idle = queue.LifoQueue() # (соединение, время последнего использования)
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        with stage("smtp_connect"):
+            server = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        try:
+            if self.starttls:
+                with stage("smtp_starttls"):
+                    server.starttls()
+            if self.login and self.password:
+                with stage("smtp_login"):
+                    server.login(self.login, self.password)
+        except Exception:
+            self._close(server)
+            raise
+        logger.info("Открыто новое SMTP-соединение с %s:%s", self.host, self.port)
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def _is_usable(self, server, last_used):
+        """Проверяет, можно ли переиспользовать простаивающее соединение."""
+        idle_for = time.monotonic() - last_used
+        if idle_for > self.idle_timeout:
+            return False
+        if idle_for > self.keepalive_interval:
+            try:
+                return server.noop()[0] == 250
+            except (smtplib.SMTPException, OSError):
+                return False
+        return True
 
-    wb.save(new_path)
-    logger.info(f"Excel file saved to: {new_path}")
-    return new_path
+    def acquire(self):
+        """Возвращает рабочее соединение из пула или открывает новое."""
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    server, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._is_usable(server, last_used):
+                    return server
+                self._close(server)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, server, broken=False):
+        """Возвращает соединение в пул (или закрывает его, если оно повреждено)."""
+        if broken:
+            self._close(server)
+        else:
+            self._idle.put((server, time.monotonic()))
+        self._slots.release()
+
+    def send_stream(self, from_addr, to_addrs, make_chunks):
+        """
+        Отправляет письмо, содержимое которого выдаёт генератор make_chunks(),
+        не собирая его целиком в памяти. При обрыве сессии один раз
+        переподключается и передаёт письмо заново.
+        """
+        for attempt in range(2):
+            server = self.acquire()
+            try:
+                with stage("smtp_send"):
+                    self._transfer(server, from_addr, to_addrs, make_chunks())
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self.release(server, broken=True)
+                metrics.inc("bot_smtp_failures_total", reason="disconnected")
+                if attempt:
+                    raise
+                logger.warning("SMTP-сессия разорвана (%s), переподключаемся.", e)
+                continue
+            except Exception as e:
+                self.release(server, broken=True)
+                metrics.inc("bot_smtp_failures_total", reason=type(e).__name__)
+                raise
+            self.release(server)
+            return
+
+    @staticmethod
+    def _transfer(server, from_addr, to_addrs, lines):
+        """Передаёт письмо командами MAIL/RCPT/DATA, отправляя строки блоками."""
+        server.ehlo_or_helo_if_needed()
+        code, resp = server.mail(from_addr)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        for to_addr in to_addrs:
+            code, resp = server.rcpt(to_addr)
+            if code not in (250, 251):
+                raise smtplib.SMTPRecipientsRefused({to_addr: (code, resp)})
+        code, resp = server.docmd("data")
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        buffer = bytearray()
+        for line in lines:
+            if line.startswith(b"."):
+                buffer += b"." # Экранирование точки в начале строки (RFC 5321)
+            buffer += line
+            if len(buffer) >= SMTP_CHUNK_SIZE:
+                server.send(bytes(buffer))
+                buffer.clear()
+        buffer += b".\r\n"
+        server.send(bytes(buffer))
+        code, resp = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+    def keepalive(self):
+        """
+        Обслуживает простаивающие соединения: закрывает просроченные
+        и отправляет NOOP остальным, чтобы сервер не разорвал сессию.
+        На время проверки каждое соединение занимает слот пула, как при acquire(),
+        иначе отправители увидели бы пустую очередь и открыли бы соединения сверх размера пула.
+        """
+        alive = []
+        slots = 0
+        while slots < self._idle.qsize() and self._slots.acquire(blocking=False):
+            slots += 1
+        for _ in range(slots):
+            try:
+                server, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if time.monotonic() - last_used > self.idle_timeout:
+                self._close(server)
+                continue
+            try:
+                if server.noop()[0] == 250:
+                    alive.append((server, last_used))
+                    continue
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close(server)
+        # Время последнего использования не сбрасываем, чтобы таймаут простоя продолжал отсчитываться
+        for item in reversed(alive):
+            self._idle.put(item)
+        for _ in range(slots):
+            self._slots.release()
+
+    def close_all(self):
+        """Закрывает все простаивающие соединения."""
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(server)
 
-async def send_email(chat_id, project, object_name, positions, user_full_name, telegram_id_or_username, context=None):
+class SmtpTransport:
+    """
+    Транспорт для доставки писем, не блокирующий event loop.
+    Блокирующие вызовы smtplib выполняются в выделенном пуле потоков
+    поверх общего пула SMTP-соединений, поэтому остальные чаты продолжают
+    обслуживаться, пока письмо уходит на сервер.
+    """
+
+    def __init__(self, pool, max_workers=SMTP_WORKERS):
+        self.pool = pool
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="smtp")
+
+    async def send(self, from_addr, to_addrs, make_chunks):
+        """Отправляет письмо в фоновом потоке и дожидается результата."""
+        loop = asyncio.get_running_loop()
+        # Контекст копируется явно, чтобы span'ы SMTP попали в трассу заявки
+        context = contextvars.copy_context()
+        await loop.run_in_executor(self._executor, context.run, self.pool.send_stream, from_addr, to_addrs, make_chunks)
+
+    async def keepalive(self):
+        """Поддерживает простаивающие SMTP-сессии в рабочем состоянии."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.pool.keepalive)
+
+    def shutdown(self):
+        """Закрывает SMTP-сессии и останавливает пул потоков транспорта."""
+        self._executor.shutdown(wait=True)
+        self.pool.close_all()
+
+mail_transport = SmtpTransport(SmtpConnectionPool(SMTP_SERVER, SMTP_PORT, EMAIL_LOGIN, EMAIL_PASSWORD))
+
+class AttachmentPrefetcher:
+    """
+    Заранее скачивает файлы позиций в spool-каталог сразу после их прикрепления,
+    чтобы при подтверждении заявки файлы уже были на диске.
+    Файлы адресуются парой (владелец, file_unique_id), где владелец - черновик заявки
+    (см. spool_owner): один и тот же файл в двух чатах или заявках хранится отдельно,
+    и удаление позиции в одной заявке не забирает файл у другой.
+    Незавершённые загрузки отменяются при удалении позиции или отмене диалога.
+    """
+
+    def __init__(self, spool_dir=ATTACHMENT_SPOOL_DIR):
+        self.spool_dir = spool_dir
+        self._tasks = {} # ключ файла -> asyncio.Task загрузки
+        os.makedirs(spool_dir, exist_ok=True)
+
+    @staticmethod
+    def _key(owner, file_data):
+        return f"{owner}_{file_data.file_unique_id or file_data.file_id}"
+
+    def _path(self, owner, file_data):
+        return os.path.join(self.spool_dir, self._key(owner, file_data))
+
+    def schedule(self, bot, owner, file_data):
+        """Запускает фоновую загрузку файла, если он ещё не скачан и не скачивается."""
+        key = self._key(owner, file_data)
+        if key in self._tasks or os.path.exists(self._path(owner, file_data)):
+            return
+        task = asyncio.create_task(self._prefetch(bot, owner, file_data))
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        self._tasks[key] = task
+
+    async def _download(self, bot, owner, file_data):
+        """Скачивает файл напрямую на диск, не держа его содержимое в памяти."""
+        path = self._path(owner, file_data)
+        partial_path = f"{path}.{os.getpid()}.{id(asyncio.current_task())}.part"
+        try:
+            with tracer.span("attachment_fetch", file_name=file_data.file_name):
+                telegram_file = await bot.get_file(file_data.file_id)
+                await telegram_file.download_to_drive(partial_path)
+            os.replace(partial_path, path)
+        except BaseException:
+            self._remove(partial_path)
+            raise
+        return path
+
+    async def _prefetch(self, bot, owner, file_data):
+        try:
+            path = await self._download(bot, owner, file_data)
+            logger.info("Файл '%s' заранее скачан в %s.", file_data.file_name, path)
+        except Exception as e:
+            logger.warning("Не удалось заранее скачать файл '%s': %s", file_data.file_name, e)
+
+    async def fetch(self, bot, owner, file_data):
+        """
+        Возвращает путь к файлу в spool-каталоге, дождавшись фоновой загрузки,
+        или, если предзагрузка не удалась, скачивает файл напрямую.
+        """
+        task = self._tasks.get(self._key(owner, file_data))
+        if task:
+            await asyncio.wait({task}) # Отмена или ошибка загрузки не прерывает получение файла
+        path = self._path(owner, file_data)
+        if os.path.exists(path):
+            return path
+        return await self._download(bot, owner, file_data)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def discard(self, owner, file_data, keep=()):
+        """
+        Отменяет загрузку файла и удаляет его из spool-каталога.
+        Файл остаётся, если он прикреплён к одной из позиций `keep` той же заявки.
+        """
+        key = self._key(owner, file_data)
+        if any(p is not None and p.file_data and self._key(owner, p.file_data) == key for p in keep):
+            return
+        task = self._tasks.pop(key, None)
+        if task:
+            task.cancel()
+        self._remove(self._path(owner, file_data))
+
+    def discard_positions(self, owner, positions, keep=()):
+        """Освобождает файлы всех переданных позиций, кроме прикреплённых к позициям `keep`."""
+        for p in positions:
+            if p.file_data:
+                self.discard(owner, p.file_data, keep)
+
+attachment_prefetcher = AttachmentPrefetcher()
+
+def spool_owner(chat_id, request_id=None):
+    """Владелец файлов в spool-каталоге: черновик заявки, а для черновиков без request_id - чат."""
+    return request_id or str(chat_id)
+
+async def download_attachments(bot, owner, files_to_attach):
+    """
+    Параллельно скачивает файлы позиций из Telegram в spool-каталог.
+    Число одновременных загрузок ограничено семафором, на каждый файл действует
+    собственный таймаут. Результат возвращается в исходном порядке позиций
+    в виде кортежей (номер позиции, file_data, путь к файлу, ошибка).
+    """
+    semaphore = asyncio.Semaphore(ATTACHMENT_DOWNLOAD_CONCURRENCY)
+
+    async def fetch_one(pos_index, file_data):
+        async with semaphore:
+            started = time.perf_counter()
+            file_path, error = None, None
+            with tracer.span("attachment_download", position=pos_index, file_name=file_data.file_name) as span:
+                try:
+                    file_path = await asyncio.wait_for(attachment_prefetcher.fetch(bot, owner, file_data), ATTACHMENT_DOWNLOAD_TIMEOUT)
+                except asyncio.TimeoutError:
+                    error = TimeoutError(f"превышено время ожидания {ATTACHMENT_DOWNLOAD_TIMEOUT:g} с")
+                except Exception as e:
+                    error = e
+                if error is not None:
+                    span.set(error=str(error))
+            elapsed = time.perf_counter() - started
+            metrics.observe("bot_stage_seconds", elapsed, stage="attachment_download")
+            if error is not None:
+                metrics.inc("bot_attachment_failures_total")
+                logger.error("Ошибка при скачивании файла '%s' для позиции %s: %s", file_data.file_name, pos_index, error)
+            else:
+                size = os.path.getsize(file_path)
+                metrics.observe("bot_attachment_bytes", size, buckets=BYTES_BUCKETS)
+                logger.info("Файл '%s' для позиции %s получен за %.3f с (%s байт).", file_data.file_name, pos_index, elapsed, size)
+            return pos_index, file_data, file_path, error, elapsed
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(fetch_one(pos_index, file_data) for pos_index, file_data in files_to_attach))
+    total = time.perf_counter() - started
+    per_file = sum(r[4] for r in results)
+    logger.info("Скачано файлов позиций: %s за %.3f с (сумма по файлам %.3f с).", len(results), total, per_file)
+    return [r[:4] for r in results]
+
+def _base64_lines(stream):
+    """Кодирует поток в base64 строками по 76 символов, читая его блоками."""
+    while True:
+        block = stream.read(MIME_READ_BLOCK)
+        if not block:
+            return
+        for line in base64.encodebytes(block).splitlines():
+            yield line + b"\r\n"
+
+def _rfc2231_param(name, value):
+    """
+    Кодирует параметр заголовка по RFC 2231. Длинное значение разбивается на сегменты
+    name*0*=, name*1*=, ... на отдельных строках заголовка, не разрывая %XX.
+    """
+    encoded = encode_rfc2231(value, "utf-8")
+    if len(encoded) <= MIME_PARAM_CHUNK:
+        return f"{name}*={encoded}"
+    segments = []
+    start = 0
+    while start < len(encoded):
+        end = min(start + MIME_PARAM_CHUNK, len(encoded))
+        percent = encoded.rfind("%", end - 2, end)
+        if end < len(encoded) and percent != -1:
+            end = percent
+        segments.append(encoded[start:end])
+        start = end
+    return ";\r\n ".join(f"{name}*{i}*={segment}" for i, segment in enumerate(segments))
+
+def iter_mime_message(from_addr, to_addr, subject, body, attachments):
+    """
+    Потоково генерирует письмо multipart/mixed построчно (строки с CRLF).
+    Текст письма и вложения кодируются в base64 блоками по мере чтения,
+    поэтому в памяти одновременно находится только небольшой фрагмент файла.
+    `attachments` - список кортежей (имя файла, MIME-тип, путь к файлу или его байты).
+    """
+    boundary = f"=============={uuid.uuid4().hex}=="
+    # Длинная тема переносится на несколько строк; перенос должен быть CRLF, голый LF серверы отвергают
+    encoded_subject = Header(subject, "utf-8", header_name="Subject").encode(linesep="\r\n")
+    headers = [
+        f"From: {from_addr}",
+        f"To: {to_addr}",
+        f"Subject: {encoded_subject}",
+        f"Date: {formatdate(localtime=True)}",
+        f"Message-ID: {make_msgid()}",
+        "MIME-Version: 1.0",
+        f'Content-Type: multipart/mixed; boundary="{boundary}"',
+        "",
+        f"--{boundary}",
+        'Content-Type: text/plain; charset="utf-8"',
+        "Content-Transfer-Encoding: base64",
+        "",
+    ]
+    for header in headers:
+        yield header.encode("ascii") + b"\r\n"
+    yield from _base64_lines(io.BytesIO(body.encode("utf-8")))
+
+    for filename, mime_type, source in attachments:
+        part_headers = [
+            "",
+            f"--{boundary}",
+            f"Content-Type: {mime_type or 'application/octet-stream'}",
+            "Content-Transfer-Encoding: base64",
+            f"Content-Disposition: attachment;\r\n {_rfc2231_param('filename', filename)}",
+            "",
+        ]
+        for header in part_headers:
+            yield header.encode("ascii") + b"\r\n"
+        if isinstance(source, (bytes, bytearray)):
+            yield from _base64_lines(io.BytesIO(source))
+        else:
+            with open(source, "rb") as f:
+                yield from _base64_lines(f)
+
+    yield f"\r\n--{boundary}--\r\n".encode("ascii")
+
+async def send_email(chat_id, project, object_name, positions, user_full_name, telegram_id_or_username, bot=None, request_id=None,
+                     owner=None):
     """
     Отправляет сгенерированный Excel-файл по электронной почте,
     с возможностью прикрепления дополнительных файлов и ссылок, привязанных к позициям,
-    а также информацией о пользователе.
+    а также информацией о пользователе. request_id задаёт запись в архиве книг,
+    owner - владельца заранее скачанных файлов в spool (по умолчанию по request_id).
     """
-    msg = EmailMessage()
-    msg["Subject"] = f"Заявка на снабжение: {project} - {object_name}"
-    msg["From"] = EMAIL_LOGIN
-    msg["To"] = EMAIL_RECEIVER
-
     email_body = "Во вложении заявка на снабжение.\n\n"
     email_body += f"Проект: {project}\n"
     email_body += f"Объект: {object_name}\n"
@@ -119,71 +1985,852 @@ async def send_email(chat_id, project, object_name, positions, user_full_name, t
     links_in_email = []
 
     for i, p in enumerate(positions):
-        pos_info = (
-            f"{i+1}. Модуль: {p.get('module', 'N/A')} | Наименование: {p.get('name', 'N/A')} | "
-            f"Ед.изм.: {p.get('unit', 'N/A')} | Количество: {p.get('quantity', 'N/A')} | "
-            f"Дата поставки: {p.get('delivery_date', 'N/A')}"
-        )
-        if p.get('link'):
-            pos_info += f" | Ссылка: {p['link']}"
-            links_in_email.append(f"Позиция {i+1} ({p.get('name', 'N/A')}): {p['link']}")
-        if p.get('file_data'):
-            pos_info += f" | Файл: {p['file_data'].get('file_name', 'N/A')}"
-            files_to_attach.append((i+1, p['file_data'])) # Сохраняем индекс позиции для логов
-        email_body += pos_info + "\n"
+        email_body += format_position_line(i, p) + "\n"
+        if p.link:
+            links_in_email.append(f"Позиция {i+1} ({p.name or 'N/A'}): {p.link}")
+        if p.file_data:
+            files_to_attach.append((i+1, p.file_data)) # Сохраняем индекс позиции для логов
 
     if links_in_email:
         email_body += "\nОтдельные ссылки для позиций:\n" + "\n".join(links_in_email) + "\n"
 
-    msg.set_content(email_body)
-    logger.info(f"Email body generated for chat_id {chat_id}: \n{email_body}")
+    # Файлы позиций скачиваются параллельно с генерацией Excel
+    downloads = None
+    if bot and files_to_attach:
+        downloads = asyncio.create_task(download_attachments(bot, owner or spool_owner(chat_id, request_id), files_to_attach))
 
     try:
-        file_path = fill_excel(project, object_name, positions, user_full_name, telegram_id_or_username)
-        with open(file_path, "rb") as f:
-            msg.add_attachment(
-                f.read(),
-                maintype="application",
-                subtype="vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                filename=os.path.basename(file_path),
-            )
-        logger.info(f"Excel file '{file_path}' прикреплен к письму.")
+        # Генерация Excel - CPU-нагрузка, выполняется в пуле процессов вне event loop
+        excel_file = await excel_renderer.render(
+            project, object_name, positions, user_full_name, telegram_id_or_username
+        )
     except Exception as e:
-        logger.error(f"Ошибка при создании или прикреплении Excel файла: {e}")
+        # Без книги заявка не отправляется: очередь отметит попытку неудачной и повторит её
+        logger.error("Ошибка при создании Excel файла: %s", e)
+        if downloads:
+            downloads.cancel()
+        raise
 
-    # Прикрепление файлов, связанных с позициями
-    if context:
-        for pos_index, file_data in files_to_attach:
-            try:
-                file_id = file_data['file_id']
-                file_name = file_data['file_name']
-                mime_type = file_data['mime_type']
-
-                telegram_file = await context.bot.get_file(file_id)
-                file_bytes = await telegram_file.download_as_bytearray()
-
-                msg.add_attachment(
-                    file_bytes,
-                    maintype=mime_type.split('/')[0],
-                    subtype=mime_type.split('/')[1],
-                    filename=f"Позиция_{pos_index}_{file_name}", # Уникальное имя файла
+    if request_archive is not None and request_id:
+        try:
+            with stage("archive"):
+                path = await asyncio.to_thread(
+                    request_archive.store, request_id, *excel_file,
+                    project=project, object_name=object_name, user_full_name=user_full_name,
+                    telegram_id_or_username=telegram_id_or_username, positions=len(positions),
                 )
-                logger.info(f"Дополнительный файл '{file_name}' для позиции {pos_index} прикреплен к письму.")
+            logger.info("Excel file saved to: %s", path)
+        except Exception as e:
+            logger.error("Не удалось сохранить заявку в архив: %s", e)
+
+    downloaded = await downloads if downloads else []
+    for pos_index, file_data, file_path, error in downloaded:
+        if error is not None:
+            email_body += (f"\n\nВнимание: Не удалось прикрепить файл '{file_data.file_name or 'N/A'}' "
+                           f"для позиции {pos_index} из-за ошибки: {error}")
+
+    logger.info("Email body generated for chat_id %s: %s positions, %s characters.", chat_id, len(positions), len(email_body))
+    if trace_enabled():
+        logger.debug("Email body for chat_id %s:\n%s", chat_id, email_body)
+
+    # Вложения кодируются потоково при отправке; Excel передаётся из памяти без записи на диск
+    excel_filename, excel_content = excel_file
+    attachments = [(excel_filename, XLSX_MIME_TYPE, excel_content)]
+    logger.info("Excel file '%s' прикреплен к письму.", excel_filename)
+
+    # Прикрепление файлов, связанных с позициями, в порядке позиций
+    for pos_index, file_data, file_path, error in downloaded:
+        if error is not None:
+            continue
+        file_name = file_data.file_name
+        # Уникальное имя файла
+        attachments.append((f"Позиция_{pos_index}_{file_name}", file_data.mime_type, file_path))
+        logger.info("Дополнительный файл '%s' для позиции %s прикреплен к письму.", file_name, pos_index)
+
+    subject = f"Заявка на снабжение: {project} - {object_name}"
+    try:
+        await mail_transport.send(
+            EMAIL_LOGIN, [EMAIL_RECEIVER],
+            lambda: iter_mime_message(EMAIL_LOGIN, EMAIL_RECEIVER, subject, email_body, attachments),
+        )
+        logger.info("Письмо успешно отправлено на %s", EMAIL_RECEIVER)
+        return True
+    except Exception as e:
+        logger.error("Ошибка при отправке письма: %s", e)
+        raise
+
+# --- ОЧЕРЕДЬ ИСХОДЯЩИХ ЗАЯВОК ---
+
+class MailOutbox:
+    """
+    Персистентная очередь исходящих заявок на SQLite.
+    Подтверждённая заявка сохраняется одной локальной записью, а отправкой
+    занимается фоновый обработчик с повторами и экспоненциальной задержкой.
+    Заявки, исчерпавшие все попытки, остаются в таблице со статусом 'dead'.
+    Методы работы с базой блокирующие (воркеры делят один файл и ждут блокировок друг друга),
+    поэтому из event loop они вызываются через asyncio.to_thread.
+    """
+
+    def __init__(self, path=OUTBOX_PATH):
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+        # Заявки, которые отправлялись в момент падения процесса, возвращаем в очередь.
+        # Несколько воркеров делят одну очередь, поэтому там зависшие отправки
+        # возвращаются по истечении OUTBOX_CLAIM_TIMEOUT в claim_due
+        if BOT_WORKERS == 1:
+            self._conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+        self._lock = threading.Lock() # Соединение общее для потоков: транзакция claim_due не должна перемежаться с другими запросами
+        self._drain_lock = asyncio.Lock()
+
+    def enqueue(self, chat_id, payload):
+        """Сохраняет заявку в очередь и возвращает её идентификатор."""
+        now = time.time()
+        data = json.dumps(payload, ensure_ascii=False)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (chat_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+                (chat_id, data, now, now),
+            )
+        return cursor.lastrowid
+
+    def claim_due(self, limit):
+        """
+        Забирает из очереди заявки, срок отправки которых наступил.
+        Выборка и пометка выполняются в одной транзакции, поэтому заявку забирает только один воркер;
+        на время отправки next_attempt_at сдвигается на OUTBOX_CLAIM_TIMEOUT.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time() # После ожидания блокировки другого воркера
+                rows = self._conn.execute(
+                    "SELECT id, chat_id, payload, attempts FROM outbox "
+                    "WHERE status IN ('pending', 'sending') AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                    (now, limit),
+                ).fetchall()
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE outbox SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+                        [(now + OUTBOX_CLAIM_TIMEOUT, r["id"]) for r in rows],
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return rows
+
+    def mark_sent(self, item_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+
+    def mark_failed(self, item_id, attempts, error):
+        """
+        Фиксирует неудачную попытку. Возвращает True, если заявка исчерпала
+        все попытки и перенесена в dead-letter.
+        """
+        dead = attempts >= OUTBOX_MAX_ATTEMPTS
+        delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                ("dead" if dead else "pending", attempts, time.time() + delay, str(error), item_id),
+            )
+        return dead
+
+    async def _deliver(self, bot, row):
+        item_id, chat_id, attempts = row["id"], row["chat_id"], row["attempts"] + 1
+        payload = json.loads(row["payload"])
+        positions = [Position.from_dict(p) for p in payload["positions"]]
+        # Элементы, поставленные в очередь до появления request_id, получают постоянный идентификатор
+        # по номеру в outbox, чтобы повторы не плодили записи в архиве и истории
+        request_id = payload.get("request_id") or f"outbox-{item_id}"
+        owner = spool_owner(chat_id, payload.get("request_id"))
+        with tracer.span("outbox_deliver", trace_id=request_id, outbox_id=item_id, attempt=attempts):
+            try:
+                with stage("send_email", positions=len(positions)):
+                    await send_email(
+                        chat_id,
+                        payload["project"],
+                        payload["object"],
+                        positions,
+                        payload["user_full_name"],
+                        payload["telegram_id_or_username"],
+                        bot=bot,
+                        request_id=request_id,
+                        owner=owner,
+                    )
             except Exception as e:
-                logger.error(f"Ошибка при скачивании или прикреплении файла '{file_name}' для позиции {pos_index}: {e}")
-                msg.set_content(msg.get_content() + f"\n\nВнимание: Не удалось прикрепить файл '{file_name}' для позиции {pos_index} из-за ошибки: {e}")
+                dead = await asyncio.to_thread(self.mark_failed, item_id, attempts, e)
+                metrics.inc("bot_outbox_attempts_total", result="dead" if dead else "retry")
+                if not dead:
+                    logger.warning("Outbox %s: попытка %s не удалась (%s), повтор позже.", item_id, attempts, e)
+                    return
+                # Повторов больше не будет, поэтому заранее скачанные файлы заявки не нужны
+                attachment_prefetcher.discard_positions(owner, positions)
+                logger.error("Outbox %s: заявка не отправлена после %s попыток: %s", item_id, attempts, e)
+                text = (f"Не удалось отправить заявку ({payload['project']} - {payload['object']}) на почту: {e}\n"
+                        f"Заявка сохранена, обратитесь к администратору.")
+            else:
+                await asyncio.to_thread(self.mark_sent, item_id)
+                metrics.inc("bot_outbox_attempts_total", result="sent")
+                try:
+                    await asyncio.to_thread(
+                        request_history.record, request_id, chat_id,
+                        payload["project"], payload["object"], payload["user_full_name"],
+                        payload["telegram_id_or_username"], positions,
+                    )
+                except Exception as e:
+                    logger.warning("Outbox %s: заявка не записана в историю: %s", item_id, e)
+                attachment_prefetcher.discard_positions(owner, positions)
+                logger.info("Outbox %s: заявка отправлена с попытки %s.", item_id, attempts)
+                text = f"Заявка ({payload['project']} - {payload['object']}) успешно отправлена на почту!"
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+            except Exception as e:
+                logger.warning("Outbox %s: не удалось уведомить чат %s: %s", item_id, chat_id, e)
+
+    async def drain(self, bot):
+        """Отправляет все заявки, срок которых наступил. Параллельно не запускается."""
+        if self._drain_lock.locked():
+            return
+        async with self._drain_lock:
+            while True:
+                rows = await asyncio.to_thread(self.claim_due, SMTP_WORKERS)
+                if not rows:
+                    return
+                await asyncio.gather(*(self._deliver(bot, row) for row in rows))
+
+mail_outbox = MailOutbox()
+
+async def outbox_worker_job(context: ContextTypes.DEFAULT_TYPE):
+    """Фоновая задача: отправляет накопившиеся в очереди заявки."""
+    await mail_outbox.drain(context.bot)
+
+# --- ИСТОРИЯ ЗАЯВОК ---
+
+class RequestHistory:
+    """
+    Локальный индекс отправленных заявок для команды /history.
+    Заявки и их позиции хранятся в SQLite, а наименования позиций вместе с проектом,
+    объектом и автором заявки — в полнотекстовом индексе FTS5, поэтому поиск
+    не перебирает книги в архиве и не сканирует все позиции.
+    """
+
+    def __init__(self, path=HISTORY_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS requests (
+                request_id TEXT PRIMARY KEY,
+                chat_id INTEGER,
+                project TEXT,
+                object TEXT,
+                user_full_name TEXT,
+                telegram_id_or_username TEXT,
+                submitted_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS requests_submitted ON requests (submitted_at);
+            CREATE INDEX IF NOT EXISTS requests_chat ON requests (chat_id, submitted_at);
+            CREATE TABLE IF NOT EXISTS positions (
+                id INTEGER PRIMARY KEY,
+                request_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                name TEXT,
+                unit TEXT,
+                quantity REAL,
+                module TEXT,
+                delivery_date TEXT
+            );
+            CREATE INDEX IF NOT EXISTS positions_request ON positions (request_id, idx);
+            CREATE VIRTUAL TABLE IF NOT EXISTS positions_fts USING fts5(
+                name, project, object, user_full_name, tokenize = 'unicode61 remove_diacritics 2'
+            );
+            CREATE TABLE IF NOT EXISTS imported_files (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                request_id TEXT,
+                imported_at REAL NOT NULL
+            );
+            """
+        )
+
+    def record(self, request_id, chat_id, project, object_name, user_full_name, telegram_id_or_username,
+               positions, submitted_at=None):
+        """Сохраняет отправленную заявку; повторная запись того же request_id заменяет прежнюю."""
+        with self._transaction():
+            self._insert(request_id, chat_id, project, object_name, user_full_name, telegram_id_or_username,
+                         positions, submitted_at or time.time())
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _insert(self, request_id, chat_id, project, object_name, user_full_name, telegram_id_or_username,
+                positions, submitted_at):
+        self._delete(request_id)
+        self._conn.execute(
+            "INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (request_id, chat_id, project, object_name, user_full_name, telegram_id_or_username, submitted_at),
+        )
+        for i, p in enumerate(positions):
+            cursor = self._conn.execute(
+                "INSERT INTO positions (request_id, idx, name, unit, quantity, module, delivery_date) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (request_id, i, p.name, p.unit, p.quantity, p.module,
+                 p.delivery_date.isoformat() if p.delivery_date else None),
+            )
+            self._conn.execute(
+                "INSERT INTO positions_fts (rowid, name, project, object, user_full_name) VALUES (?, ?, ?, ?, ?)",
+                (cursor.lastrowid, p.name, project, object_name, user_full_name),
+            )
+
+    def imported_files(self):
+        """Возвращает уже импортированные книги: путь -> (mtime_ns, размер, SHA-256)."""
+        with self._lock:
+            rows = self._conn.execute("SELECT path, mtime_ns, size, sha256 FROM imported_files").fetchall()
+        return {r["path"]: (r["mtime_ns"], r["size"], r["sha256"]) for r in rows}
+
+    def record_imported(self, results):
+        """
+        Сохраняет пачку разобранных книг (результаты parse_request_workbook) одной транзакцией.
+        Книги без изменений содержимого только обновляют mtime в imported_files, а заявки,
+        уже записанные ботом при отправке (с chat_id), не перезаписываются. Если у изменённой
+        старой книги сменился request_id (он считается по содержимому), прежняя заявка удаляется.
+        """
+        now = time.time()
+        with self._transaction():
+            for r in results:
+                previous = self._conn.execute(
+                    "SELECT request_id FROM imported_files WHERE path = ?", (r["path"],),
+                ).fetchone()
+                if previous and previous["request_id"] != r["request_id"] and not self._conn.execute(
+                    "SELECT 1 FROM imported_files WHERE request_id = ? AND path != ? "
+                    "UNION ALL SELECT 1 FROM requests WHERE request_id = ? AND chat_id IS NOT NULL",
+                    (previous["request_id"], r["path"], previous["request_id"]),
+                ).fetchone():
+                    self._delete(previous["request_id"]) # Та же заявка не нужна другим книгам и не записана ботом
+                recorded = self._conn.execute(
+                    "SELECT 1 FROM requests WHERE request_id = ? AND chat_id IS NOT NULL", (r["request_id"],),
+                ).fetchone()
+                if "positions" in r and not recorded:
+                    self._insert(r["request_id"], None, r["project"], r["object"], r["user_full_name"],
+                                 r["telegram_id_or_username"], [Position.from_dict(p) for p in r["positions"]],
+                                 r["submitted_at"])
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO imported_files VALUES (?, ?, ?, ?, ?, ?)",
+                    (r["path"], r["mtime_ns"], r["size"], r["sha256"], r.get("request_id"), now),
+                )
+
+    def _delete(self, request_id):
+        self._conn.execute(
+            "DELETE FROM positions_fts WHERE rowid IN (SELECT id FROM positions WHERE request_id = ?)", (request_id,),
+        )
+        self._conn.execute("DELETE FROM positions WHERE request_id = ?", (request_id,))
+        self._conn.execute("DELETE FROM requests WHERE request_id = ?", (request_id,))
+
+    @staticmethod
+    def _match_expression(text):
+        """Превращает текст пользователя в запрос FTS5: все слова по префиксу, без операторов FTS."""
+        return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text))
+
+    def search(self, text="", chat_id=None, limit=HISTORY_PAGE_SIZE, offset=0):
+        """
+        Возвращает заявки (новые первыми), у которых позиции, проект, объект или автор
+        содержат все слова из text, вместе с их позициями. Если задан chat_id —
+        только заявки этого чата. Вторым значением возвращает, есть ли следующая страница.
+        """
+        match = self._match_expression(text)
+        conditions, params = [], []
+        if match:
+            conditions.append(
+                "request_id IN (SELECT p.request_id FROM positions_fts JOIN positions p ON p.id = positions_fts.rowid "
+                "WHERE positions_fts MATCH ?)"
+            )
+            params.append(match)
+        if chat_id is not None:
+            conditions.append("chat_id = ?")
+            params.append(chat_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM requests {where} ORDER BY submitted_at DESC LIMIT ? OFFSET ?",
+                (*params, limit + 1, offset),
+            ).fetchall()
+            has_more = len(rows) > limit
+            requests = [dict(r, positions=[]) for r in rows[:limit]]
+            by_id = {r["request_id"]: r for r in requests}
+            if by_id:
+                placeholders = ",".join("?" * len(by_id))
+                for p in self._conn.execute(
+                    f"SELECT * FROM positions WHERE request_id IN ({placeholders}) ORDER BY request_id, idx", list(by_id),
+                ):
+                    by_id[p["request_id"]]["positions"].append(Position(
+                        name=p["name"], unit=p["unit"], quantity=p["quantity"], module=p["module"],
+                        delivery_date=date.fromisoformat(p["delivery_date"]) if p["delivery_date"] else None,
+                    ))
+        return requests, has_more
+
+    def iter_positions(self, date_from, date_to, chat_id=None):
+        """
+        Позиции заявок, отправленных с date_from по date_to включительно, в порядке записи
+        (позиции одной заявки идут подряд): (объект, модуль, дата поставки, наименование,
+        ед. изм., количество, request_id). Строки читаются пачками через отдельное соединение
+        только для чтения в одной транзакции: в режиме WAL она видит снимок базы на момент
+        начала, и заявки, записанные outbox во время обхода, в отчёт не попадают.
+        """
+        start = time.mktime(date_from.timetuple())
+        end = time.mktime((date_to + timedelta(days=1)).timetuple())
+        chat_filter = "AND r.chat_id = ?" if chat_id is not None else ""
+        uri = f"file:{urllib.request.pathname2url(os.path.abspath(self.path))}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False, timeout=30)
+        try:
+            conn.execute("BEGIN")
+            cursor = conn.execute(
+                f"""
+                SELECT r.object, p.module, p.delivery_date, p.name, p.unit, p.quantity, p.request_id
+                FROM positions p JOIN requests r ON r.request_id = p.request_id
+                WHERE r.submitted_at >= ? AND r.submitted_at < ? {chat_filter}
+                ORDER BY p.id
+                """,
+                (start, end, *(() if chat_id is None else (chat_id,))),
+            )
+            while True:
+                rows = cursor.fetchmany(5000)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            conn.close()
+
+    def close(self):
+        self._conn.close()
+
+request_history = RequestHistory()
 
+# --- СВОДНЫЙ ОТЧЁТ ---
 
+REPORT_COLUMNS = ("Объект", "Модуль", "Неделя поставки", "Наименование", "Ед. изм.", "Количество", "Заявок")
+REPORT_COLUMN_WIDTHS = (20, 8, 16, 50, 10, 12, 8)
+
+def aggregate_requests(date_from, date_to, chat_id=None):
+    """
+    Сводит позиции заявок, отправленных с date_from по date_to включительно: количество
+    суммируется по (объект, модуль, неделя поставки, наименование, ед. изм.), где наименование
+    и единица сравниваются без учёта регистра, «ё» и лишних пробелов. Нормализация и расчёт недели
+    кэшируются по исходному значению, поэтому на позицию остаются поиск в словаре и сложение.
+    Возвращает строки отчёта, упорядоченные по объекту, номеру модуля, неделе и наименованию.
+    """
+    normalized, weeks, totals = {}, {}, {}
+    for object_name, module, delivery_date, name, unit, quantity, request_id in \
+            request_history.iter_positions(date_from, date_to, chat_id):
+        if isinstance(quantity, str):
+            # Текст мог попасть в историю при импорте до нормализации количества
+            quantity = _parse_quantity(quantity)
+        name_key = normalized.get(name)
+        if name_key is None:
+            name_key = normalized[name] = " ".join(str(name or "").lower().replace("ё", "е").split())
+        unit_key = normalized.get(unit)
+        if unit_key is None:
+            unit_key = normalized[unit] = " ".join(str(unit or "").lower().replace("ё", "е").split())
+        week = weeks.get(delivery_date)
+        if week is None:
+            day = date.fromisoformat(delivery_date) if delivery_date else None
+            week = weeks[delivery_date] = day - timedelta(days=day.weekday()) if day else ""
+        key = (object_name or "", module or "", week, name_key, unit_key)
+        entry = totals.get(key)
+        if entry is None:
+            # В отчёт попадает первое встретившееся написание наименования
+            totals[key] = [" ".join(str(name or "").split()), quantity or 0, 1, request_id]
+            continue
+        entry[1] += quantity or 0
+        # Позиции одной заявки идут подряд, поэтому достаточно сравнить с последней учтённой
+        if entry[3] != request_id:
+            entry[2] += 1
+            entry[3] = request_id
+
+    def order(key):
+        object_name, module, week, name, unit = key
+        # Модули — номера, поэтому «2» идёт раньше «10»; позиции без даты — в конце объекта и модуля
+        return (object_name, (0, int(module), "") if module.isdigit() else (1, 0, module),
+                (week == "", week or date.min), name, unit)
+
+    return [
+        (key[0], key[1], key[2] or None, name, key[4], quantity, requests)
+        for key, (name, quantity, requests, _) in sorted(totals.items(), key=lambda item: order(item[0]))
+    ]
+
+_XLSX_STATIC_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    ),
+    # Два формата ячеек: обычный (0) и полужирный (1) для заголовков
+    "xl/styles.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    ),
+}
+
+def _xlsx_cell(value, style):
+    """XML ячейки без ссылки r: столбец определяется позицией в строке."""
+    if value is None or value == "":
+        return "<c/>"
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return f'<c{style}><v>{value!r}</v></c>'
+    text = xml_escape(OoxmlTemplate._ILLEGAL_XML_RE.sub("", str(value)))
+    return f'<c{style} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def write_xlsx(sheet_name, rows, bold_rows=(), widths=()):
+    """
+    Потоково записывает книгу из одного листа и возвращает её байты. XML листа пишется
+    в архив блоками по мере обхода rows (как OoxmlTemplate, без объектной модели openpyxl),
+    строки с номерами из bold_rows (с нуля) выделяются полужирным.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, xml in _XLSX_STATIC_PARTS.items():
+            zf.writestr(name, xml)
+        zf.writestr("xl/workbook.xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{xml_escape(sheet_name)}" sheetId="1" r:id="rId1"/></sheets></workbook>'
+        ))
+        with zf.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            cols = "".join(f'<col min="{i}" max="{i}" width="{w}" customWidth="1"/>' for i, w in enumerate(widths, 1))
+            chunk = [
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">',
+                f"<cols>{cols}</cols><sheetData>" if cols else "<sheetData>",
+            ]
+            for i, row in enumerate(rows):
+                style = ' s="1"' if i in bold_rows else ""
+                chunk.append(f'<row r="{i + 1}">' + "".join(_xlsx_cell(v, style) for v in row) + "</row>")
+                if len(chunk) >= 1000:
+                    sheet.write("".join(chunk).encode("utf-8"))
+                    chunk.clear()
+            chunk.append("</sheetData></worksheet>")
+            sheet.write("".join(chunk).encode("utf-8"))
+    return buffer.getvalue()
+
+def build_report_workbook(rows, date_from, date_to):
+    """Формирует XLSX сводного отчёта и возвращает его байты."""
+    def sheet_rows():
+        yield (f"Сводная заявка за период {date_from:%d.%m.%Y} — {date_to:%d.%m.%Y}",)
+        yield ()
+        yield REPORT_COLUMNS
+        for object_name, module, week, name, unit, quantity, requests in rows:
+            yield object_name, module, week.strftime("%d.%m.%Y") if week else "Не указано", name, unit, quantity, requests
+
+    return write_xlsx("Сводная заявка", sheet_rows(), bold_rows=(0, 2), widths=REPORT_COLUMN_WIDTHS)
+
+def generate_report(date_from, date_to, chat_id=None):
+    """Сводный отчёт за период: возвращает (имя файла, байты XLSX, число строк)."""
+    rows = aggregate_requests(date_from, date_to, chat_id)
+    filename = f"Сводная_заявка_{date_from:%Y-%m-%d}_{date_to:%Y-%m-%d}.xlsx"
+    return filename, build_report_workbook(rows, date_from, date_to), len(rows)
+
+# --- ИМПОРТ КНИГ ИЗ АРХИВА ---
+
+_HEADER_LABELS = frozenset({"Дата", "Проект", "Объект", "Имя пользователя", "Telegram"})
+_ARCHIVE_NAME_RE = re.compile(r"[0-9a-f]{32}|outbox-\d+") # Имена книг архива: request_id или outbox-<id> для заявок без него
+
+def _header_value(row):
+    """Значение строки шапки (F2..F6): в старых книгах оно стоит справа от подписи, в новых — вместо неё."""
+    values = [v for v in row[4:8] if v not in (None, "") and v not in _HEADER_LABELS]
+    return values[-1] if values else None
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    for parse in (date.fromisoformat, lambda v: datetime.strptime(v, "%d.%m.%Y").date()):
+        try:
+            return parse(str(value).strip())
+        except ValueError:
+            pass
+    return None
+
+def _parse_quantity(value):
+    """Количество из ячейки книги: число или текст с запятой вместо точки ("3,5"); иначе None."""
+    if isinstance(value, (int, float)) or value is None:
+        return value
     try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_LOGIN, EMAIL_PASSWORD)
-            server.send_message(msg)
-        logger.info(f"Письмо успешно отправлено на {EMAIL_RECEIVER}")
-        return True
+        return float(str(value).strip().replace(",", "."))
+    except ValueError:
+        return None
+
+_SHEET_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+
+def iter_sheet_rows(content, columns=8):
+    """
+    Потоково читает активный лист XLSX и выдаёт (номер строки, значения первых `columns` столбцов).
+    В отличие от openpyxl не разбирает стили и всю книгу: читаются только sharedStrings
+    и XML листа, поэтому разбор одной заявки занимает доли миллисекунды.
+    """
+    with zipfile.ZipFile(io.BytesIO(content)) as zf:
+        names = set(zf.namelist())
+        contents = {name: zf.read(name) for name in ("xl/workbook.xml", "xl/_rels/workbook.xml.rels")}
+        shared = []
+        if "xl/sharedStrings.xml" in names:
+            for si in ElementTree.fromstring(zf.read("xl/sharedStrings.xml")).iter(f"{_SHEET_NS}si"):
+                shared.append("".join(t.text or "" for t in si.iter(f"{_SHEET_NS}t")))
+        with zf.open(OoxmlTemplate._active_sheet_name(contents)) as sheet:
+            for _, row in ElementTree.iterparse(sheet):
+                if row.tag != f"{_SHEET_NS}row":
+                    continue
+                values = [None] * columns
+                for cell in row.iter(f"{_SHEET_NS}c"):
+                    column = column_index_from_string(OoxmlTemplate._REF_RE.match(cell.get("r")).group(1))
+                    if column > columns:
+                        continue
+                    kind = cell.get("t")
+                    if kind == "inlineStr":
+                        values[column - 1] = "".join(t.text or "" for t in cell.iter(f"{_SHEET_NS}t"))
+                        continue
+                    v = cell.find(f"{_SHEET_NS}v")
+                    if v is None or v.text is None:
+                        continue
+                    if kind == "s":
+                        values[column - 1] = shared[int(v.text)]
+                    elif kind in ("str", "e"):
+                        values[column - 1] = v.text
+                    elif kind == "b":
+                        values[column - 1] = v.text == "1"
+                    else:
+                        number = float(v.text)
+                        values[column - 1] = int(number) if number.is_integer() else number
+                yield int(row.get("r")), tuple(values)
+                row.clear()
+
+def parse_request_workbook(path, known_sha256=None):
+    """
+    Разбирает книгу заявки, сформированную fill_excel (шапка в F2..F6, позиции с 9-й строки),
+    потоково через iter_sheet_rows. Выполняется в процессах импорта. Если SHA-256 файла
+    совпадает с known_sha256, книга не разбирается и возвращаются только сведения о файле.
+    """
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        content = f.read()
+    sha256 = hashlib.sha256(content).hexdigest()
+    stem = os.path.splitext(os.path.basename(path))[0]
+    result = {
+        "path": path,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha256": sha256,
+        # Книги нового архива названы по request_id, старые адресуются по содержимому
+        "request_id": stem if _ARCHIVE_NAME_RE.fullmatch(stem) else f"legacy-{sha256[:32]}",
+    }
+    if sha256 == known_sha256:
+        return result
+    header = [None] * 5
+    positions = []
+    try:
+        for number, row in iter_sheet_rows(content):
+            if 2 <= number <= 6:
+                header[number - 2] = _header_value(row)
+                continue
+            if number < 9:
+                continue
+            # Позиции идут подряд с 9-й строки; первая пустая строка завершает таблицу
+            if number != 9 + len(positions) or (row[0] is None and row[1] is None):
+                break
+            delivery_date = _parse_date(row[4]) if row[4] else None
+            positions.append({
+                "name": str(row[1]) if row[1] is not None else None,
+                "unit": row[2],
+                "quantity": _parse_quantity(row[3]),
+                "module": str(row[5]) if row[5] is not None else None,
+                "delivery_date": delivery_date.isoformat() if delivery_date else None,
+                "link": row[6],
+            })
     except Exception as e:
-        logger.error(f"Ошибка при отправке письма: {e}")
-        raise
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+    submitted = _parse_date(header[0]) if header[0] else None
+    result.update(
+        project=header[1],
+        object=header[2],
+        user_full_name=header[3],
+        telegram_id_or_username=str(header[4]) if header[4] is not None else None,
+        submitted_at=time.mktime(submitted.timetuple()) if submitted else stat.st_mtime,
+        positions=positions,
+    )
+    return result
+
+def import_archive(root=ARCHIVE_DIR, workers=None, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Загружает в историю заявок книги из каталога архива (включая старые файлы out/).
+    Книги разбираются параллельно в пуле процессов, результаты сохраняются пачками,
+    поэтому прерванный импорт продолжается с места остановки. Файлы с теми же mtime
+    и размером пропускаются без чтения, с тем же SHA-256 — без разбора.
+    Возвращает словарь со счётчиками и временем работы.
+    """
+    started = time.perf_counter()
+    known = request_history.imported_files()
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith(".xlsx"):
+                paths.append(os.path.join(dirpath, name))
+    stats = {"found": len(paths), "imported": 0, "unchanged": 0, "failed": 0, "positions": 0}
+    pending = []
+    for path in paths:
+        stat = os.stat(path)
+        previous = known.get(path)
+        if previous and previous[:2] == (stat.st_mtime_ns, stat.st_size):
+            stats["unchanged"] += 1
+        else:
+            pending.append((path, previous[2] if previous else None))
+
+    batch = []
+
+    def flush():
+        request_history.record_imported(batch)
+        batch.clear()
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        chunksize = max(1, len(pending) // (workers * 8))
+        pending_paths = [path for path, _ in pending]
+        known_hashes = [sha256 for _, sha256 in pending]
+        for result in executor.map(parse_request_workbook, pending_paths, known_hashes, chunksize=chunksize):
+            if "error" in result:
+                stats["failed"] += 1
+                logger.warning("Import: не удалось разобрать %s: %s", result["path"], result["error"])
+                continue
+            if "positions" in result:
+                stats["imported"] += 1
+                stats["positions"] += len(result["positions"])
+            else:
+                stats["unchanged"] += 1
+            batch.append(result)
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+    stats["seconds"] = time.perf_counter() - started
+    return stats
+
+# --- ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ---
+
+class ChatSerialUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления разных чатов параллельно, а обновления одного чата — строго по очереди.
+    Обработчики свободно меняют user_state[chat_id] и состояние ConversationHandler,
+    не опасаясь гонок с соседним нажатием кнопки в том же чате.
+
+    Общее ограничение параллельности применяется уже после блокировки чата, чтобы обновления,
+    ожидающие своей очереди в одном чате, не занимали места обновлений других чатов.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        self._limit = max_concurrent_updates
+        # Семафор базового класса фактически отключаем: ограничение держит self._slots
+        super().__init__(sys.maxsize)
+        self._slots = None
+        self._chat_locks = {} # chat_id -> [asyncio.Lock, число ожидающих обновлений]
+
+    @property
+    def max_concurrent_updates(self):
+        return self._limit
+
+    async def initialize(self):
+        self._slots = asyncio.BoundedSemaphore(self._limit)
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        async with self.chat_lock(chat.id):
+            async with self._slots:
+                await coroutine
+
+    @contextlib.asynccontextmanager
+    async def chat_lock(self, chat_id):
+        """
+        Занимает очередь чата. Фоновые задачи (например, удаление черновика) выполняются
+        внутри неё между обновлениями чата, а не посреди обработчика, ожидающего сеть.
+        """
+        entry = self._chat_locks.get(chat_id)
+        if entry is None:
+            entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat_id]
 
 # === Telegram Handlers ===
 
@@ -192,8 +2839,7 @@ async def initial_message_handler(update: Update, context: ContextTypes.DEFAULT_
     Обрабатывает первое сообщение от пользователя (или когда диалог неактивен)
     и предлагает кнопку "Создать заявку".
     """
-    keyboard = [[KeyboardButton("Создать заявку")]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
+    reply_markup = keyboards.create_request
     await update.message.reply_text(
         "Привет! Я бот для создания заявок. Нажмите кнопку, чтобы начать.",
         reply_markup=reply_markup
@@ -212,21 +2858,14 @@ async def start_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_full_name = f"{first_name} {last_name}".strip()
     telegram_id_or_username = user.username if user.username else str(user.id)
 
-    user_state[chat_id] = {
-        "user_full_name": user_full_name,
-        "telegram_id_or_username": telegram_id_or_username,
-        "project": None,
-        "object": None,
-        "positions": [], # Позиции теперь могут содержать 'link' и 'file_data'
-    }
-    logger.info(f"User {user_full_name} ({telegram_id_or_username}) started conversation.")
+    request_id = uuid.uuid4().hex
+    user_state[chat_id] = Draft(user_full_name=user_full_name, telegram_id_or_username=telegram_id_or_username, request_id=request_id)
+    tracer.adopt(request_id)
+    logger.info("User %s (%s) started conversation, request %s.", user_full_name, telegram_id_or_username, request_id)
 
     await update.message.reply_text("Начинаем создание заявки...", reply_markup=ReplyKeyboardRemove())
 
-    keyboard = [[InlineKeyboardButton(p, callback_data=p)] for p in projects]
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Выберите проект:", reply_markup=reply_markup)
+    await update.message.reply_text("Выберите проект:", reply_markup=keyboards.projects)
     return PROJECT
 
 async def project_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -234,13 +2873,10 @@ async def project_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    user_state[query.message.chat.id]["project"] = query.data
-    logger.info(f"Chat {query.message.chat.id}: Project selected - {query.data}")
+    user_state[query.message.chat.id].project = query.data
+    logger.info("Chat %s: Project selected - %s", query.message.chat.id, query.data)
 
-    keyboard = [[InlineKeyboardButton(o, callback_data=o)] for o in objects]
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Выберите объект:", reply_markup=reply_markup)
+    await query.edit_message_text("Выберите объект:", reply_markup=keyboards.objects)
     return OBJECT
 
 async def object_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -248,20 +2884,17 @@ async def object_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    user_state[query.message.chat.id]["object"] = query.data
-    logger.info(f"Chat {query.message.chat.id}: Object selected - {query.data}")
+    user_state[query.message.chat.id].object = query.data
+    logger.info("Chat %s: Object selected - %s", query.message.chat.id, query.data)
     await query.edit_message_text("Введите наименование позиции:")
     return NAME
 
 async def name_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает наименование позиции и предлагает выбрать единицу измерения."""
-    user_state[update.effective_chat.id]["current"] = {"name": update.message.text}
-    logger.info(f"Chat {update.effective_chat.id}: Position name entered - {update.message.text}")
+    user_state[update.effective_chat.id].current = Position(name=update.message.text)
+    logger.info("Chat %s: Position name entered - %s", update.effective_chat.id, update.message.text)
 
-    keyboard = [[InlineKeyboardButton(u, callback_data=u)] for u in units]
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Выберите единицу измерения:", reply_markup=reply_markup)
+    await update.message.reply_text("Выберите единицу измерения:", reply_markup=keyboards.units)
     return UNIT
 
 async def unit_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -269,8 +2902,8 @@ async def unit_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    user_state[query.message.chat.id]["current"]["unit"] = query.data
-    logger.info(f"Chat {query.message.chat.id}: Unit selected - {query.data}")
+    user_state[query.message.chat.id].current.unit = query.data
+    logger.info("Chat %s: Unit selected - %s", query.message.chat.id, query.data)
     await query.edit_message_text("Введите количество:")
     return QUANTITY
 
@@ -279,24 +2912,14 @@ async def quantity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     try:
         quantity = float(update.message.text)
-        user_state[chat_id]["current"]["quantity"] = quantity
-        logger.info(f"Chat {chat_id}: Quantity entered - {quantity}")
+        user_state[chat_id].current.quantity = quantity
+        logger.info("Chat %s: Quantity entered - %s", chat_id, quantity)
     except ValueError:
-        logger.warning(f"Chat {chat_id}: Invalid quantity format - '{update.message.text}'")
+        logger.warning("Chat %s: Invalid quantity format - '%s'", chat_id, update.message.text)
         await update.message.reply_text("Неверный формат количества. Пожалуйста, введите число (например, 5 или 3.5):")
         return QUANTITY
 
-    buttons_per_row = 5
-    keyboard = []
-    current_row = []
-    for i, m in enumerate(modules):
-        current_row.append(InlineKeyboardButton(m, callback_data=m))
-        if (i + 1) % buttons_per_row == 0 or (i + 1) == len(modules):
-            keyboard.append(current_row)
-            current_row = []
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("К какому модулю относится позиция?", reply_markup=reply_markup)
+    await update.message.reply_text("К какому модулю относится позиция?", reply_markup=keyboards.modules)
     return MODULE
 
 async def module_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -307,8 +2930,8 @@ async def module_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     chat_id = query.message.chat.id
-    user_state[chat_id]["current"]["module"] = query.data # Сохраняем модуль
-    logger.info(f"Chat {chat_id}: Module selected - {query.data}. Requesting delivery date for this position.")
+    user_state[chat_id].current.module = query.data # Сохраняем модуль
+    logger.info("Chat %s: Module selected - %s. Requesting delivery date for this position.", chat_id, query.data)
 
     # Переходим к выбору даты поставки для текущей позиции
     current_date = date.today()
@@ -348,27 +2971,19 @@ async def process_position_calendar_callback(update: Update, context: ContextTyp
         selected_date_str = data.replace("POS_CAL_DATE_", "")
 
         # Сохраняем дату в текущей позиции, но еще не добавляем в список позиций
-        user_state[chat_id]["current"]["delivery_date"] = selected_date_str
-        logger.info(f"Chat {chat_id}: Position delivery date selected - {selected_date_str}. Now asking about attachments.")
+        user_state[chat_id].current.delivery_date = date.fromisoformat(selected_date_str)
+        logger.info("Chat %s: Position delivery date selected - %s. Now asking about attachments.", chat_id, selected_date_str)
 
         # Предлагаем варианты прикрепления
-        keyboard = [
-            [InlineKeyboardButton("Прикрепить файл", callback_data="attach_file")],
-            [InlineKeyboardButton("Прикрепить ссылку", callback_data="attach_link")],
-            [InlineKeyboardButton("Продолжить без вложений", callback_data="no_attachment")]
-        ]
-        keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Теперь вы можете прикрепить файл или ссылку к этой позиции:", reply_markup=reply_markup)
+        await query.edit_message_text("Теперь вы можете прикрепить файл или ссылку к этой позиции:", reply_markup=keyboards.attachment_choice)
         return ATTACHMENT_CHOICE # Переход в новое состояние
 
     elif data == "POS_CAL_CANCEL":
-        logger.info(f"Chat {chat_id}: Position calendar date selection cancelled.")
+        logger.info("Chat %s: Position calendar date selection cancelled.", chat_id)
         # Если пользователь отменяет выбор даты для позиции,
         # текущая неполная позиция должна быть удалена,
         # и пользователь возвращается в меню редактирования.
-        if "current" in user_state[chat_id]:
-            del user_state[chat_id]["current"]
+        user_state[chat_id].current = None
         await query.edit_message_text("Выбор даты для позиции отменен. Вы можете добавить позицию снова или продолжить.")
         return await edit_menu_handler(update, context) # Вернуться в меню редактирования
 
@@ -385,23 +3000,20 @@ async def attachment_choice_handler(update: Update, context: ContextTypes.DEFAUL
 
     if data == "attach_file":
         await query.edit_message_text("Пожалуйста, **отправьте мне файл** (как документ) для этой позиции.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=keyboards.cancel)
         return FILE_INPUT
     elif data == "attach_link":
         await query.edit_message_text("Пожалуйста, **введите ссылку** для этой позиции.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=keyboards.cancel)
         return LINK_INPUT
     elif data == "no_attachment":
         # Добавляем текущую позицию в список позиций, т.к. вложений не будет
-        user_state[chat_id]["positions"].append(user_state[chat_id]["current"])
-        logger.info(f"Chat {chat_id}: Position added without attachments: {user_state[chat_id]['current']}")
-        del user_state[chat_id]["current"] # Очищаем current после добавления
+        draft = user_state[chat_id]
+        draft.positions.append(draft.current)
+        logger.info("Chat %s: Position added without attachments: %s", chat_id, draft.current)
+        draft.current = None # Очищаем current после добавления
 
-        keyboard = [
-            [InlineKeyboardButton("Да", callback_data="yes"), InlineKeyboardButton("Нет", callback_data="no")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Позиция добавлена. Добавить ещё позицию?", reply_markup=reply_markup)
+        await query.edit_message_text("Позиция добавлена. Добавить ещё позицию?", reply_markup=keyboards.add_more)
         return CONFIRM_ADD_MORE
     else:
         await query.edit_message_text("Неизвестный выбор.")
@@ -415,29 +3027,24 @@ async def handle_file_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if update.message.document:
         document = update.message.document
-        user_state[chat_id]["current"]["file_data"] = {
-            'file_id': document.file_id,
-            'file_name': document.file_name,
-            'mime_type': document.mime_type
-        }
-        logger.info(f"Chat {chat_id}: File '{document.file_name}' attached to current position.")
+        user_state[chat_id].current.file_data = FileData(
+            file_id=document.file_id,
+            file_unique_id=document.file_unique_id,
+            file_name=document.file_name,
+            mime_type=document.mime_type
+        )
+        state = user_state[chat_id]
+        attachment_prefetcher.schedule(context.bot, spool_owner(chat_id, state.request_id), state.current.file_data)
+        logger.info("Chat %s: File '%s' attached to current position.", chat_id, document.file_name)
         await update.message.reply_text(f"Файл '{document.file_name}' успешно прикреплен.")
     else:
-        logger.warning(f"Chat {chat_id}: Expected document but received something else for file input.")
+        logger.warning("Chat %s: Expected document but received something else for file input.", chat_id)
         await update.message.reply_text("Это не похоже на файл-документ. Пожалуйста, отправьте файл (документ).")
         return FILE_INPUT # Stay in state if not a document
 
     # После прикрепления файла, предлагаем прикрепить ссылку или продолжить
-    keyboard = []
-    current_pos_data = user_state[chat_id]["current"]
-    
     # Если ссылка еще не прикреплена, предлагаем прикрепить ссылку
-    if not current_pos_data.get('link'):
-        keyboard.append([InlineKeyboardButton("Прикрепить ссылку", callback_data="attach_link")])
-    
-    keyboard.append([InlineKeyboardButton("Продолжить без вложений", callback_data="no_attachment")])
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = keyboards.after_attachment if user_state[chat_id].current.link else keyboards.after_file
 
     await update.message.reply_text("Что дальше?", reply_markup=reply_markup)
     return ATTACHMENT_CHOICE
@@ -450,25 +3057,17 @@ async def handle_link_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     link = update.message.text.strip()
 
     if link.startswith("http://") or link.startswith("https://"):
-        user_state[chat_id]["current"]["link"] = link
-        logger.info(f"Chat {chat_id}: Link '{link}' attached to current position.")
+        user_state[chat_id].current.link = link
+        logger.info("Chat %s: Link '%s' attached to current position.", chat_id, link)
         await update.message.reply_text(f"Ссылка '{link}' успешно прикреплена.")
     else:
-        logger.warning(f"Chat {chat_id}: Invalid link format for link input - '{link}'")
+        logger.warning("Chat %s: Invalid link format for link input - '%s'", chat_id, link)
         await update.message.reply_text("Пожалуйста, введите корректную ссылку, начинающуюся с http:// или https://.")
         return LINK_INPUT # Stay in state if invalid link
 
     # После прикрепления ссылки, предлагаем прикрепить файл или продолжить
-    keyboard = []
-    current_pos_data = user_state[chat_id]["current"]
-
     # Если файл еще не прикреплен, предлагаем прикрепить файл
-    if not current_pos_data.get('file_data'):
-        keyboard.append([InlineKeyboardButton("Прикрепить файл", callback_data="attach_file")])
-    
-    keyboard.append([InlineKeyboardButton("Продолжить без вложений", callback_data="no_attachment")])
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = keyboards.after_attachment if user_state[chat_id].current.file_data else keyboards.after_link
 
     await update.message.reply_text("Что дальше?", reply_markup=reply_markup)
     return ATTACHMENT_CHOICE
@@ -476,43 +3075,73 @@ async def handle_link_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- ОБРАБОТЧИКИ ДЛЯ РЕДАКТИРОВАНИЯ ---
 
-def get_positions_summary(positions):
-    """Формирует читаемую сводку позиций, включая прикрепленные ссылки и файлы."""
+def summary_page_count(positions):
+    """Число страниц сводки; пустая заявка занимает одну страницу."""
+    return max(1, -(-len(positions) // SUMMARY_PAGE_SIZE))
+
+def clamp_summary_page(positions, page):
+    """Приводит номер страницы к допустимому: после удаления позиций страниц может стать меньше."""
+    return min(max(page, 0), summary_page_count(positions) - 1)
+
+def get_positions_summary(positions, page=0):
+    """
+    Формирует читаемую сводку позиций страницы page, включая прикрепленные ссылки и файлы.
+    Строки позиций берутся из кэша Position.summary(), поэтому листание не пересобирает всю заявку.
+    """
     if not positions:
         return "Позиции отсутствуют."
-    summary_lines = []
-    for i, p in enumerate(positions):
-        line = (
-            f"{i+1}. Модуль: {p.get('module', 'N/A')} | Наименование: {p.get('name', 'N/A')} | "
-            f"Ед.изм.: {p.get('unit', 'N/A')} | Количество: {p.get('quantity', 'N/A')} | "
-            f"Дата поставки: {p.get('delivery_date', 'N/A')}"
-        )
-        if p.get('link'):
-            line += f" | Ссылка: {p['link']}"
-        if p.get('file_data'):
-            line += f" | Файл: {p['file_data'].get('file_name', 'N/A')}"
-        summary_lines.append(line)
-    return "\n".join(summary_lines)
+    page = clamp_summary_page(positions, page)
+    first = page * SUMMARY_PAGE_SIZE
+    last = min(first + SUMMARY_PAGE_SIZE, len(positions))
+    lines = []
+    for i in range(first, last):
+        line = format_position_line(i, positions[i])
+        lines.append(line if len(line) <= SUMMARY_LINE_MAX else line[:SUMMARY_LINE_MAX - 1] + "…")
+    pages = summary_page_count(positions)
+    if pages > 1:
+        lines.append(f"(позиции {first + 1}–{last} из {len(positions)}, страница {page + 1}/{pages})")
+    return "\n".join(lines)
+
+def summary_page_buttons(positions, page, prefix="summary_page_"):
+    """Ряд кнопок листания сводки; пустой, если все позиции помещаются на одну страницу."""
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"{prefix}{page - 1}"))
+    if page < summary_page_count(positions) - 1:
+        buttons.append(InlineKeyboardButton("Вперёд ▶️", callback_data=f"{prefix}{page + 1}"))
+    return buttons
+
+def with_summary_pages(markup, positions, page):
+    """Добавляет к готовой клавиатуре ряд листания; при одной странице возвращает её без изменений."""
+    buttons = summary_page_buttons(positions, page)
+    if not buttons:
+        return markup
+    return InlineKeyboardMarkup([buttons] + list(markup.inline_keyboard))
+
+def requested_summary_page(update, prefix="summary_page_"):
+    """Номер страницы из нажатой кнопки листания или None, если нажата другая кнопка."""
+    query = update.callback_query
+    if query and query.data and query.data.startswith(prefix):
+        return int(query.data.removeprefix(prefix))
+    return None
 
-async def edit_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def edit_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, notice=None, page=None):
     """
     Отображает сводку текущих позиций и предлагает опции редактирования/удаления/продолжения.
+    `notice` выводится над сводкой, `page` - страница сводки (по умолчанию из кнопки листания или первая).
     """
     chat_id = update.effective_chat.id
-    state = user_state.get(chat_id, {})
-    positions = state.get("positions", [])
+    state = user_state.get(chat_id)
+    positions = state.positions if state else []
+    if page is None:
+        page = requested_summary_page(update) or 0
+    page = clamp_summary_page(positions, page)
 
-    summary_text = f"Текущие позиции в заявке:\n{get_positions_summary(positions)}\n\n"
+    summary_text = f"Текущие позиции в заявке:\n{get_positions_summary(positions, page)}\n\n"
+    if notice:
+        summary_text = f"{notice}\n\n{summary_text}"
 
-    keyboard = []
-    if positions:
-        keyboard.append([InlineKeyboardButton("Редактировать позицию", callback_data="edit_pos")])
-        keyboard.append([InlineKeyboardButton("Удалить позицию", callback_data="delete_pos")])
-
-    keyboard.append([InlineKeyboardButton("Продолжить", callback_data="continue_final_confirm")])
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = with_summary_pages(keyboards.edit_menu, positions, page) if positions else keyboards.continue_or_cancel
 
     if update.callback_query:
         await update.callback_query.answer()
@@ -525,38 +3154,49 @@ async def edit_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def select_position_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Предлагает пользователю выбрать позицию по номеру для редактирования или удаления.
+    Кнопки выбора показываются только для позиций текущей страницы сводки.
     """
     query = update.callback_query
     await query.answer()
 
     chat_id = query.message.chat.id
-    action = query.data
-    user_state[chat_id]['action_type'] = action
-
-    positions = user_state[chat_id].get("positions", [])
+    page = requested_summary_page(update, "select_page_")
+    if page is None:
+        # Нажата «Редактировать»/«Удалить»; при листании действие остаётся прежним
+        user_state[chat_id].action_type = query.data
+        page = 0
+    action = user_state[chat_id].action_type
+
+    positions = user_state[chat_id].positions
     if not positions:
         await query.edit_message_text("В заявке нет позиций для редактирования или удаления. "
                                       "Нажмите 'Продолжить' или 'Отмена заявки'.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Продолжить", callback_data="continue_final_confirm")],
-                                                                         [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=keyboards.continue_or_cancel)
         return EDIT_MENU # Возвращаемся в EDIT_MENU
 
+    page = clamp_summary_page(positions, page)
+    first = page * SUMMARY_PAGE_SIZE
+    last = min(first + SUMMARY_PAGE_SIZE, len(positions))
+
     keyboard = []
     buttons_per_row = 5
     current_row = []
-    for i in range(len(positions)):
+    for i in range(first, last):
         button_text = f"{i+1}"
         current_row.append(InlineKeyboardButton(button_text, callback_data=f"select_pos_{i}"))
-        if (i + 1) % buttons_per_row == 0 or (i + 1) == len(positions):
+        if (i - first + 1) % buttons_per_row == 0 or (i + 1) == last:
             keyboard.append(current_row)
             current_row = []
 
+    page_buttons = summary_page_buttons(positions, page, "select_page_")
+    if page_buttons:
+        keyboard.append(page_buttons)
     keyboard.append([InlineKeyboardButton("Назад в меню", callback_data="back_to_edit_menu")])
     keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text(f"Выберите номер позиции для { 'редактирования' if action == 'edit_pos' else 'удаления' }:\n"
-                                  f"{get_positions_summary(positions)}", reply_markup=reply_markup)
+                                  f"{get_positions_summary(positions, page)}", reply_markup=reply_markup)
 
     return SELECT_POSITION
 
@@ -576,34 +3216,34 @@ async def process_selected_position(update: Update, context: ContextTypes.DEFAUL
         selected_index = int(query.data.split('_')[2])
     except (IndexError, ValueError):
         await query.edit_message_text("Неверный выбор позиции. Пожалуйста, попробуйте снова.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад в меню", callback_data="back_to_edit_menu")],
-                                                                         [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=keyboards.back_or_cancel)
         return SELECT_POSITION # Остаемся в SELECT_POSITION
 
-    positions = user_state[chat_id].get("positions", [])
+    positions = user_state[chat_id].positions
     if selected_index < 0 or selected_index >= len(positions):
         await query.edit_message_text("Выбрана несуществующая позиция. Пожалуйста, выберите номер из списка.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад в меню", callback_data="back_to_edit_menu")],
-                                                                         [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=keyboards.back_or_cancel)
         return SELECT_POSITION
 
-    action_type = user_state[chat_id].get('action_type')
+    action_type = user_state[chat_id].action_type
 
     if action_type == 'delete_pos':
         deleted_pos = positions.pop(selected_index)
-        logger.info(f"Chat {chat_id}: Position deleted - {deleted_pos.get('name', '')}")
-        await query.edit_message_text(f"Позиция '{deleted_pos.get('name', '')}' удалена.\n\n"
-                                      f"Текущие позиции:\n{get_positions_summary(positions)}")
-        return await edit_menu_handler(update, context)
+        state = user_state[chat_id]
+        attachment_prefetcher.discard_positions(spool_owner(chat_id, state.request_id), [deleted_pos],
+                                                keep=positions + [state.current])
+        logger.info("Chat %s: Position deleted - %s", chat_id, deleted_pos.name or '')
+        # Показываем меню на той же странице, где была удалённая позиция
+        return await edit_menu_handler(update, context, notice=f"Позиция '{deleted_pos.name or ''}' удалена.",
+                                       page=selected_index // SUMMARY_PAGE_SIZE)
     elif action_type == 'edit_pos':
-        user_state[chat_id]['editing_position_index'] = selected_index
-        logger.info(f"Chat {chat_id}: Editing position index - {selected_index}")
+        user_state[chat_id].editing_position_index = selected_index
+        logger.info("Chat %s: Editing position index - %s", chat_id, selected_index)
         return await edit_field_selection_handler(update, context)
     else:
-        logger.warning(f"Chat {chat_id}: Unknown action type in process_selected_position - {action_type}")
+        logger.warning("Chat %s: Unknown action type in process_selected_position - %s", chat_id, action_type)
         await query.edit_message_text("Неизвестное действие. Пожалуйста, попробуйте снова.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад в меню", callback_data="back_to_edit_menu")],
-                                                                         [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+                                      reply_markup=keyboards.back_or_cancel)
         return await edit_menu_handler(update, context)
 
 async def edit_field_selection_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -615,37 +3255,25 @@ async def edit_field_selection_handler(update: Update, context: ContextTypes.DEF
     if query: await query.answer()
 
     chat_id = update.effective_chat.id
-    selected_index = user_state[chat_id]['editing_position_index']
-    current_pos = user_state[chat_id]['positions'][selected_index]
+    selected_index = user_state[chat_id].editing_position_index
+    current_pos = user_state[chat_id].positions[selected_index]
 
     summary_pos = (
         f"Редактирование позиции №{selected_index+1}:\n"
-        f"Модуль: {current_pos.get('module', 'N/A')}\n"
-        f"Наименование: {current_pos.get('name', 'N/A')}\n"
-        f"Ед.изм.: {current_pos.get('unit', 'N/A')}\n"
-        f"Количество: {current_pos.get('quantity', 'N/A')}\n"
-        f"Дата поставки: {current_pos.get('delivery_date', 'N/A')}\n"
+        f"Модуль: {current_pos.module or 'N/A'}\n"
+        f"Наименование: {current_pos.name or 'N/A'}\n"
+        f"Ед.изм.: {current_pos.unit or 'N/A'}\n"
+        f"Количество: {current_pos.quantity if current_pos.quantity is not None else 'N/A'}\n"
+        f"Дата поставки: {current_pos.delivery_date or 'N/A'}\n"
     )
-    if current_pos.get('link'):
-        summary_pos += f"Ссылка: {current_pos['link']}\n"
-    if current_pos.get('file_data'):
-        summary_pos += f"Файл: {current_pos['file_data'].get('file_name', 'N/A')}\n"
+    if current_pos.link:
+        summary_pos += f"Ссылка: {current_pos.link}\n"
+    if current_pos.file_data:
+        summary_pos += f"Файл: {current_pos.file_data.file_name or 'N/A'}\n"
     summary_pos += "\n"
 
 
-    keyboard = [
-        [InlineKeyboardButton("Наименование", callback_data="edit_field_name")],
-        [InlineKeyboardButton("Ед. изм.", callback_data="edit_field_unit")],
-        [InlineKeyboardButton("Количество", callback_data="edit_field_quantity")],
-        [InlineKeyboardButton("Модуль", callback_data="edit_field_module")],
-        [InlineKeyboardButton("Дата поставки", callback_data="edit_field_delivery_date")],
-        # Новые кнопки для прикрепления/изменения ссылки и файла к позиции
-        [InlineKeyboardButton("Прикрепить/Изменить файл", callback_data="edit_field_attach_file")],
-        [InlineKeyboardButton("Прикрепить/Изменить ссылку", callback_data="edit_field_attach_link")],
-        [InlineKeyboardButton("Назад в меню", callback_data="back_to_edit_menu")],
-        [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = keyboards.edit_fields
 
     if query:
         await query.edit_message_text(summary_pos + "Выберите поле для редактирования:", reply_markup=reply_markup)
@@ -666,8 +3294,8 @@ async def edit_field_input_handler(update: Update, context: ContextTypes.DEFAULT
         query = update.callback_query
         await query.answer()
         editing_field = query.data.replace("edit_field_", "")
-        current_state_data['editing_field'] = editing_field
-        logger.info(f"Chat {chat_id}: Editing field set to {editing_field}")
+        current_state_data.editing_field = editing_field
+        logger.info("Chat %s: Editing field set to %s", chat_id, editing_field)
 
         if editing_field == 'delivery_date':
             current_date = date.today()
@@ -675,29 +3303,16 @@ async def edit_field_input_handler(update: Update, context: ContextTypes.DEFAULT
             await query.edit_message_text("Выберите новую дату поставки:", reply_markup=reply_markup)
             return GLOBAL_DELIVERY_DATE_SELECTION
         elif editing_field == 'unit':
-            keyboard = [[InlineKeyboardButton(u, callback_data=f"edit_unit_{u}")] for u in units]
-            keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Выберите новую единицу измерения:", reply_markup=reply_markup)
+            await query.edit_message_text("Выберите новую единицу измерения:", reply_markup=keyboards.edit_units)
             return EDITING_UNIT # Новое состояние
         elif editing_field == 'module':
-            buttons_per_row = 5
-            keyboard = []
-            current_row = []
-            for i, m in enumerate(modules):
-                current_row.append(InlineKeyboardButton(m, callback_data=f"edit_module_{m}"))
-                if (i + 1) % buttons_per_row == 0 or (i + 1) == len(modules):
-                    keyboard.append(current_row)
-                    current_row = []
-            keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Выберите новый модуль:", reply_markup=reply_markup)
+            await query.edit_message_text("Выберите новый модуль:", reply_markup=keyboards.edit_modules)
             return EDITING_MODULE # Новое состояние
         elif editing_field == 'attach_file':
-            await query.edit_message_text("Пожалуйста, **отправьте мне файл** (как документ) для этой позиции.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+            await query.edit_message_text("Пожалуйста, **отправьте мне файл** (как документ) для этой позиции.", reply_markup=keyboards.cancel)
             return EDIT_FIELD_INPUT # Ждем файл
         elif editing_field == 'attach_link':
-            await query.edit_message_text("Пожалуйста, **введите ссылку** для этой позиции.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]]))
+            await query.edit_message_text("Пожалуйста, **введите ссылку** для этой позиции.", reply_markup=keyboards.cancel)
             return EDIT_FIELD_INPUT # Ждем ссылку
         else: # name or quantity
             field_name_ru = {
@@ -708,55 +3323,62 @@ async def edit_field_input_handler(update: Update, context: ContextTypes.DEFAULT
             return EDIT_FIELD_INPUT
 
     # Обработка ввода (текст или файл)
-    editing_position_index = current_state_data['editing_position_index']
-    editing_field = current_state_data['editing_field']
-    current_position = current_state_data['positions'][editing_position_index]
+    editing_position_index = current_state_data.editing_position_index
+    editing_field = current_state_data.editing_field
+    current_position = current_state_data.positions[editing_position_index]
 
     if editing_field == 'quantity':
         try:
             new_value = float(update.message.text)
-            current_position[editing_field] = new_value
-            logger.info(f"Chat {chat_id}: Position field '{editing_field}' updated to '{new_value}' for index {editing_position_index}")
+            current_position.quantity = new_value
+            logger.info("Chat %s: Position field '%s' updated to '%s' for index %s", chat_id, editing_field, new_value, editing_position_index)
             await update.message.reply_text(f"Поле '{editing_field}' обновлено.")
             return await edit_menu_handler(update, context)
         except ValueError:
-            logger.warning(f"Chat {chat_id}: Invalid quantity format for edit - '{update.message.text}'")
+            logger.warning("Chat %s: Invalid quantity format for edit - '%s'", chat_id, update.message.text)
             await update.message.reply_text("Неверный формат количества. Пожалуйста, введите число (например, 5 или 3.5):")
             return EDIT_FIELD_INPUT
     elif editing_field == 'name':
         new_value = update.message.text.strip()
-        current_position[editing_field] = new_value
-        logger.info(f"Chat {chat_id}: Position field '{editing_field}' updated to '{new_value}' for index {editing_position_index}")
+        current_position.name = new_value
+        logger.info("Chat %s: Position field '%s' updated to '%s' for index %s", chat_id, editing_field, new_value, editing_position_index)
         await update.message.reply_text(f"Поле '{editing_field}' обновлено.")
         return await edit_menu_handler(update, context)
     elif editing_field == 'attach_file':
         if update.message.document:
             document = update.message.document
-            current_position['file_data'] = {
-                'file_id': document.file_id,
-                'file_name': document.file_name,
-                'mime_type': document.mime_type
-            }
-            logger.info(f"Chat {chat_id}: File '{document.file_name}' attached to position {editing_position_index}.")
+            owner = spool_owner(chat_id, user_state[chat_id].request_id)
+            if current_position.file_data:
+                # Старый файл больше не нужен, если он не прикреплён к другой позиции этой заявки
+                other_positions = [p for p in user_state[chat_id].positions if p is not current_position]
+                attachment_prefetcher.discard(owner, current_position.file_data, keep=other_positions)
+            current_position.file_data = FileData(
+                file_id=document.file_id,
+                file_unique_id=document.file_unique_id,
+                file_name=document.file_name,
+                mime_type=document.mime_type
+            )
+            attachment_prefetcher.schedule(context.bot, owner, current_position.file_data)
+            logger.info("Chat %s: File '%s' attached to position %s.", chat_id, document.file_name, editing_position_index)
             await update.message.reply_text(f"Файл '{document.file_name}' успешно прикреплен к позиции.")
             return await edit_menu_handler(update, context)
         else:
-            logger.warning(f"Chat {chat_id}: Expected document but received something else for attach_file.")
+            logger.warning("Chat %s: Expected document but received something else for attach_file.", chat_id)
             await update.message.reply_text("Это не похоже на файл-документ. Пожалуйста, отправьте файл (документ).")
             return EDIT_FIELD_INPUT # Остаемся в этом состоянии
     elif editing_field == 'attach_link':
         link = update.message.text.strip()
         if link.startswith("http://") or link.startswith("https://"):
-            current_position['link'] = link
-            logger.info(f"Chat {chat_id}: Link '{link}' attached to position {editing_position_index}.")
+            current_position.link = link
+            logger.info("Chat %s: Link '%s' attached to position %s.", chat_id, link, editing_position_index)
             await update.message.reply_text(f"Ссылка '{link}' успешно прикреплена к позиции.")
             return await edit_menu_handler(update, context)
         else:
-            logger.warning(f"Chat {chat_id}: Invalid link format for attach_link - '{link}'")
+            logger.warning("Chat %s: Invalid link format for attach_link - '%s'", chat_id, link)
             await update.message.reply_text("Пожалуйста, введите корректную ссылку, начинающуюся с http:// или https://.")
             return EDIT_FIELD_INPUT # Остаемся в этом состоянии
     else:
-        logger.warning(f"Chat {chat_id}: Unexpected field or input type in edit_field_input_handler: field={editing_field}, update.message={update.message}")
+        logger.warning("Chat %s: Unexpected field or input type in edit_field_input_handler: field=%s, update.message=%s", chat_id, editing_field, update.message)
         await update.message.reply_text("Произошла неизвестная ошибка при редактировании. Пожалуйста, попробуйте снова.")
         return await edit_menu_handler(update, context) # Вернуться в меню редактирования
 
@@ -770,9 +3392,9 @@ async def process_edited_unit_selection(update: Update, context: ContextTypes.DE
     chat_id = query.message.chat.id
     selected_unit = query.data.replace("edit_unit_", "")
 
-    editing_position_index = user_state[chat_id]['editing_position_index']
-    user_state[chat_id]['positions'][editing_position_index]['unit'] = selected_unit
-    logger.info(f"Chat {chat_id}: Position unit updated to '{selected_unit}' for index {editing_position_index}")
+    editing_position_index = user_state[chat_id].editing_position_index
+    user_state[chat_id].positions[editing_position_index].unit = selected_unit
+    logger.info("Chat %s: Position unit updated to '%s' for index %s", chat_id, selected_unit, editing_position_index)
 
     await query.edit_message_text(f"Единица измерения обновлена на '{selected_unit}'.")
     return await edit_menu_handler(update, context)
@@ -787,9 +3409,9 @@ async def process_edited_module_selection(update: Update, context: ContextTypes.
     chat_id = query.message.chat.id
     selected_module = query.data.replace("edit_module_", "")
 
-    editing_position_index = user_state[chat_id]['editing_position_index']
-    user_state[chat_id]['positions'][editing_position_index]['module'] = selected_module
-    logger.info(f"Chat {chat_id}: Position module updated to '{selected_module}' for index {editing_position_index}")
+    editing_position_index = user_state[chat_id].editing_position_index
+    user_state[chat_id].positions[editing_position_index].module = selected_module
+    logger.info("Chat %s: Position module updated to '%s' for index %s", chat_id, selected_module, editing_position_index)
 
     await query.edit_message_text(f"Модуль обновлен на '{selected_module}'.")
     return await edit_menu_handler(update, context)
@@ -805,28 +3427,37 @@ async def confirm_add_more_handler(update: Update, context: ContextTypes.DEFAULT
     chat_id = query.message.chat.id
 
     if query.data == "yes":
-        logger.info(f"Chat {chat_id}: User wants to add more positions.")
+        logger.info("Chat %s: User wants to add more positions.", chat_id)
         await query.edit_message_text("Введите наименование позиции:")
         return NAME
     else:
-        logger.info(f"Chat {chat_id}: User finished adding positions, proceeding to edit menu.")
+        logger.info("Chat %s: User finished adding positions, proceeding to edit menu.", chat_id)
         return await edit_menu_handler(update, context)
 
 # --- ОБРАБОТЧИКИ ДЛЯ КАЛЕНДАРЯ ---
 
-def create_calendar_keyboard(year, month, prefix="CAL_"):
+CALENDAR_MONTH_NAMES = {
+    "ru": ["", "Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+           "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"],
+}
+CALENDAR_PREFIXES = ("POS_CAL_", "EDIT_CAL_", "CAL_")
+
+def build_calendar_keyboard(year, month, prefix, locale, past_cutoff=0, mark_weekends=False):
     """
-    Генерирует Inline-клавиатуру для выбора даты.
-    `prefix` используется для создания уникальных callback_data,
-    например, "CAL_" для глобального выбора даты и "POS_CAL_" для даты позиции.
+    Строит Inline-клавиатуру календаря на месяц.
+    Дни с номером меньше `past_cutoff` считаются прошедшими и недоступны для выбора;
+    результат зависит только от аргументов, поэтому его можно кэшировать.
     """
+    month_names = CALENDAR_MONTH_NAMES.get(locale, calendar.month_name)
+    prev_year, prev_month = (year, month - 1) if month > 1 else (year - 1, 12)
+    next_year, next_month = (year, month + 1) if month < 12 else (year + 1, 1)
     keyboard = []
     # Ряд 1: Навигация по месяцам и годам
     keyboard.append([
         InlineKeyboardButton("<<", callback_data=f"{prefix}NAV_{year-1}_{month}"),
-        InlineKeyboardButton("<", callback_data=f"{prefix}NAV_{year}_{month-1 if month > 1 else 12}"),
-        InlineKeyboardButton(f"{calendar.month_name[month]} {year}", callback_data="ignore"),
-        InlineKeyboardButton(">", callback_data=f"{prefix}NAV_{year}_{month+1 if month < 12 else 1}"),
+        InlineKeyboardButton("<", callback_data=f"{prefix}NAV_{prev_year}_{prev_month}"),
+        InlineKeyboardButton(f"{month_names[month]} {year}", callback_data="ignore"),
+        InlineKeyboardButton(">", callback_data=f"{prefix}NAV_{next_year}_{next_month}"),
         InlineKeyboardButton(">>", callback_data=f"{prefix}NAV_{year+1}_{month}")
     ])
 
@@ -835,22 +3466,89 @@ def create_calendar_keyboard(year, month, prefix="CAL_"):
     keyboard.append([InlineKeyboardButton(day, callback_data="ignore") for day in weekdays])
 
     # Дни календаря
-    cal = calendar.Calendar()
-    for week in cal.monthdayscalendar(year, month):
+    for week in calendar.Calendar().monthdayscalendar(year, month):
         row = []
-        for day in week:
+        for weekday, day in enumerate(week):
             if day == 0:
                 row.append(InlineKeyboardButton(" ", callback_data="ignore"))
+            elif day < past_cutoff:
+                row.append(InlineKeyboardButton("·", callback_data="ignore"))
             else:
-                current_day = date(year, month, day)
-                row.append(InlineKeyboardButton(str(day), callback_data=f"{prefix}DATE_{current_day.isoformat()}"))
+                label = f"*{day}" if mark_weekends and weekday >= 5 else str(day)
+                row.append(InlineKeyboardButton(label, callback_data=f"{prefix}DATE_{year:04d}-{month:02d}-{day:02d}"))
         keyboard.append(row)
 
     keyboard.append([InlineKeyboardButton("Отмена выбора даты", callback_data=f"{prefix}CANCEL")])
-    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]) # Добавлена общая кнопка отмены
+    keyboard.append([InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]) # Общая кнопка отмены
 
     return InlineKeyboardMarkup(keyboard)
 
+class CalendarKeyboardCache:
+    """
+    LRU-кэш клавиатур-календарей с ключом (год, месяц, префикс, язык, граница прошедших дней).
+    Граница отличается от 0 только у текущего и прошедших месяцев, поэтому будущие месяцы
+    кэшируются без учёта даты, а при смене месяца кэш очищается и строится заново.
+    """
+
+    def __init__(self, maxsize=CALENDAR_CACHE_SIZE, locale=CALENDAR_LOCALE,
+                 block_past=CALENDAR_BLOCK_PAST, mark_weekends=CALENDAR_MARK_WEEKENDS):
+        self.maxsize = maxsize
+        self.locale = locale
+        self.block_past = block_past
+        self.mark_weekends = mark_weekends
+        self._cache = OrderedDict()
+        self._month = None
+        self.hits = 0
+        self.misses = 0
+
+    def _past_cutoff(self, year, month, today):
+        if not self.block_past or (year, month) > (today.year, today.month):
+            return 0
+        if (year, month) == (today.year, today.month):
+            return today.day
+        return 32 # Весь месяц в прошлом
+
+    def get(self, year, month, prefix="CAL_"):
+        """Возвращает клавиатуру из кэша, строя её при промахе."""
+        today = date.today()
+        if self._month != (today.year, today.month):
+            self.prewarm(today)
+        key = (year, month, prefix, self.locale, self._past_cutoff(year, month, today))
+        markup = self._cache.get(key)
+        if markup is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return markup
+        self.misses += 1
+        markup = build_calendar_keyboard(year, month, prefix, self.locale, key[4], self.mark_weekends)
+        self._cache[key] = markup
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return markup
+
+    def prewarm(self, today=None):
+        """Очищает кэш и строит календари текущего и CALENDAR_PREWARM_MONTHS следующих месяцев."""
+        today = today or date.today()
+        self._cache.clear()
+        self._month = (today.year, today.month)
+        year, month = today.year, today.month
+        for _ in range(CALENDAR_PREWARM_MONTHS + 1):
+            for prefix in CALENDAR_PREFIXES:
+                key = (year, month, prefix, self.locale, self._past_cutoff(year, month, today))
+                self._cache[key] = build_calendar_keyboard(year, month, prefix, self.locale, key[4], self.mark_weekends)
+            year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+        logger.info("Calendar cache warmed for %d-%02d: %s keyboards.", today.year, today.month, len(self._cache))
+
+calendar_keyboards = CalendarKeyboardCache()
+
+def create_calendar_keyboard(year, month, prefix="CAL_"):
+    """
+    Возвращает Inline-клавиатуру для выбора даты.
+    `prefix` используется для создания уникальных callback_data,
+    например, "CAL_" для глобального выбора даты и "POS_CAL_" для даты позиции.
+    """
+    return calendar_keyboards.get(year, month, prefix)
+
 
 async def request_global_delivery_date_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -900,11 +3598,11 @@ async def process_global_calendar_callback(update: Update, context: ContextTypes
     elif data.startswith("CAL_DATE_") or data.startswith("EDIT_CAL_DATE_"):
         selected_date_str = data.replace("CAL_DATE_", "").replace("EDIT_CAL_DATE_", "")
 
-        if user_state[chat_id].get('editing_field') == 'delivery_date':
+        if user_state[chat_id].editing_field == 'delivery_date':
             # Если это редактирование даты для конкретной позиции
-            editing_position_index = user_state[chat_id]['editing_position_index']
-            user_state[chat_id]['positions'][editing_position_index]['delivery_date'] = selected_date_str
-            logger.info(f"Chat {chat_id}: Position {editing_position_index} delivery date updated to {selected_date_str}")
+            editing_position_index = user_state[chat_id].editing_position_index
+            user_state[chat_id].positions[editing_position_index].delivery_date = date.fromisoformat(selected_date_str)
+            logger.info("Chat %s: Position %s delivery date updated to %s", chat_id, editing_position_index, selected_date_str)
             await query.edit_message_text(f"Дата поставки обновлена на {selected_date_str}.")
             # После редактирования возвращаемся в меню редактирования позиций
             return await edit_menu_handler(update, context)
@@ -916,7 +3614,7 @@ async def process_global_calendar_callback(update: Update, context: ContextTypes
         return await edit_menu_handler(update, context)
 
     elif data == "CAL_CANCEL" or data == "EDIT_CAL_CANCEL":
-        logger.info(f"Chat {chat_id}: Calendar date selection cancelled.")
+        logger.info("Chat %s: Calendar date selection cancelled.", chat_id)
         await query.edit_message_text("Выбор даты отменен.")
         # После отмены выбора даты, возвращаемся в меню редактирования
         return await edit_menu_handler(update, context)
@@ -932,23 +3630,23 @@ async def show_final_summary_and_confirm(update: Update, context: ContextTypes.D
     chat_id = update.effective_chat.id
     state = user_state[chat_id]
 
-    positions_summary = get_positions_summary(state["positions"])
+    page = requested_summary_page(update)
+    if page is not None:
+        await update.callback_query.answer()
+    page = clamp_summary_page(state.positions, page or 0)
+    positions_summary = get_positions_summary(state.positions, page)
 
     full_summary = (
-        f"Проект: {state['project']}\n"
-        f"Объект: {state['object']}\n"
-        f"От кого: {state.get('user_full_name', 'Неизвестно')}\n"
-        f"Telegram ID: {state.get('telegram_id_or_username', 'Неизвестно')}\n\n"
+        f"Проект: {state.project}\n"
+        f"Объект: {state.object}\n"
+        f"От кого: {state.user_full_name}\n"
+        f"Telegram ID: {state.telegram_id_or_username}\n\n"
         f"Позиции:\n{positions_summary}\n\n"
     )
 
     full_summary += "Отправить заявку на почту? (Да/Нет)"
 
-    keyboard = [
-        [InlineKeyboardButton("Да", callback_data="final_yes"), InlineKeyboardButton("Нет", callback_data="final_no")],
-        [InlineKeyboardButton("Отмена заявки", callback_data="cancel_dialog")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = with_summary_pages(keyboards.final_confirm, state.positions, page)
 
     if update.callback_query:
         await update.callback_query.edit_message_text(full_summary, reply_markup=reply_markup)
@@ -967,40 +3665,36 @@ async def final_confirm_handler(update: Update, context: ContextTypes.DEFAULT_TY
 
     if query.data == "final_yes":
         try:
-            email_sent = await send_email(
-                chat_id,
-                state["project"],
-                state["object"],
-                state["positions"],
-                state.get("user_full_name", "Неизвестно"),
-                state.get("telegram_id_or_username", "Неизвестно"),
-                context=context # Передаем context для скачивания файлов позиций
-            )
-            if email_sent:
-                await query.edit_message_text("Заявка успешно отправлена на почту!")
-            else:
-                await query.edit_message_text("Заявка отправлена, но возникли проблемы при отправке письма. Пожалуйста, проверьте логи.")
-
-            keyboard = [[KeyboardButton("Создать заявку")]]
-            reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
-            await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=reply_markup)
+            item_id = await asyncio.to_thread(mail_outbox.enqueue, chat_id, {
+                "project": state.project,
+                "object": state.object,
+                "positions": [p.to_dict() for p in state.positions],
+                "user_full_name": state.user_full_name,
+                "telegram_id_or_username": state.telegram_id_or_username,
+                "request_id": state.request_id,
+            })
+            metrics.inc("bot_requests_submitted_total")
+            metrics.observe("bot_request_positions", len(state.positions), buckets=COUNT_BUCKETS)
+            logger.info("Chat %s: Request %s queued for sending as outbox item %s.", chat_id, state.request_id, item_id)
+            await query.edit_message_text("Заявка принята и поставлена в очередь на отправку. Я сообщу, когда письмо уйдёт.")
+            # Запускаем отправку сразу, не дожидаясь очередного опроса очереди
+            context.job_queue.run_once(outbox_worker_job, 0)
+
+            await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=keyboards.create_request)
 
             if chat_id in user_state:
                 del user_state[chat_id]
         except Exception as e:
-            logger.error(f"Ошибка в final_confirm_handler: {e}")
+            logger.error("Ошибка в final_confirm_handler: %s", e)
             await query.edit_message_text(f"Произошла ошибка при отправке заявки: {e}\nПожалуйста, попробуйте еще раз позднее.")
-            keyboard = [[KeyboardButton("Создать заявку")]]
-            reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
-            await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=reply_markup)
+            await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=keyboards.create_request)
 
         return ConversationHandler.END
     else: # query.data == "final_no"
         await query.edit_message_text("Отправка заявки отменена.")
-        keyboard = [[KeyboardButton("Создать заявку")]]
-        reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
-        await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=reply_markup)
+        await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=keyboards.create_request)
         if chat_id in user_state:
+            discard_draft_attachments(chat_id, user_state[chat_id])
             del user_state[chat_id]
         return ConversationHandler.END
 
@@ -1020,25 +3714,104 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if query.message and query.message.reply_markup and query.message.reply_markup.inline_keyboard:
                 await query.edit_message_reply_markup(reply_markup=None)
         except Exception as e:
-            logger.warning(f"Failed to edit message to remove inline keyboard after cancel: {e}")
+            logger.warning("Failed to edit message to remove inline keyboard after cancel: %s", e)
 
     # После всего, отправляем новую кнопку "Создать заявку"
-    keyboard = [[KeyboardButton("Создать заявку")]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
+    reply_markup = keyboards.create_request
     await context.bot.send_message(chat_id=chat_id, text="Для создания новой заявки:", reply_markup=reply_markup)
 
     # Очищаем состояние пользователя
     if chat_id in user_state:
+        discard_draft_attachments(chat_id, user_state[chat_id])
         del user_state[chat_id]
-        logger.info(f"Chat {chat_id} state cleared after cancel.")
+        logger.info("Chat %s state cleared after cancel.", chat_id)
         
     return ConversationHandler.END
 
+def discard_draft_attachments(chat_id, state):
+    """Освобождает заранее скачанные файлы незавершённой заявки."""
+    owner = spool_owner(chat_id, state.request_id)
+    attachment_prefetcher.discard_positions(owner, state.positions)
+    if state.current:
+        attachment_prefetcher.discard_positions(owner, [state.current])
+
+# Причина удаления черновика -> текст уведомления пользователю
+EVICTION_MESSAGES = {
+    "idle timeout": "Черновик вашей заявки был удалён из-за долгого бездействия.",
+    "session limit reached": "Черновик вашей заявки был удалён: сейчас открыто слишком много незавершённых заявок, "
+                             "и ваша дольше всех не менялась.",
+}
+
+async def expire_draft(application, chat_id, reason):
+    """
+    Удаляет черновик заявки и вежливо сообщает пользователю причину (см. EVICTION_MESSAGES).
+    Диалог в ConversationHandler завершается при следующем обновлении из чата (см. MissingDraftHandler).
+    """
+    draft = user_state.evict(chat_id)
+    discard_draft_attachments(chat_id, draft)
+    logger.info("Chat %s: draft evicted (%s).", chat_id, reason)
+
+    reply_markup = keyboards.create_request
+    try:
+        await application.bot.send_message(
+            chat_id=chat_id,
+            text=f"{EVICTION_MESSAGES[reason]} Чтобы начать заново, нажмите «Создать заявку».",
+            reply_markup=reply_markup,
+        )
+    except Exception as e:
+        logger.warning("Chat %s: failed to notify about expired draft: %s", chat_id, e)
+
+class MissingDraftHandler(BaseHandler):
+    """
+    Срабатывает в любом состоянии диалога, если черновика чата уже нет в user_state
+    (его удалил сборщик черновиков или он потерялся при перезапуске). Ставится первым
+    в каждое состояние ConversationHandler, чтобы обработчики шагов не получили KeyError.
+    """
+
+    def check_update(self, update):
+        return isinstance(update, Update) and update.effective_chat is not None and update.effective_chat.id not in user_state
+
+async def missing_draft_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Завершает диалог без черновика; нажатие «Создать заявку» сразу начинает новую заявку."""
+    if update.message and update.message.text == "Создать заявку":
+        return await start_conversation(update, context)
+    if update.callback_query:
+        await update.callback_query.answer()
+    logger.info("Chat %s: conversation ended, its draft no longer exists.", update.effective_chat.id)
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text="Черновик этой заявки больше недоступен. Чтобы начать заново, нажмите «Создать заявку».",
+        reply_markup=keyboards.create_request,
+    )
+    return ConversationHandler.END
+
+async def session_sweeper_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Периодическая задача: удаляет черновики, простаивающие дольше SESSION_IDLE_TTL,
+    и вытесняет самые давние, если их больше SESSION_MAX_COUNT.
+    Черновик удаляется в очереди его чата, поэтому обработчик, который сейчас работает
+    с этим черновиком, доработает до конца; если за время ожидания очереди к черновику
+    обращались, он остаётся.
+    """
+    processor = context.application.update_processor
+    started = time.time()
+    for chat_id in user_state.idle_sessions(SESSION_IDLE_TTL):
+        async with processor.chat_lock(chat_id):
+            last_activity = user_state.last_activity(chat_id)
+            if last_activity is not None and time.time() - last_activity >= SESSION_IDLE_TTL:
+                await expire_draft(context.application, chat_id, "idle timeout")
+    for chat_id in user_state.lru_overflow(SESSION_MAX_COUNT):
+        async with processor.chat_lock(chat_id):
+            last_activity = user_state.last_activity(chat_id)
+            if last_activity is not None and last_activity < started:
+                await expire_draft(context.application, chat_id, "session limit reached")
+    logger.info("Sessions: %s live, %s evicted (%s bytes) since start.",
+                len(user_state), user_state.evicted_sessions, user_state.evicted_bytes)
+
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ответ на неизвестные команды или сообщения, не относящиеся к текущему диалогу."""
     chat_id = update.effective_chat.id
-    keyboard = [[KeyboardButton("Создать заявку")]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
+    reply_markup = keyboards.create_request
 
     if update.message:
         await update.message.reply_text("Извините, я не понял вашу команду или сообщение. Пожалуйста, используйте кнопку 'Создать заявку' или начните заново командой /start.", reply_markup=reply_markup)
@@ -1047,9 +3820,388 @@ async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=chat_id, text=".", reply_markup=reply_markup)
 
 
+def history_scope(update):
+    """chat_id, которым ограничены /history и /report: администраторы видят заявки всех чатов, остальные — только свои."""
+    user = update.effective_user
+    if str(user.id) in HISTORY_ADMINS or (user.username or "") in HISTORY_ADMINS:
+        return None
+    return update.effective_chat.id
+
+def format_history_page(requests, page, text):
+    """Формирует текст страницы результатов /history."""
+    header = f"История заявок по запросу «{text}»" if text else "Последние заявки"
+    lines = [f"{header}, страница {page + 1}:"]
+    for r in requests:
+        submitted = datetime.fromtimestamp(r["submitted_at"]).strftime("%d.%m.%Y %H:%M")
+        lines.append(f"\n{submitted} — {r['project']} / {r['object']} — {r['user_full_name']} ({r['telegram_id_or_username']})")
+        positions = r["positions"]
+        lines.extend(format_position_line(i, p) for i, p in enumerate(positions[:HISTORY_POSITIONS_SHOWN]))
+        if len(positions) > HISTORY_POSITIONS_SHOWN:
+            lines.append(f"… и ещё {len(positions) - HISTORY_POSITIONS_SHOWN}")
+    result = "\n".join(lines)
+    return result if len(result) <= 4000 else result[:4000] + "…"
+
+async def show_history_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page):
+    """Ищет заявки по сохранённому запросу и показывает страницу page с кнопками листания."""
+    text = context.chat_data.get("history_query", "")
+    requests, has_more = await asyncio.to_thread(
+        request_history.search, text, history_scope(update),
+        HISTORY_PAGE_SIZE, page * HISTORY_PAGE_SIZE,
+    )
+    if not requests:
+        message = "Заявки не найдены." if page == 0 else "Больше заявок нет."
+        reply_markup = None
+    else:
+        message = format_history_page(requests, page, text)
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"history_{page - 1}"))
+        if has_more:
+            buttons.append(InlineKeyboardButton("Вперёд ▶️", callback_data=f"history_{page + 1}"))
+        reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    if update.callback_query:
+        await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(message, reply_markup=reply_markup)
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /history [слова]: поиск по отправленным заявкам (позиции, проект, объект, автор)."""
+    context.chat_data["history_query"] = " ".join(context.args)
+    await show_history_page(update, context, 0)
+
+async def history_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание результатов /history."""
+    query = update.callback_query
+    await query.answer()
+    await show_history_page(update, context, int(query.data.removeprefix("history_")))
+
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Команда /report [с по]: сводная заявка за период (даты ГГГГ-ММ-ДД или ДД.ММ.ГГГГ)
+    в виде XLSX. Без параметров — за последние REPORT_DEFAULT_DAYS дней.
+    """
+    dates = [_parse_date(arg) for arg in context.args[:2]]
+    if None in dates:
+        await update.message.reply_text("Укажите период в формате /report 2025-07-01 2025-07-31 (или 01.07.2025 31.07.2025).")
+        return
+    date_to = dates[1] if len(dates) > 1 else date.today()
+    date_from = dates[0] if dates else date_to - timedelta(days=REPORT_DEFAULT_DAYS - 1)
+    filename, content, rows = await asyncio.to_thread(generate_report, date_from, date_to, history_scope(update))
+    if not rows:
+        await update.message.reply_text(f"За период {date_from:%d.%m.%Y} — {date_to:%d.%m.%Y} отправленных заявок нет.")
+        return
+    await update.message.reply_document(
+        document=content, filename=filename,
+        caption=f"Сводная заявка за {date_from:%d.%m.%Y} — {date_to:%d.%m.%Y}: {rows} строк.",
+    )
+
+async def smtp_keepalive_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая задача: NOOP для простаивающих SMTP-сессий и закрытие просроченных."""
+    try:
+        await mail_transport.keepalive()
+    except Exception as e:
+        logger.warning("Ошибка при обслуживании SMTP-сессий: %s", e)
+
+async def archive_maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая задача: срок хранения и пережатие старых книг в архиве."""
+    try:
+        await asyncio.to_thread(request_archive.maintain)
+    except Exception as e:
+        logger.warning("Ошибка при обслуживании архива заявок: %s", e)
+
+async def post_init(application):
+    """Подготавливает ресурсы до начала обработки обновлений."""
+    # Запускается синхронно до появления фоновых потоков, чтобы fork воркеров был безопасным
+    excel_renderer.start()
+    # Восстанавливаем незавершённые заявки, сохранённые до перезапуска
+    sessions = await asyncio.to_thread(state_store.load_sessions)
+    user_state.restore({chat_id: data for chat_id, data in sessions.items() if owns_chat(chat_id)})
+    logger.info("Restored %s unfinished requests from state store.", len(user_state))
+    calendar_keyboards.prewarm()
+    metrics.gauge("bot_active_sessions", lambda: len(user_state))
+    # Потоки HTTP-сервера запускаются только после fork воркеров Excel
+    metrics.serve(port=METRICS_PORT + (WORKER_INDEX or 0))
+    tracer.start()
+
+async def post_shutdown(application):
+    """Освобождает фоновые ресурсы после остановки бота."""
+    mail_transport.shutdown()
+    excel_renderer.shutdown()
+    metrics.shutdown()
+    tracer.stop()
+    if request_archive is not None:
+        request_archive.close()
+    request_history.close()
+    state_store.close()
+
+async def state_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая задача: пакетно сохраняет состояние диалогов в хранилище."""
+    await context.application.update_persistence()
+    await dialog_persistence.write_behind()
+
+# --- НЕСКОЛЬКО ПРОЦЕССОВ-ВОРКЕРОВ ---
+
+def owns_chat(chat_id):
+    """Обслуживает ли этот процесс чат: в кластере чаты делятся между воркерами по chat_id % BOT_WORKERS."""
+    return WORKER_INDEX is None or chat_id % BOT_WORKERS == WORKER_INDEX
+
+def update_partition(update):
+    """Номер воркера, которому лидер передаёт обновление."""
+    chat = update.effective_chat
+    return chat.id % BOT_WORKERS if chat else 0
+
+class ClusterBus:
+    """
+    Общая шина воркеров на SQLite (WAL): аренда роли лидера, смещение getUpdates
+    и очередь входящих обновлений, разбитая на разделы по воркерам.
+    """
+
+    def __init__(self, path=CLUSTER_DB_PATH):
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cursors (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS inbox (id INTEGER PRIMARY KEY AUTOINCREMENT, partition INTEGER NOT NULL, data TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS inbox_partition ON inbox (partition, id)")
+        self._lock = threading.Lock()
+
+    def _transaction(self, work):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work()
+                self._conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def try_lead(self, owner, ttl=CLUSTER_LEASE_TTL):
+        """Захватывает или продлевает аренду лидера. Возвращает True, если лидер — owner."""
+        def work():
+            now = time.time()
+            self._conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES ('leader', ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (owner, now + ttl, now),
+            )
+            return self._conn.execute("SELECT owner FROM leases WHERE name = 'leader'").fetchone()[0] == owner
+        return self._transaction(work)
+
+    def resign(self, owner):
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE name = 'leader' AND owner = ?", (owner,))
+
+    def offset(self):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM cursors WHERE name = 'update_offset'").fetchone()
+        return row[0] if row else None
+
+    def publish(self, updates):
+        """
+        Раскладывает обновления по разделам воркеров и сдвигает смещение getUpdates в одной транзакции.
+        Обновления, уже опубликованные прежним лидером, пропускаются.
+        """
+        def work():
+            row = self._conn.execute("SELECT value FROM cursors WHERE name = 'update_offset'").fetchone()
+            fresh = [u for u in updates if row is None or u.update_id >= row[0]]
+            self._conn.executemany(
+                "INSERT INTO inbox (partition, data) VALUES (?, ?)",
+                [(update_partition(u), u.to_json()) for u in fresh],
+            )
+            if fresh:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cursors (name, value) VALUES ('update_offset', ?)",
+                    (fresh[-1].update_id + 1,),
+                )
+            return len(fresh)
+        return self._transaction(work)
+
+    def take(self, partition, limit=100):
+        """Забирает обновления своего раздела в порядке поступления."""
+        def work():
+            rows = self._conn.execute(
+                "SELECT id, data FROM inbox WHERE partition = ? ORDER BY id LIMIT ?", (partition, limit)
+            ).fetchall()
+            if rows:
+                self._conn.execute("DELETE FROM inbox WHERE partition = ? AND id <= ?", (partition, rows[-1][0]))
+            return [data for _, data in rows]
+        return self._transaction(work)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+async def cluster_leader_loop(application, bus, owner, stop):
+    """Пока процесс держит аренду лидера, получает обновления через getUpdates и публикует их в шину."""
+    leading = False
+    while not stop.is_set():
+        if not await asyncio.to_thread(bus.try_lead, owner):
+            if leading:
+                logger.warning("Worker %s: leader lease lost.", WORKER_INDEX)
+                leading = False
+            try:
+                await asyncio.wait_for(stop.wait(), CLUSTER_LEASE_TTL / 3)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        if not leading:
+            logger.info("Worker %s: became leader, polling for updates.", WORKER_INDEX)
+            await application.bot.delete_webhook()
+            leading = True
+        try:
+            updates = await application.bot.get_updates(
+                offset=await asyncio.to_thread(bus.offset),
+                timeout=CLUSTER_POLL_TIMEOUT,
+                read_timeout=CLUSTER_POLL_TIMEOUT + 5,
+            )
+        except Exception as e:
+            logger.warning("Worker %s: getUpdates failed: %s", WORKER_INDEX, e)
+            await asyncio.sleep(1)
+            continue
+        if updates:
+            published = await asyncio.to_thread(bus.publish, updates)
+            logger.debug("Worker %s: published %s updates.", WORKER_INDEX, published)
+    if leading:
+        await asyncio.to_thread(bus.resign, owner)
+
+async def cluster_inbox_loop(application, bus, stop):
+    """Передаёт обновления своего раздела шины в очередь обновлений приложения."""
+    while not stop.is_set():
+        rows = await asyncio.to_thread(bus.take, WORKER_INDEX)
+        for data in rows:
+            await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+        if not rows:
+            try:
+                await asyncio.wait_for(stop.wait(), CLUSTER_INBOX_POLL)
+            except asyncio.TimeoutError:
+                pass
+
+async def run_cluster_worker(application):
+    """
+    Жизненный цикл воркера в кластерном режиме: вместо run_polling обновления
+    приходят из общей шины, а getUpdates выполняет только текущий лидер.
+    """
+    bus = ClusterBus()
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info("Worker %s/%s started (pid %s).", WORKER_INDEX, BOT_WORKERS, os.getpid())
+    tasks = [
+        asyncio.create_task(cluster_leader_loop(application, bus, owner, stop)),
+        asyncio.create_task(cluster_inbox_loop(application, bus, stop)),
+    ]
+    try:
+        await stop.wait()
+    finally:
+        # Даём циклам завершиться штатно; long polling лидера прерываем
+        await asyncio.wait(tasks, timeout=1)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.to_thread(bus.resign, owner)
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        bus.close()
+        logger.info("Worker %s stopped.", WORKER_INDEX)
+
+def run_cluster_supervisor():
+    """Запускает BOT_WORKERS процессов-воркеров и перезапускает упавшие."""
+    def spawn(index):
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            env={**os.environ, "WORKER_INDEX": str(index)},
+        )
+
+    stopping = False
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    workers = {index: spawn(index) for index in range(BOT_WORKERS)}
+    logger.info("Started %s workers: %s.", BOT_WORKERS, [p.pid for p in workers.values()])
+    while not stopping:
+        time.sleep(1)
+        for index, process in workers.items():
+            if process.poll() is not None and not stopping:
+                logger.error("Worker %s exited with code %s, restarting.", index, process.returncode)
+                workers[index] = spawn(index)
+
+    for process in workers.values():
+        if process.poll() is None:
+            process.terminate()
+    for process in workers.values():
+        process.wait()
+    logger.info("All workers stopped.")
+
+def run_cli(argv):
+    """Служебные команды: python main.py <команда> [параметры]."""
+    parser = argparse.ArgumentParser(prog="main.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="загрузить книги заявок из архива в историю /history")
+    import_parser.add_argument("directory", nargs="?", default=ARCHIVE_DIR, help="каталог с книгами (по умолчанию ARCHIVE_DIR)")
+    import_parser.add_argument("--workers", type=int, default=None, help="число процессов разбора (по умолчанию по числу ядер)")
+    report_parser = commands.add_parser("report", help="сводная заявка за период в XLSX")
+    report_parser.add_argument("date_from", type=date.fromisoformat, help="начало периода, ГГГГ-ММ-ДД")
+    report_parser.add_argument("date_to", type=date.fromisoformat, help="конец периода включительно, ГГГГ-ММ-ДД")
+    report_parser.add_argument("-o", "--output", help="файл отчёта (по умолчанию Сводная_заявка_<с>_<по>.xlsx)")
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        if not os.path.isdir(args.directory):
+            parser.error(f"каталог {args.directory} не найден")
+        stats = import_archive(args.directory, args.workers)
+        processed = stats["imported"] + stats["unchanged"] + stats["failed"]
+        print(f"Найдено книг: {stats['found']}, импортировано: {stats['imported']} ({stats['positions']} позиций), "
+              f"без изменений: {stats['unchanged']}, с ошибками: {stats['failed']}.")
+        print(f"Время: {stats['seconds']:.2f} с, {processed / stats['seconds']:.0f} файлов/с.")
+    elif args.command == "report":
+        started = time.perf_counter()
+        filename, content, rows = generate_report(args.date_from, args.date_to)
+        with open(args.output or filename, "wb") as f:
+            f.write(content)
+        print(f"Отчёт {args.output or filename}: {rows} строк, {time.perf_counter() - started:.2f} с.")
+    request_history.close()
+
 def main():
     """Основная функция для запуска бота."""
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+        return
+    if BOT_WORKERS > 1 and WORKER_INDEX is None:
+        if BOT_MODE == "webhook":
+            raise RuntimeError("Несколько воркеров (BOT_WORKERS > 1) поддерживаются только в режиме polling")
+        run_cluster_supervisor()
+        return
+
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .persistence(dialog_persistence)
+        .concurrent_updates(ChatSerialUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    if tracer.enabled:
+        builder = builder.request(TracingHTTPXRequest(connection_pool_size=256))
+    app = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[MessageHandler(filters.TEXT & filters.Regex("^Создать заявку$"), start_conversation)],
@@ -1103,10 +4255,12 @@ def main():
             EDIT_MENU: [
                 CallbackQueryHandler(select_position_handler, pattern="^(edit_pos|delete_pos)$"),
                 CallbackQueryHandler(show_final_summary_and_confirm, pattern="^continue_final_confirm$"),
+                CallbackQueryHandler(edit_menu_handler, pattern="^summary_page_\\d+$"),
                 CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
             ],
             SELECT_POSITION: [
                 CallbackQueryHandler(process_selected_position, pattern="^select_pos_\\d+$"),
+                CallbackQueryHandler(select_position_handler, pattern="^select_page_\\d+$"),
                 CallbackQueryHandler(edit_menu_handler, pattern="^back_to_edit_menu$"),
                 CallbackQueryHandler(cancel, pattern="^cancel_dialog$")
             ],
@@ -1136,6 +4290,7 @@ def main():
 
             FINAL_CONFIRMATION: [
                 CallbackQueryHandler(cancel, pattern="^cancel_dialog$"),
+                CallbackQueryHandler(show_final_summary_and_confirm, pattern="^summary_page_\\d+$"),
                 CallbackQueryHandler(final_confirm_handler)
             ],
         },
@@ -1144,15 +4299,54 @@ def main():
             CallbackQueryHandler(cancel, pattern="^cancel_dialog$"),
             MessageHandler(filters.COMMAND | filters.TEXT, unknown)
         ],
+        name="request_dialog",
+        persistent=True,
     )
-
+    # Диалоги, чей черновик удалён (простой, лимит, перезапуск), завершаются при первом же обновлении из чата
+    missing_draft = MissingDraftHandler(missing_draft_handler)
+    for state_handlers in conv_handler.states.values():
+        state_handlers.insert(0, missing_draft)
+
+    # Команды истории и отчёта доступны и посреди диалога, поэтому регистрируется раньше ConversationHandler
+    history_handlers = [
+        CommandHandler("history", history_command),
+        CommandHandler("report", report_command),
+        CallbackQueryHandler(history_page_callback, pattern="^history_\\d+$"),
+    ]
+    if metrics.enabled or tracer.enabled:
+        instrument_handlers(history_handlers + conv_handler.entry_points + conv_handler.fallbacks
+                            + [h for hs in conv_handler.states.values() for h in hs])
+    app.add_handlers(history_handlers)
     app.add_handler(conv_handler)
 
+    app.job_queue.run_repeating(outbox_worker_job, interval=OUTBOX_POLL_INTERVAL, first=0)
+    app.job_queue.run_repeating(state_flush_job, interval=STATE_FLUSH_INTERVAL, first=STATE_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(session_sweeper_job, interval=SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL)
+    app.job_queue.run_repeating(smtp_keepalive_job, interval=SMTP_KEEPALIVE_INTERVAL, first=SMTP_KEEPALIVE_INTERVAL)
+    # Архив общий для всех воркеров, обслуживает его только один
+    if request_archive is not None and not WORKER_INDEX:
+        app.job_queue.run_repeating(archive_maintenance_job, interval=ARCHIVE_MAINTENANCE_INTERVAL, first=60)
+
     app.add_handler(CommandHandler("start", initial_message_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, initial_message_handler))
 
-
-    app.run_polling()
+    if WORKER_INDEX is not None:
+        asyncio.run(run_cluster_worker(app))
+    elif BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise RuntimeError("Для BOT_MODE=webhook нужно задать WEBHOOK_URL")
+        logger.info("Starting webhook server on %s:%s/%s (max_connections=%s, concurrent_updates=%s).",
+                    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_MAX_CONNECTIONS, CONCURRENT_UPDATES)
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,28 @@
+"""
+Общая настройка тестов: main.py импортируется так, чтобы его файлы состояния
+(очередь, история, архив, spool) создавались во временном каталоге, а не в репозитории.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="supply-bot-tests-")
+
+os.environ.update({
+    "STATE_BACKEND": "memory",
+    "OUTBOX_PATH": os.path.join(WORKDIR, "outbox.db"),
+    "HISTORY_DB_PATH": os.path.join(WORKDIR, "history.db"),
+    "ATTACHMENT_SPOOL_DIR": os.path.join(WORKDIR, "spool"),
+    "ARCHIVE_DIR": os.path.join(WORKDIR, "out"),
+    "EXCEL_ARCHIVE": "0",
+    "EXCEL_PROCESSES": "0",
+})
+os.environ.setdefault("SMTP_PORT", "25") # Без .env модуль не импортируется
+sys.path.insert(0, ROOT)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(WORKDIR, ignore_errors=True)
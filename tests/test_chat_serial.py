@@ -0,0 +1,114 @@
+"""
+Нагрузочная проверка ChatSerialUpdateProcessor: N чатов присылают обновления одновременно.
+Обновления одного чата обрабатываются строго по очереди, разные чаты - параллельно,
+а удаление черновика сборщиком не вклинивается в работающий обработчик того же чата.
+"""
+
+import asyncio
+import random
+from collections import defaultdict
+from types import SimpleNamespace
+
+from telegram import Update
+
+import main
+
+CHATS = 50
+UPDATES_PER_CHAT = 20
+LIMIT = 8
+
+
+def make_update(update_id, chat_id):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": "x",
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+        },
+    }, None)
+
+
+async def run_stress():
+    processor = main.ChatSerialUpdateProcessor(LIMIT)
+    await processor.initialize()
+    seen = defaultdict(list)
+    active_per_chat = defaultdict(int)
+    stats = {"active": 0, "max_active": 0, "max_per_chat": 0}
+
+    async def handler(chat_id, seq):
+        active_per_chat[chat_id] += 1
+        stats["active"] += 1
+        stats["max_per_chat"] = max(stats["max_per_chat"], active_per_chat[chat_id])
+        stats["max_active"] = max(stats["max_active"], stats["active"])
+        await asyncio.sleep(random.uniform(0, 0.002)) # Обработчик ждёт сеть, отдавая управление
+        seen[chat_id].append(seq)
+        stats["active"] -= 1
+        active_per_chat[chat_id] -= 1
+
+    # Обновления разных чатов перемешаны, как в реальном потоке, но порядок внутри чата сохранён
+    order = [chat_id for chat_id in range(CHATS) for _ in range(UPDATES_PER_CHAT)]
+    random.shuffle(order)
+    counters = defaultdict(int)
+    tasks = []
+    for update_id, chat_id in enumerate(order):
+        seq = counters[chat_id]
+        counters[chat_id] += 1
+        tasks.append(asyncio.create_task(
+            processor.process_update(make_update(update_id, chat_id), handler(chat_id, seq))
+        ))
+    await asyncio.gather(*tasks)
+    return seen, stats, processor
+
+
+def test_updates_of_one_chat_stay_ordered_across_parallel_chats():
+    random.seed(16)
+    seen, stats, processor = asyncio.run(run_stress())
+
+    assert all(seen[chat_id] == list(range(UPDATES_PER_CHAT)) for chat_id in range(CHATS))
+    assert stats["max_per_chat"] == 1
+    assert 1 < stats["max_active"] <= LIMIT
+    assert not processor._chat_locks # Блокировки чатов освобождаются после обработки
+
+
+async def run_sweep_during_handler(monkeypatch, ttl):
+    processor = main.ChatSerialUpdateProcessor(LIMIT)
+    await processor.initialize()
+    chat_id = 4242
+    main.user_state[chat_id] = main.Draft(project="Мотели")
+    monkeypatch.setattr(main, "SESSION_IDLE_TTL", ttl)
+    await asyncio.sleep(ttl * 1.5) # Черновик успевает стать простаивающим
+
+    events = []
+    bot = SimpleNamespace(send_message=lambda **kwargs: asyncio.sleep(0, events.append("notice")))
+    context = SimpleNamespace(application=SimpleNamespace(update_processor=processor, bot=bot))
+    handler_started = asyncio.Event()
+
+    async def handler():
+        handler_started.set()
+        await asyncio.sleep(0.05) # Сборщик запускается, пока обработчик ждёт сеть
+        main.user_state[chat_id].positions.append(main.Position(name="Болт")) # Без общей очереди здесь был KeyError
+        events.append("handler")
+
+    update_task = asyncio.create_task(processor.process_update(make_update(1, chat_id), handler()))
+    await handler_started.wait()
+    await main.session_sweeper_job(context)
+    await update_task
+    return chat_id, events
+
+
+def test_sweeper_waits_for_running_handler(monkeypatch):
+    chat_id, events = asyncio.run(run_sweep_during_handler(monkeypatch, ttl=0))
+
+    # Черновик удаляется только после того, как обработчик чата закончил с ним работу
+    assert events == ["handler", "notice"]
+    assert chat_id not in main.user_state
+
+
+def test_sweeper_keeps_draft_touched_while_waiting(monkeypatch):
+    chat_id, events = asyncio.run(run_sweep_during_handler(monkeypatch, ttl=0.02))
+
+    # Пока сборщик ждал очереди чата, обработчик обратился к черновику - он больше не простаивает
+    assert events == ["handler"]
+    assert chat_id in main.user_state
+    del main.user_state[chat_id]
@@ -0,0 +1,77 @@
+"""
+download_attachments с подставным ботом, который отдаёт локальные файлы с заданной задержкой:
+результаты идут в порядке позиций, медленный файл упирается в таймаут, не мешая остальным,
+а одновременных загрузок не больше ATTACHMENT_DOWNLOAD_CONCURRENCY.
+"""
+
+import asyncio
+import os
+import shutil
+
+import main
+
+CONCURRENCY = 3
+TIMEOUT = 0.3
+SLOW_POSITION = 4
+
+
+class FakeBot:
+    """Вместо Telegram отдаёт файлы из локального каталога; file_id - имя файла."""
+
+    def __init__(self, source_dir, delays):
+        self.source_dir = source_dir
+        self.delays = delays
+        self.active = 0
+        self.max_active = 0
+
+    async def get_file(self, file_id):
+        return FakeFile(self, file_id)
+
+
+class FakeFile:
+    def __init__(self, bot, file_id):
+        self.bot = bot
+        self.file_id = file_id
+
+    async def download_to_drive(self, path):
+        bot = self.bot
+        bot.active += 1
+        bot.max_active = max(bot.max_active, bot.active)
+        try:
+            await asyncio.sleep(bot.delays[self.file_id])
+            shutil.copyfile(os.path.join(bot.source_dir, self.file_id), path)
+        finally:
+            bot.active -= 1
+
+
+def test_downloads_in_position_order_with_timeout_and_limit(tmp_path, monkeypatch):
+    source_dir = tmp_path / "telegram"
+    source_dir.mkdir()
+    # Ранние позиции скачиваются дольше поздних, чтобы порядок завершения отличался от порядка позиций
+    delays = {}
+    files = []
+    for pos_index in range(1, 9):
+        file_id = f"file{pos_index}.pdf"
+        (source_dir / file_id).write_bytes(f"содержимое {pos_index}".encode("utf-8") * pos_index)
+        delays[file_id] = 5 if pos_index == SLOW_POSITION else 0.02 * (9 - pos_index)
+        files.append((pos_index, main.FileData(file_id, file_id, "application/pdf", f"U{pos_index}")))
+
+    bot = FakeBot(str(source_dir), delays)
+    monkeypatch.setattr(main, "ATTACHMENT_DOWNLOAD_CONCURRENCY", CONCURRENCY)
+    monkeypatch.setattr(main, "ATTACHMENT_DOWNLOAD_TIMEOUT", TIMEOUT)
+    monkeypatch.setattr(main, "attachment_prefetcher", main.AttachmentPrefetcher(str(tmp_path / "spool")))
+
+    results = asyncio.run(main.download_attachments(bot, "request-1", files))
+
+    assert [pos_index for pos_index, *_ in results] == list(range(1, 9))
+    for pos_index, file_data, file_path, error in results:
+        if pos_index == SLOW_POSITION:
+            assert isinstance(error, TimeoutError)
+            assert file_path is None
+            continue
+        assert error is None
+        with open(file_path, "rb") as f:
+            assert f.read() == (source_dir / file_data.file_id).read_bytes()
+    assert bot.max_active == CONCURRENCY
+    # От прерванной загрузки не остаётся недокачанного файла
+    assert not [name for name in os.listdir(tmp_path / "spool") if name.endswith(".part")]
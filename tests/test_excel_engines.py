@@ -0,0 +1,56 @@
+"""Книга, собранная движком ooxml, совпадает с книгой openpyxl по значениям и стилям ячеек."""
+
+import io
+import os
+from copy import copy
+from datetime import date
+
+import pytest
+from openpyxl import load_workbook
+
+import main
+from conftest import ROOT
+
+TEMPLATE = os.path.join(ROOT, "template.xlsx")
+
+
+def make_positions(count):
+    positions = []
+    for i in range(count):
+        positions.append(main.Position(
+            name=f"Кабель ВВГнг 3x{i + 1},5 <м> & \"проч\"" if i % 3 == 0 else f"Позиция {i + 1}",
+            unit=main.units[i % len(main.units)] if i % 5 else None,
+            quantity=[1, 2.5, 100, 0.75, 12.0][i % 5],
+            module=main.modules[i % len(main.modules)],
+            delivery_date=date(2025, 7, 1 + i % 28) if i % 4 else None,
+            link=f"https://example.com/item?id={i}&ref=bot" if i % 2 else None,
+        ))
+    return positions
+
+
+def render(engine, positions, monkeypatch):
+    monkeypatch.setattr(main, "excel_template", engine(TEMPLATE))
+    filename, content = main.fill_excel("Мотели", "Каркаролинск", positions, "Иван Петров", "@ivan")
+    return filename, load_workbook(io.BytesIO(content)).active
+
+
+def cell_style(cell):
+    # copy() снимает StyleProxy: сами прокси между собой не сравниваются
+    return (copy(cell.font), copy(cell.fill), copy(cell.border), copy(cell.alignment),
+            cell.number_format, copy(cell.protection))
+
+
+@pytest.mark.parametrize("count", [0, 1, 12, 60])
+def test_ooxml_matches_openpyxl(count, monkeypatch):
+    positions = make_positions(count)
+    expected_name, expected = render(main.ExcelTemplateCache, positions, monkeypatch)
+    actual_name, actual = render(main.OoxmlTemplate, positions, monkeypatch)
+
+    assert actual_name == expected_name
+    assert (actual.max_row, actual.max_column) == (expected.max_row, expected.max_column)
+    for expected_row, actual_row in zip(expected.iter_rows(), actual.iter_rows()):
+        for expected_cell, actual_cell in zip(expected_row, actual_row):
+            assert actual_cell.value == expected_cell.value, expected_cell.coordinate
+            # Номера стилей openpyxl перенумеровывает при сохранении, поэтому сравниваются сами стили
+            assert cell_style(actual_cell) == cell_style(expected_cell), expected_cell.coordinate
+            assert actual_cell.has_style == expected_cell.has_style, expected_cell.coordinate
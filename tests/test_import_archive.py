@@ -0,0 +1,77 @@
+"""
+import_archive не дублирует заявки в истории: изменённая старая книга заменяет
+свою прежнюю заявку, а книга outbox-<id>.xlsx относится к заявке, уже записанной ботом.
+"""
+
+import os
+
+import pytest
+
+import main
+from conftest import ROOT
+
+TEMPLATE = os.path.join(ROOT, "template.xlsx")
+
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    history = main.RequestHistory(str(tmp_path / "history.db"))
+    monkeypatch.setattr(main, "request_history", history)
+    monkeypatch.setattr(main, "excel_template", main.OoxmlTemplate(TEMPLATE))
+    return history
+
+
+def write_workbook(path, names, mtime_ns):
+    positions = [main.Position(name=name, unit="шт", quantity=1, module="1") for name in names]
+    _, content = main.fill_excel("Мотели", "Каркаролинск", positions, "Иван Петров", "@ivan")
+    with open(path, "wb") as f:
+        f.write(content)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def requests(history):
+    found, _ = history.search(limit=100)
+    return {r["request_id"]: [p.name for p in r["positions"]] for r in found}
+
+
+def test_edited_legacy_workbook_replaces_its_request(tmp_path, history):
+    archive = tmp_path / "out"
+    archive.mkdir()
+    path = str(archive / "Заявка_Мотели_Каркаролинск_Иван_Петров_2024-05-01.xlsx")
+    write_workbook(path, ["Болт М8"], 1_000_000_000)
+    main.import_archive(str(archive), workers=1)
+
+    write_workbook(path, ["Болт М8", "Гайка М8"], 2_000_000_000)
+    stats = main.import_archive(str(archive), workers=1)
+
+    assert stats["imported"] == 1
+    assert list(requests(history).values()) == [["Болт М8", "Гайка М8"]]
+
+
+def test_edited_copy_keeps_request_of_identical_workbook(tmp_path, history):
+    archive = tmp_path / "out"
+    archive.mkdir()
+    first, second = str(archive / "Заявка_1.xlsx"), str(archive / "Заявка_2.xlsx")
+    write_workbook(first, ["Болт М8"], 1_000_000_000)
+    with open(first, "rb") as src, open(second, "wb") as dst:
+        dst.write(src.read())
+    main.import_archive(str(archive), workers=1)
+    assert len(requests(history)) == 1 # Одинаковые книги - одна заявка
+
+    write_workbook(second, ["Гайка М8"], 2_000_000_000)
+    main.import_archive(str(archive), workers=1)
+
+    assert sorted(requests(history).values()) == [["Болт М8"], ["Гайка М8"]]
+
+
+def test_outbox_workbook_matches_request_recorded_by_bot(tmp_path, history):
+    archive = tmp_path / "out" / "2024" / "05" / "Мотели"
+    archive.mkdir(parents=True)
+    write_workbook(str(archive / "outbox-7.xlsx"), ["Болт М8"], 1_000_000_000)
+    history.record("outbox-7", 42, "Мотели", "Каркаролинск", "Иван Петров", "@ivan",
+                   [main.Position(name="Болт М8", unit="шт", quantity=1, module="1")])
+
+    main.import_archive(str(tmp_path / "out"), workers=1)
+
+    found, _ = history.search(limit=100)
+    assert [(r["request_id"], r["chat_id"]) for r in found] == [("outbox-7", 42)]
@@ -0,0 +1,26 @@
+"""Инструментирование обработчиков: каждое обновление учитывается в метриках один раз."""
+
+import asyncio
+from types import SimpleNamespace
+
+from telegram.ext import ConversationHandler
+
+import main
+
+
+def test_shared_handler_is_instrumented_once(monkeypatch):
+    monkeypatch.setattr(main, "metrics", main.Metrics(enabled=True))
+
+    async def missing_draft_handler(update, context):
+        return ConversationHandler.END
+
+    # Как в main(): один MissingDraftHandler стоит первым во всех состояниях диалога
+    shared = main.MissingDraftHandler(missing_draft_handler)
+    states = {state: [shared, main.MissingDraftHandler(missing_draft_handler)] for state in range(19)}
+    main.instrument_handlers([h for hs in states.values() for h in hs])
+
+    asyncio.run(shared.callback(SimpleNamespace(), None))
+
+    rendered = main.metrics.render()
+    assert 'bot_handler_seconds_count{handler="missing_draft_handler"} 1\n' in rendered
+    assert 'bot_state_transitions_total{handler="missing_draft_handler",state="END"} 1\n' in rendered
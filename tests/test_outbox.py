@@ -0,0 +1,42 @@
+"""
+MailOutbox при общем outbox.db: пока другой воркер держит блокировку записи,
+drain ждёт её в фоновом потоке, а цикл событий продолжает обрабатывать обновления.
+"""
+
+import asyncio
+import sqlite3
+import threading
+import time
+
+import main
+
+LOCK_HELD = 0.3
+TICK = 0.01
+
+
+def test_drain_waits_for_write_lock_off_the_event_loop(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = main.MailOutbox(path)
+    other = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE") # Другой воркер забирает заявки
+    release = threading.Timer(LOCK_HELD, other.execute, ("COMMIT",))
+
+    async def run():
+        ticks = 0
+        release.start()
+        drain = asyncio.create_task(outbox.drain(bot=None))
+        started = time.monotonic()
+        while not drain.done():
+            await asyncio.sleep(TICK)
+            ticks += 1
+        await drain
+        return ticks, time.monotonic() - started
+
+    try:
+        ticks, elapsed = asyncio.run(run())
+    finally:
+        release.cancel()
+        other.close()
+
+    assert elapsed >= LOCK_HELD * 0.8 # drain действительно ждал блокировку
+    assert ticks >= LOCK_HELD / TICK / 3 # а цикл событий всё это время работал
@@ -0,0 +1,98 @@
+"""
+SmtpConnectionPool против локального SMTP-сервера из benchmarks/support.py:
+сессии переиспользуются, обрыв соединения лечится переподключением,
+простаивающие сессии закрываются, а keepalive() не выходит за размер пула.
+"""
+
+import time
+import threading
+
+import pytest
+
+import main
+from benchmarks.support import SinkServer
+
+
+@pytest.fixture
+def sink():
+    server = SinkServer().start()
+    yield server
+    server.stop()
+
+
+def make_pool(sink, **kwargs):
+    return main.SmtpConnectionPool("127.0.0.1", sink.port, None, None, starttls=False, **kwargs)
+
+
+def send(pool, text="Заявка"):
+    pool.send_stream("bot@example.com", ["supply@example.com"], lambda: main.iter_mime_message(
+        "bot@example.com", "supply@example.com", text, "Во вложении заявка на снабжение.", [],
+    ))
+
+
+def test_sessions_are_reused(sink):
+    pool = make_pool(sink, size=2)
+    for _ in range(3):
+        send(pool)
+    pool.close_all()
+
+    assert len(sink.received) == 3
+    assert sink.connections == 1
+
+
+def test_reconnects_after_server_drops_connection(sink):
+    pool = make_pool(sink, size=1)
+    send(pool)
+    sink.drop_connections()
+    send(pool) # Сессия из пула уже разорвана: письмо уходит через новое соединение
+    pool.close_all()
+
+    assert len(sink.received) == 2
+    assert sink.connections == 2
+
+
+def test_idle_sessions_are_evicted(sink):
+    pool = make_pool(sink, size=2, idle_timeout=0.05)
+    send(pool)
+    time.sleep(0.1)
+    pool.keepalive()
+
+    assert pool._idle.qsize() == 0
+    assert sink.wait_idle() == 0 # Сессия закрыта командой QUIT, а не брошена открытой
+
+
+def test_keepalive_stays_within_pool_size(sink):
+    size = 2
+    sink.data_delay = 0.01 # Письма идут дольше, чтобы отправители и keepalive пересекались
+    pool = make_pool(sink, size=size, keepalive_interval=0)
+    senders = [threading.Thread(target=send, args=(pool,)) for _ in range(size)]
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+
+    stop = threading.Event()
+
+    def keep_alive():
+        while not stop.is_set():
+            pool.keepalive()
+            time.sleep(0.001)
+
+    def send_many():
+        for _ in range(10):
+            send(pool)
+
+    keeper = threading.Thread(target=keep_alive)
+    keeper.start()
+    senders = [threading.Thread(target=send_many) for _ in range(4)]
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    stop.set()
+    keeper.join()
+    pool.close_all()
+
+    assert len(sink.received) == size + 40
+    assert sink.noops > 0
+    assert sink.max_active <= size